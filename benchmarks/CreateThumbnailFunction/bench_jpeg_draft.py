@@ -0,0 +1,78 @@
+"""
+JPEGのサムネイル生成のベンチマーク。
+元の解像度でデコードしてから縮小する方法(full)と、draftで縮小してデコードする方法(draft)を比較する。
+ピークメモリを正しく測るため、ケースごとに別プロセスで実行する。
+
+$ PYTHONPATH=src/CreateThumbnailFunction python benchmarks/CreateThumbnailFunction/bench_jpeg_draft.py
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image
+
+os.environ.setdefault('THUMBNAIL_SIZE', '250')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+
+import thumbnail_creator  # noqa: E402
+
+SIZES = [(1000, 750), (3000, 2000), (6000, 4000)]
+
+
+def create_jpeg(width, height):
+    # 一様な色だと圧縮されすぎるので、ノイズを縮小した画像を使う
+    image = Image.effect_noise((width // 8, height // 8), 64).convert('RGB').resize((width, height))
+    io = BytesIO()
+    image.save(io, format='JPEG', quality=90)
+    return io.getvalue()
+
+
+def run(mode, path, repeat=3):
+    """
+    子プロセスで実行される。最速の時間とプロセスのピークメモリ(MB)を出力する
+    """
+    with open(path, 'rb') as f:
+        raw_bytes = f.read()
+    if mode == 'full':
+        thumbnail_creator.draft_image = lambda image, size: image
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = Image.open(BytesIO(raw_bytes))
+        thumbnail_creator.create_thumbnail(image)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{best} {peak / 1024}')
+
+
+def measure(mode, path):
+    output = subprocess.check_output([sys.executable, __file__, mode, path])
+    elapsed, memory = output.decode('utf-8').split()
+    return float(elapsed), float(memory)
+
+
+def main():
+    print(f'{"size":>10} {"full [s]":>9} {"draft [s]":>10} {"speedup":>8} {"full [MB]":>10} {"draft [MB]":>11}')
+    for width, height in SIZES:
+        # 画像の生成でピークメモリが増えないように、親プロセスで生成してファイル経由で渡す
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+            f.write(create_jpeg(width, height))
+            f.flush()
+            full_time, full_memory = measure('full', f.name)
+            draft_time, draft_memory = measure('draft', f.name)
+        print(
+            f'{f"{width}x{height}":>10} {full_time:>9.4f} {draft_time:>10.4f} {full_time / draft_time:>7.1f}x'
+            f' {full_memory:>10.1f} {draft_memory:>11.1f}'
+        )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        run(sys.argv[1], sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,70 @@
+"""
+サムネイルの縮小処理のベンチマーク。
+元の解像度の正方形を作ってから縮小する以前の方法(square canvas)と、縮小してから余白を追加する方法(resize then pad)を比較する。
+デコード済みの画像に対して、縮小処理で増えたピークメモリを測るため、ケースごとに別プロセスで実行する。
+
+$ PYTHONPATH=src/CreateThumbnailFunction python benchmarks/CreateThumbnailFunction/bench_resize_to_square.py
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from PIL import Image
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+
+import thumbnail_creator  # noqa: E402
+
+SIZE = 250
+SIZES = [(1000, 750), (3000, 2000), (6000, 4000)]
+
+
+def resize_square_canvas(image, size):
+    width, height = image.size
+    longest = max(width, height)
+    square_image = Image.new(image.mode, (longest, longest), (0, 0, 0))
+    square_image.paste(image, ((longest - width) // 2, (longest - height) // 2))
+    return square_image.resize((size, size), Image.LANCZOS)
+
+
+def run(mode, width, height, repeat=3):
+    """
+    子プロセスで実行される。最速の時間と、縮小処理で増えたピークメモリ(MB)を出力する
+    """
+    func = resize_square_canvas if mode == 'square' else thumbnail_creator.resize_to_square
+    image = Image.new('RGB', (width, height), (255, 0, 0))
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(image, SIZE)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{best} {(peak - baseline) / 1024}')
+
+
+def measure(mode, width, height):
+    output = subprocess.check_output([sys.executable, __file__, mode, str(width), str(height)])
+    elapsed, memory = output.decode('utf-8').split()
+    return float(elapsed), float(memory)
+
+
+def main():
+    print(f'{"size":>10} {"square [s]":>11} {"pad [s]":>8} {"square [MB]":>12} {"pad [MB]":>9}')
+    for width, height in SIZES:
+        square_time, square_memory = measure('square', width, height)
+        pad_time, pad_memory = measure('pad', width, height)
+        print(
+            f'{f"{width}x{height}":>10} {square_time:>11.4f} {pad_time:>8.4f}'
+            f' {square_memory:>12.1f} {pad_memory:>9.1f}'
+        )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        run(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        main()
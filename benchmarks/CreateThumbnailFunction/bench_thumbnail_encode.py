@@ -0,0 +1,68 @@
+"""
+サムネイルのエンコードのベンチマーク。
+写真に近い画像から作ったサムネイルを、形式とエンコードのOptionごとにエンコードし、時間と出力のサイズを比較する。
+
+$ PYTHONPATH=src/CreateThumbnailFunction python benchmarks/CreateThumbnailFunction/bench_thumbnail_encode.py
+"""
+import os
+import time
+
+from PIL import Image, ImageFilter
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+
+import thumbnail_creator  # noqa: E402
+
+SIZES = [64, 250, 800]
+SAVE_OPTIONS = [
+    {'format': 'PNG'},
+    {'format': 'PNG', 'compress_level': 1},
+    {'format': 'PNG', 'optimize': True},
+    {'format': 'JPEG', 'quality': 85},
+    {'format': 'JPEG', 'quality': 85, 'optimize': True},
+    {'format': 'JPEG', 'quality': 75},
+    {'format': 'WEBP', 'quality': 80},
+    {'format': 'WEBP', 'quality': 60}
+]
+
+
+def create_photo_like_image(width, height):
+    """
+    グラデーションにノイズとぼかしを加えた、写真に近い画像を作る
+    """
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 48).filter(ImageFilter.GaussianBlur(1.5))
+    red = Image.blend(gradient, noise, 0.4)
+    green = Image.blend(gradient.rotate(90).resize((width, height)), noise, 0.5)
+    blue = Image.effect_noise((width // 16, height // 16), 96).resize((width, height), Image.BICUBIC)
+    return Image.merge('RGB', (red, green, blue))
+
+
+def measure(thumbnail, save_option, repeat=5):
+    best = None
+    raw_bytes = b''
+    for _ in range(repeat):
+        start = time.perf_counter()
+        raw_bytes = thumbnail_creator.convert_image_to_bytes(thumbnail, save_option)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(raw_bytes)
+
+
+def format_option(save_option):
+    return ', '.join(f'{k}={v}' for k, v in save_option.items())
+
+
+def main():
+    image = create_photo_like_image(3000, 2000)
+    for size in SIZES:
+        thumbnail = thumbnail_creator.resize_to_square(image, size)
+        print(f'size: {size}px')
+        print(f'  {"option":<40} {"encode [ms]":>12} {"bytes":>9}')
+        for save_option in SAVE_OPTIONS:
+            elapsed, length = measure(thumbnail, save_option)
+            print(f'  {format_option(save_option):<40} {elapsed * 1000:>12.2f} {length:>9}')
+
+
+if __name__ == '__main__':
+    main()
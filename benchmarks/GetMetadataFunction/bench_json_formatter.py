@@ -0,0 +1,155 @@
+"""
+JSONのLogFormatterのベンチマーク。
+LogRecordの全ての属性を1つずつjson.dumpsで確かめてから全体を変換する従来の方法と、
+決まった属性だけを1回で変換する現在のJsonLogFormatterを、API GatewayとSNSのEventをLogに出す場合で比較する。
+loggerパッケージは全てのFunctionで同じものを使っている。
+
+$ PYTHONPATH=src/GetMetadataFunction python benchmarks/GetMetadataFunction/bench_json_formatter.py
+"""
+import json
+import logging
+import os
+import time
+
+from logger.json_formatter import JsonLogFormatter
+
+
+class LegacyJsonLogFormatter(logging.Formatter):
+    """
+    以前のJsonLogFormatter
+    """
+
+    def format(self, record):
+        result = {}
+
+        for attr, value in record.__dict__.items():
+            if attr == 'asctime':
+                value = self.formatTime(record)
+            if attr == 'exc_info' and value is not None:
+                value = self.formatException(value)
+            if attr == 'stack_info' and value is not None:
+                value = self.formatStack(value)
+
+            try:
+                json.dumps(value)
+            except Exception:
+                value = str(value)
+
+            result[attr] = value
+
+        result['lambda_request_id'] = os.environ.get('LAMBDA_REQUEST_ID')
+
+        return json.dumps(result, ensure_ascii=False)
+
+
+def create_api_gateway_event():
+    return {
+        'resource': '/metadata/{id}',
+        'path': '/metadata/34d4b1ab-edfb-4b21-83e9-642e2f623345',
+        'httpMethod': 'GET',
+        'headers': {
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate, br',
+            'CloudFront-Forwarded-Proto': 'https',
+            'CloudFront-Viewer-Country': 'JP',
+            'Host': 'xxxxxxxxxx.execute-api.ap-northeast-1.amazonaws.com',
+            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_6) AppleWebKit/537.36',
+            'Via': '2.0 xxxxxxxxxxxxxxxx.cloudfront.net (CloudFront)',
+            'X-Amz-Cf-Id': 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+            'X-Amzn-Trace-Id': 'Root=1-5d6b1c2e-xxxxxxxxxxxxxxxxxxxxxxxx',
+            'X-Forwarded-For': '203.0.113.1, 198.51.100.1',
+            'X-Forwarded-Port': '443',
+            'X-Forwarded-Proto': 'https'
+        },
+        'queryStringParameters': {'include': 'urls'},
+        'pathParameters': {'id': '34d4b1ab-edfb-4b21-83e9-642e2f623345'},
+        'stageVariables': None,
+        'requestContext': {
+            'resourcePath': '/metadata/{id}',
+            'httpMethod': 'GET',
+            'path': '/v1/metadata/34d4b1ab-edfb-4b21-83e9-642e2f623345',
+            'accountId': '123456789012',
+            'stage': 'v1',
+            'requestId': 'c6af9ac6-7b61-11e6-9a41-93e8deadbeef',
+            'identity': {'sourceIp': '203.0.113.1', 'userAgent': 'Mozilla/5.0'},
+            'apiId': 'xxxxxxxxxx'
+        },
+        'body': None,
+        'isBase64Encoded': False
+    }
+
+
+def create_sns_event():
+    s3_message = {
+        'Records': [
+            {
+                'eventVersion': '2.1',
+                'eventSource': 'aws:s3',
+                'awsRegion': 'ap-northeast-1',
+                'eventTime': '2019-08-27T01:12:42.512Z',
+                'eventName': 'ObjectCreated:Put',
+                's3': {
+                    'bucket': {'name': 'data-bucket', 'arn': 'arn:aws:s3:::data-bucket'},
+                    'object': {
+                        'key': 'images/34d4b1ab-edfb-4b21-83e9-642e2f623345/dog.png',
+                        'size': 1048576,
+                        'eTag': 'd41d8cd98f00b204e9800998ecf8427e',
+                        'sequencer': '005D6483AA7A0F33E1'
+                    }
+                }
+            }
+        ]
+    }
+    return {
+        'Records': [
+            {
+                'EventSource': 'aws:sns',
+                'EventVersion': '1.0',
+                'EventSubscriptionArn': 'arn:aws:sns:ap-northeast-1:123456789012:topic:xxxxxxxx',
+                'Sns': {
+                    'Type': 'Notification',
+                    'MessageId': '95df01b4-ee98-5cb9-9903-4c221d41eb5e',
+                    'TopicArn': 'arn:aws:sns:ap-northeast-1:123456789012:topic',
+                    'Subject': 'Amazon S3 Notification',
+                    'Message': json.dumps(s3_message),
+                    'Timestamp': '2019-08-27T01:12:42.612Z',
+                    'SignatureVersion': '1',
+                    'Signature': 'x' * 344,
+                    'SigningCertUrl': 'https://sns.ap-northeast-1.amazonaws.com/SimpleNotificationService.pem',
+                    'UnsubscribeUrl': 'https://sns.ap-northeast-1.amazonaws.com/?Action=Unsubscribe',
+                    'MessageAttributes': {}
+                }
+            }
+        ]
+    }
+
+
+def create_record(event):
+    # logger.info('event', event)と同じLogRecord。dict1つだけのargsはdictとして保持される
+    return logging.LogRecord('index', logging.INFO, __file__, 1, 'event', (event,), None)
+
+
+def measure(formatter, record, count=20000, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(count):
+            formatter.format(record)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count * 1000000
+
+
+def main():
+    legacy = LegacyJsonLogFormatter()
+    current = JsonLogFormatter()
+    print(f'{"event":>12} {"legacy [us]":>12} {"current [us]":>13} {"speedup":>8}')
+    for name, event in [('api_gateway', create_api_gateway_event()), ('sns', create_sns_event())]:
+        record = create_record(event)
+        legacy_time = measure(legacy, record)
+        current_time = measure(current, record)
+        print(f'{name:>12} {legacy_time:>12.2f} {current_time:>13.2f} {legacy_time / current_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+コールドスタート時のロギング設定のベンチマーク。
+Functionごとに新しいプロセスでindexをimportし、get_loggerを呼ぶたびにdictConfigを行う従来の方法と、
+プロセスで1回だけ設定する現在の方法で、importにかかる時間とdictConfigの回数・時間を比較する。
+importの時間にはboto3などのimportも含まれるので、ロギング設定の差はdictConfigの時間で確認する。
+
+$ python benchmarks/bench_cold_start.py
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+FUNCTIONS = [
+    'CreateMetadataFunction',
+    'CreateThumbnailFunction',
+    'GetMetadataFunction',
+    'PutS3EventFunction',
+    'UpdateMetadataFunction'
+]
+
+# 子プロセスで実行するコード。dictConfigの呼び出しを数え、indexのimportにかかった時間を出力する
+SCRIPT = """
+import json
+import logging
+import logging.config
+import sys
+import time
+
+start = time.perf_counter()
+from logger import get_logger
+
+original_dict_config = logging.config.dictConfig
+stats = {'calls': 0, 'configTime': 0.0}
+
+
+def dict_config(config):
+    config_start = time.perf_counter()
+    original_dict_config(config)
+    stats['calls'] += 1
+    stats['configTime'] += time.perf_counter() - config_start
+
+
+logging.config.dictConfig = dict_config
+
+if sys.argv[1] == 'legacy':
+    def legacy_get_logger(name):
+        logging.config.dictConfig(get_logger.get_logging_config())
+        return logging.getLogger(name)
+    get_logger.get_logger = legacy_get_logger
+
+import index
+stats['importTime'] = time.perf_counter() - start
+print(json.dumps(stats))
+"""
+
+
+def measure(function_name, mode, repeat=7):
+    env = dict(os.environ, PYTHONPATH=os.path.join(SRC_DIR, function_name))
+    # import時にclientを作るFunctionがあるので、認証情報を探しに行かないようにダミーの値を設定する
+    env.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'dummy')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'dummy')
+    results = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', SCRIPT, mode], env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ).stdout
+        results.append(json.loads(output))
+    return {
+        'calls': results[0]['calls'],
+        'importTime': statistics.median(x['importTime'] for x in results) * 1000,
+        'configTime': statistics.median(x['configTime'] for x in results) * 1000
+    }
+
+
+def main():
+    print(
+        f'{"function":>24} {"mode":>7} {"dictConfig":>10} {"config [ms]":>12} {"import [ms]":>12}'
+    )
+    for function_name in FUNCTIONS:
+        for mode in ['legacy', 'current']:
+            result = measure(function_name, mode)
+            print(
+                f'{function_name:>24} {mode:>7} {result["calls"]:>10} '
+                f'{result["configTime"]:>12.2f} {result["importTime"]:>12.2f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
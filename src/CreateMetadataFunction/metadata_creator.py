@@ -2,7 +2,7 @@ import json
 import os
 import re
 from datetime import datetime, timezone
-from typing import Tuple
+from typing import Any, Dict, List, Optional, Tuple
 from uuid import uuid4
 
 import boto3
@@ -10,9 +10,15 @@ from boto3.resources.base import ServiceResource
 from botocore.client import BaseClient
 
 from logger.get_logger import get_logger
+from logger.metrics import StageMetrics
 
 logger = get_logger(__name__)
 
+# 一括作成で1回のリクエストに指定できるファイル数の上限
+MAX_BATCH_SIZE = 500
+# アップロードされた画像に付けるtrace idのObjectのmetadataのKey(HTTPのHeaderはx-amz-meta-trace-id)
+TRACE_ID_METADATA_KEY = 'trace-id'
+
 
 class ValidationError(Exception):
     """ValidationでErrorが起きたことを示す自作Errorクラス"""
@@ -29,14 +35,21 @@ def main(event: dict,
     :param s3_client: S3のClient
     :return: API Gatewayの統合Proxy用のHTTP Status CodeとBody
     """
+    metrics = StageMetrics()
     try:
+        if is_batch_request(event):
+            return create_metadata_batch(event, dynamodb_resouce, s3_client, metrics)
         validate_content_json(event)
         body = get_json_request_body(event)
         filename = get_and_validate_file_name(body)
         id = str(uuid4())
-        metadata_item = create_metadata_item(id, filename)
-        put_metadata_item(metadata_item, dynamodb_resouce)
-        signed_url_info = create_pre_signed_url_for_put(id, filename, s3_client)
+        trace_id = str(uuid4())
+        metrics.set_property('traceId', trace_id)
+        metadata_item = create_metadata_item(id, filename, trace_id)
+        metrics.measure('put_db', put_metadata_item, metadata_item, dynamodb_resouce)
+        signed_url_info = metrics.measure(
+            'pre_sign', create_pre_signed_url_for_put, id, filename, s3_client, trace_id
+        )
         result = {
             'metadata': metadata_item,
             'preSignedUrl': signed_url_info
@@ -44,6 +57,67 @@ def main(event: dict,
         return (200, json.dumps(result))
     except ValidationError as e:
         return (400, json.dumps({'message': str(e)}))
+    finally:
+        metrics.emit(logger)
+
+
+def is_batch_request(event: dict) -> bool:
+    """
+    一括作成(POST /metadata/batch)のリクエストかどうか
+    """
+    return event.get('resource') == '/metadata/batch'
+
+
+def create_metadata_batch(
+        event: dict,
+        dynamodb_resouce: ServiceResource,
+        s3_client: BaseClient,
+        metrics: Optional[StageMetrics] = None) -> Tuple[int, str]:
+    """
+    metadataを一括作成する場合のレスポンスを作成する。
+    filenameのValidationはファイルごとに行い、不正なものはerrorsで返して、正しいものだけを作成する。
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    try:
+        validate_content_json(event)
+        body = get_json_request_body(event)
+        filenames = get_and_validate_file_names(body)
+        metadata_items = []
+        errors = []
+        for index, filename in enumerate(filenames):
+            try:
+                name = get_and_validate_file_name({'filename': filename})
+                metadata_items.append(create_metadata_item(str(uuid4()), name, str(uuid4())))
+            except ValidationError as e:
+                errors.append({'index': index, 'filename': filename, 'message': str(e)})
+        metrics.measure('put_db', put_metadata_items, metadata_items, dynamodb_resouce)
+        with metrics.stage('pre_sign'):
+            pre_signed_urls = [
+                create_pre_signed_url_for_put(x['id'], x['filename'], s3_client, x['traceId']) for x in metadata_items
+            ]
+        result = {
+            'metadata': metadata_items,
+            'preSignedUrls': pre_signed_urls,
+            'errors': errors
+        }
+        return (200, json.dumps(result))
+    except ValidationError as e:
+        return (400, json.dumps({'message': str(e)}))
+
+
+def get_and_validate_file_names(body: dict) -> list:
+    """
+    RequestBodyからfilenamesを取得しつつValidationを行う。個々のfilenameのValidationはここでは行わない
+    :param body: Parsed Request Body
+    :return: filenames
+    """
+    names = body.get('filenames') if isinstance(body, dict) else None
+    if not isinstance(names, list):
+        raise ValidationError('filenames is not list.')
+    if not 0 < len(names) <= MAX_BATCH_SIZE:
+        raise ValidationError(f'filenames must have 1 to {MAX_BATCH_SIZE} items.')
+    return names
 
 
 def validate_content_json(event: dict) -> None:
@@ -87,18 +161,23 @@ def get_and_validate_file_name(body: dict) -> str:
     return name
 
 
-def create_metadata_item(id: str, filename: str) -> dict:
+def create_metadata_item(id: str, filename: str, trace_id: str) -> dict:
     """
-    DynamoDBに保存するmetadataを生成する
+    DynamoDBに保存するmetadataを生成する。
+    アップロードからサムネイルの作成までの遅延を測るために、trace idとアップロード用URLの発行時刻も記録する
     :param id: metadataのID
     :param filename: ファイル名
+    :param trace_id: アップロード用URLで画像に付けるtrace id
     :return: metadata
     """
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
     return {
         'id': id,
-        'createdAt': int(datetime.now(timezone.utc).timestamp() * 1000),
+        'createdAt': now,
         'filename': filename,
-        'isUploaded': False
+        'isUploaded': False,
+        'traceId': trace_id,
+        'uploadUrlIssuedAt': now
     }
 
 
@@ -125,19 +204,42 @@ def put_metadata_item(metadata, dynamodb_resouece):
     table.put_item(Item=metadata)
 
 
-def create_pre_signed_url_for_put(id: str, filename: str, s3_client: BaseClient) -> dict:
+def put_metadata_items(metadata_items: List[dict], dynamodb_resouece: ServiceResource) -> None:
+    """
+    metadataをDynamoDBにまとめて保存する。
+    batch_writerが25件ずつのBatchWriteItemに分割し、UnprocessedItemsは再送する
+    """
+    if len(metadata_items) == 0:
+        return
+    table = dynamodb_resouece.Table(get_table_name())
+    with table.batch_writer() as batch:
+        for metadata in metadata_items:
+            batch.put_item(Item=metadata)
+
+
+def create_pre_signed_url_for_put(
+        id: str,
+        filename: str,
+        s3_client: BaseClient,
+        trace_id: Optional[str] = None) -> dict:
     """
-    アップロード用のPreSignedUrlを生成する
+    アップロード用のPreSignedUrlを生成する。
+    trace_idが指定された場合は、ObjectのmetadataとしてHeaderごと署名するので、headersのHeaderを付けないとアップロードできない
     """
     bucket = get_bucket_name()
     expire = 3600
     method = 'PUT'
+    params: Dict[str, Any] = {
+        'Bucket': bucket,
+        'Key': f'images/{id}/{filename}'
+    }
+    headers = {}
+    if trace_id is not None:
+        params['Metadata'] = {TRACE_ID_METADATA_KEY: trace_id}
+        headers[f'x-amz-meta-{TRACE_ID_METADATA_KEY}'] = trace_id
     url = s3_client.generate_presigned_url(
         ClientMethod='put_object',
-        Params={
-            'Bucket': bucket,
-            'Key': f'images/{id}/{filename}'
-        },
+        Params=params,
         ExpiresIn=expire,
         HttpMethod=method
     )
@@ -145,5 +247,6 @@ def create_pre_signed_url_for_put(id: str, filename: str, s3_client: BaseClient)
         'id': id,
         'url': url,
         'method': method,
-        'expiresIn': expire
+        'expiresIn': expire,
+        'headers': headers
     }
@@ -0,0 +1,153 @@
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from boto3.resources.base import ServiceResource
+from botocore.client import BaseClient
+
+from logger.get_logger import get_logger
+from logger.metrics import StageMetrics
+from pipeline.idempotency import (create_processed_condition, get_processed_object, get_processed_object_attribute,
+                                  get_table_name, run_unless_processed, update_unless_superseded)
+from pipeline.latency import PROCESSED_AT_ATTRIBUTES, get_event_time, record_pipeline_latencies
+from pipeline.records import get_bucket, get_id, get_key, get_size, process_all_records
+from thumbnail_creator import (decode_with_content_hash_item, get_image_with_hash, get_thumbnail_variant,
+                               put_thumbnails, run_concurrently, save_content_hash_item)
+
+logger = get_logger(__name__)
+
+# PutS3EventFunctionとCreateThumbnailFunctionの両方の処理を行うので、両方の段階を処理済みとして記録する
+COMBINED_STAGES = ['analyzer', 'thumbnail']
+# 両方の処理を行うので、両方の段階の遅延を記録する
+COMBINED_LATENCY_STAGES = ['analyze', 'thumbnail']
+
+
+def main(
+        event: dict,
+        s3_client: BaseClient = boto3.client('s3'),
+        dynamodb_resouce: ServiceResource = boto3.resource('dynamodb')) -> List[dict]:
+    """
+    PutS3EventFunctionとCreateThumbnailFunctionの処理をまとめて行う(PROCESSING_MODE=combined)。
+    Eventに含まれる全てのRecordを並列に処理し、Recordごとの結果を返す。
+    :param event: Lambdaで受け取ったevent
+    :param s3_client: S3のClient
+    :param dynamodb_resouce: DynamoDBのServiceResource。
+    """
+    return process_all_records(event, process_record, s3_client, dynamodb_resouce)
+
+
+def process_record(record: dict, s3_client: BaseClient, dynamodb_resouce: ServiceResource) -> None:
+    """
+    1つのRecordを処理する。
+    画像のダウンロードとデコードを1回だけ行い、解像度の取得とサムネイルの生成に使う。
+    同じ内容の画像を処理済みの場合は、記録されている解像度とサムネイルを再利用する。
+    metadataの更新(size, width, height, isUploaded, hasThumbnail, thumbnailKeys)も1回のupdate_itemで行う。
+    metadataはサムネイルのアップロードが成功してから更新する。
+    処理済みかどうかの確認と画像のダウンロード、ハッシュ値との対応の取得とデコード、
+    metadataの更新とハッシュ値との対応の記録はそれぞれ並列に行い、処理の段階ごとにかかった時間とbyte数をログに出力する。
+    全ての段階で同じObjectかより新しいObjectを処理済みの場合は何もしない。
+    """
+    bucket = get_bucket(record)
+    key = get_key(record)
+    size = get_size(record)
+    id = get_id(key)
+    filename = os.path.basename(key)
+    name, ext = os.path.splitext(filename)
+    metrics = StageMetrics()
+
+    processed_object = get_processed_object(record)
+    already_processed, downloaded = run_unless_processed(
+        id, COMBINED_STAGES, processed_object, dynamodb_resouce,
+        lambda: metrics.measure('download', get_image_with_hash, bucket, key, s3_client, metrics)
+    )
+    if already_processed:
+        logger.info(f'skipped already processed record. key: {key}', extra={'processedObject': processed_object})
+        return
+    image, content_hash = downloaded
+    metrics.set_dimension('ImageFormat', image.format)
+    # 縮小してデコードするとimage.sizeが変わるので、先に元の解像度を取得しておく
+    width, height = image.size
+    decoded, content_hash_item = decode_with_content_hash_item(image, content_hash, dynamodb_resouce, metrics)
+    # 同じ内容の画像を処理済みの場合は、記録されている解像度を使う
+    if content_hash_item is not None:
+        width, height = int(content_hash_item['width']), int(content_hash_item['height'])
+
+    thumbnail_keys, is_new = put_thumbnails(
+        id, name, bucket, decoded, content_hash, content_hash_item, s3_client, metrics
+    )
+    update_option = create_update_option(
+        id, size, width, height, thumbnail_keys, processed_object, get_event_time(record)
+    )
+    tasks = [
+        lambda: metrics.measure(
+            'update_db', update_unless_superseded, update_metadata, update_option, dynamodb_resouce, processed_object
+        )
+    ]
+    if is_new:
+        tasks.append(lambda: save_content_hash_item(
+            content_hash, get_thumbnail_variant(), thumbnail_keys, width, height, dynamodb_resouce
+        ))
+    with metrics.stage('io'):
+        resp = run_concurrently(*tasks)[0]
+    record_pipeline_latencies(metrics, resp, COMBINED_LATENCY_STAGES)
+    logger.info(f'processed record. key: {key}', extra=metrics.create_log_extra())
+
+
+def create_update_option(
+        id: str,
+        size: int,
+        width: int,
+        height: int,
+        thumbnail_keys: Dict[str, str],
+        processed_object: Optional[dict] = None,
+        uploaded_at: Optional[int] = None) -> dict:
+    """
+    metadataを更新するためのDynamoDBのOptionを生成する。
+    画像の情報とサムネイルを持っていることを、まとめて書き込む。
+    processed_objectが指定された場合は、両方の段階の処理済みのObjectとして記録する。
+    サムネイルのアップロードが終わってから呼び、両方の処理が終わった時刻(呼んだ時刻)と、uploaded_atが指定された場合はアップロードの時刻(S3のEventの発生時刻)も記録する。
+    """
+    condition = Key('id').eq(id)
+    if processed_object is not None:
+        condition = condition & create_processed_condition(COMBINED_STAGES, processed_object)
+    option = {
+        'Key': {
+            'id': id
+        },
+        'ConditionExpression': condition,
+        'ReturnValues': 'ALL_NEW'
+    }
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    update_attributes: Dict[str, Any] = {
+        'size': size,
+        'width': width,
+        'height': height,
+        'updatedAt': now,
+        'isUploaded': True,
+        'hasThumbnail': True,
+        'thumbnailKeys': thumbnail_keys
+    }
+    for attribute in PROCESSED_AT_ATTRIBUTES.values():
+        update_attributes[attribute] = now
+    if uploaded_at is not None:
+        update_attributes['uploadedAt'] = uploaded_at
+    if processed_object is not None:
+        for stage in COMBINED_STAGES:
+            update_attributes[get_processed_object_attribute(stage)] = processed_object
+    update_expression_array = [f'#{x} = :{x}' for x in update_attributes.keys()]
+    option['UpdateExpression'] = f'SET {", ".join(update_expression_array)}'
+    option['ExpressionAttributeNames'] = {f'#{x}': x for x in update_attributes.keys()}
+    option['ExpressionAttributeValues'] = {f':{k}': v for k, v in update_attributes.items()}
+
+    return option
+
+
+def update_metadata(option: dict, dynamodb_resource: ServiceResource) -> dict:
+    """
+    metadataを更新する。
+    Recordごとのスレッドから呼ばれるので、スレッドセーフなClientを使う(ServiceResourceはスレッドセーフではない)。
+    ServiceResourceから取得したClientは、型の変換(DynamoDB JSON <-> Pythonの値)とConditionの変換も行ってくれる
+    """
+    return dynamodb_resource.meta.client.update_item(TableName=get_table_name(), **option)
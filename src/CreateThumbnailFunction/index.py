@@ -1,20 +1,67 @@
-from typing import Any
+import os
+from typing import Any, Callable, List, Optional
 
-from logger.get_logger import get_logger
+from image_processor import main as process_image
+from logger.event_logger import log_error_with_event, log_event
+from logger.get_logger import flush_logs, get_logger
+from pipeline.records import RecordProcessingError
 from thumbnail_creator import main
 
 logger = get_logger(__name__)
 
 
-def handler(event: dict, context: Any) -> None:
+def handler(event: dict, context: Any) -> Optional[dict]:
     """
     Lambdaで実行される関数
     :param event: 渡されたEvent。ここから色々な情報を取得する
     :param context: Lambdaの実行に関する情報が入ったインスタンス。今回の処理では使用しない
     """
     try:
-        logger.info('event', event)
-        main(event)
+        log_event(logger, event)
+        process = process_image if is_combined_mode() else main
+        if is_sqs_event(event):
+            return process_sqs_event(event, process)
+        process(event)
+        return None
     except Exception as e:
-        logger.error(f'Exception occurred: {e}', exc_info=True)
+        log_error_with_event(logger, f'Exception occurred: {e}', event)
         raise
+    finally:
+        # Lambdaはhandlerから戻ると停止するので、Queueに残っているLogはここで出力しておく
+        flush_logs()
+
+
+def is_combined_mode() -> bool:
+    """
+    解像度の取得とサムネイルの生成をまとめて行うモードかどうか。
+    combinedの場合、PutS3EventFunctionはデプロイされない。
+    """
+    return os.environ.get('PROCESSING_MODE') == 'combined'
+
+
+def is_sqs_event(event: dict) -> bool:
+    """
+    SQSから呼ばれたかどうか
+    """
+    records = event.get('Records', [])
+    return len(records) > 0 and records[0].get('eventSource') == 'aws:sqs'
+
+
+def process_sqs_event(event: dict, process: Callable[[dict], List[dict]]) -> dict:
+    """
+    SQSから呼ばれた場合の処理。
+    失敗したMessageだけが再度配信されるように、batchItemFailuresでmessageIdを返す
+    """
+    try:
+        process(event)
+        return {'batchItemFailures': []}
+    except RecordProcessingError as e:
+        return create_batch_item_failures(e.results)
+
+
+def create_batch_item_failures(results: list) -> dict:
+    """
+    Recordごとの処理結果から、失敗したMessageのmessageIdを重複なく取り出す
+    """
+    failed_message_ids = dict.fromkeys(x['messageId'] for x in results if not x['succeeded'])
+    return {'batchItemFailures': [{'itemIdentifier': x} for x in failed_message_ids]}
@@ -0,0 +1,149 @@
+import operator
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from typing import Any, Callable, List, Optional, Tuple
+
+from boto3.dynamodb.conditions import Attr, ConditionBase
+from boto3.resources.base import ServiceResource
+
+from logger.get_logger import get_logger
+
+logger = get_logger(__name__)
+
+# 処理済みのS3のObject(keyとsequencerまたはeTag)を記録するmetadataの属性名。{}には処理の段階が入る
+PROCESSED_OBJECT_ATTRIBUTE = '{}ProcessedObject'
+# S3のEventのsequencerを比較するときに揃える長さ(16進数の桁数)
+SEQUENCER_LENGTH = 32
+
+
+def get_table_name():
+    """
+    環境変数からDynamoDBのTable名を取得する
+    """
+    return os.environ['DATA_TABLE_NAME']
+
+
+def get_processed_object(record: dict) -> Optional[dict]:
+    """
+    RecordのS3のObjectを識別する情報(keyとsequencer、sequencerがなければeTag)を取得する。
+    sequencerは同じKeyのEventの順序を表すので、桁数を揃えて文字列のまま大小を比較できるようにする。
+    どちらもない場合はnullを返す(処理済みかどうかを判断しない)
+    """
+    s3_object = record['s3']['object']
+    sequencer = s3_object.get('sequencer')
+    if sequencer is not None:
+        return {'key': s3_object['key'], 'sequencer': sequencer.upper().rjust(SEQUENCER_LENGTH, '0')}
+    e_tag = s3_object.get('eTag')
+    if e_tag is not None:
+        return {'key': s3_object['key'], 'eTag': e_tag}
+    return None
+
+
+def get_processed_object_attribute(stage: str) -> str:
+    """
+    処理の段階ごとに、処理済みのObjectを記録するmetadataの属性名を返す
+    """
+    return PROCESSED_OBJECT_ATTRIBUTE.format(stage)
+
+
+def is_processed(processed: Optional[dict], current: dict) -> bool:
+    """
+    記録されている処理済みのObject(processed)が、currentと同じかそれより新しいかどうか。
+    sequencerがある場合は大小を比較するので、古いEventが後から届いた場合も処理済みとみなす。
+    """
+    if processed is None or processed.get('key') != current['key']:
+        return False
+    if 'sequencer' in current:
+        return processed.get('sequencer') is not None and processed['sequencer'] >= current['sequencer']
+    return processed.get('eTag') == current['eTag']
+
+
+def is_already_processed(
+        id: str,
+        stages: List[str],
+        processed_object: Optional[dict],
+        dynamodb_resource: ServiceResource) -> bool:
+    """
+    全ての段階で、RecordのObjectを処理済みかどうか。
+    S3からSNSへの配信は少なくとも1回(重複がありうる)なので、縮小やmetadataの更新の前に確認する。
+    処理済みの記録は処理の結果と一緒に書き込むので、途中で失敗したObjectは処理済みとみなさない。
+    metadataが存在しない場合はエラーにする。
+    Recordごとのスレッドから呼ばれるので、スレッドセーフなClientを使う(ServiceResourceはスレッドセーフではない)。
+    """
+    if processed_object is None:
+        return False
+    attributes = [get_processed_object_attribute(x) for x in stages]
+    resp = dynamodb_resource.meta.client.get_item(
+        TableName=get_table_name(),
+        Key={
+            'id': id
+        },
+        ConsistentRead=True,
+        ProjectionExpression=', '.join(['#id'] + [f'#{x}' for x in attributes]),
+        ExpressionAttributeNames={f'#{x}': x for x in ['id'] + attributes}
+    )
+    item = resp.get('Item')
+    if item is None:
+        raise ValueError(f'metadata is not found. id: {id}')
+    return all(is_processed(item.get(x), processed_object) for x in attributes)
+
+
+def run_unless_processed(
+        id: str,
+        stages: List[str],
+        processed_object: Optional[dict],
+        dynamodb_resource: ServiceResource,
+        task: Callable[[], Any]) -> Tuple[bool, Any]:
+    """
+    処理済みかどうかの確認と、画像の取得などのtaskを並列に実行する。
+    重複したEventは少ないので、確認を待たずにtaskを始め、GetItemの待ち時間をS3からの取得と重ねる。
+    処理済みの場合は(true, null)を返し、taskの結果や例外は使わない。そうでなければ(false, taskの結果)を返す。
+    スレッドは途中で止められないので、処理済みの場合や確認に失敗した場合も、taskが終わるのを待ってから返す。
+    """
+    if processed_object is None:
+        return False, task()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(task)
+        already_processed = is_already_processed(id, stages, processed_object, dynamodb_resource)
+    if already_processed:
+        return True, None
+    return False, future.result()
+
+
+def create_processed_condition(stages: List[str], processed_object: dict) -> ConditionBase:
+    """
+    いずれかの段階で、RecordのObjectが記録されているものより新しいことを確かめるConditionを生成する。
+    metadataの更新に付けることで、並行して処理された新しいObjectの結果を古いもので上書きしないようにする。
+    """
+    conditions = []
+    for stage in stages:
+        attribute = get_processed_object_attribute(stage)
+        key_changed = Attr(f'{attribute}.key').ne(processed_object['key'])
+        if 'sequencer' in processed_object:
+            field = 'sequencer'
+            is_newer = Attr(f'{attribute}.{field}').lt(processed_object[field])
+        else:
+            field = 'eTag'
+            is_newer = Attr(f'{attribute}.{field}').ne(processed_object[field])
+        conditions.append(Attr(f'{attribute}.{field}').not_exists() | key_changed | is_newer)
+    return reduce(operator.or_, conditions)
+
+
+def update_unless_superseded(
+        update: Callable[[dict, ServiceResource], dict],
+        option: dict,
+        dynamodb_resource: ServiceResource,
+        processed_object: Optional[dict]) -> Optional[dict]:
+    """
+    updateでmetadataを更新する。
+    処理済みのObjectの条件を満たさず更新しなかった場合(より新しいObjectを処理済み)は、エラーにせずnullを返す。
+    metadataの存在はis_already_processedで確かめているので、ConditionalCheckFailedはこの場合だけとみなす。
+    """
+    try:
+        return update(option, dynamodb_resource)
+    except dynamodb_resource.meta.client.exceptions.ConditionalCheckFailedException as e:
+        if processed_object is None:
+            raise
+        logger.info(f'skipped update superseded by newer object: {e}', extra={'processedObject': processed_object})
+        return None
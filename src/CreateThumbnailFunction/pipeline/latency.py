@@ -0,0 +1,55 @@
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from logger.metrics import StageMetrics
+
+# アップロード用URLで画像に付けられたtrace idのObjectのmetadataのKey
+TRACE_ID_METADATA_KEY = 'trace-id'
+# 画像の処理(解析とサムネイルの作成)が終わった時刻を記録するmetadataの属性。2つの処理は並列に行われる
+PROCESSED_AT_ATTRIBUTES = {'analyze': 'analyzedAt', 'thumbnail': 'thumbnailCreatedAt'}
+
+
+def get_event_time(record: dict) -> Optional[int]:
+    """
+    S3のEventの発生時刻(アップロードが完了した時刻)をミリ秒で取得する。なければnullを返す
+    """
+    event_time = record.get('eventTime')
+    if event_time is None:
+        return None
+    return int(datetime.fromisoformat(event_time.replace('Z', '+00:00')).timestamp() * 1000)
+
+
+def get_pipeline_latencies(item: dict, trace_id: Optional[str], stages: List[str]) -> Dict[str, int]:
+    """
+    metadataに記録された時刻から、stagesの処理の遅延(アップロードから処理が終わるまで)をミリ秒で求める。
+    解析とサムネイルの作成の両方が今回のアップロードの処理を終えている場合(後に終わった方の更新でだけ起きる)は、
+    アップロード用URLの発行からアップロードまで(upload)と、全体(end_to_end)の遅延も求める。
+    URLの発行時刻は、Objectのtrace idがmetadataと一致する場合だけ使う(別のURLでアップロードされた可能性があるため)。
+    """
+    if item.get('uploadedAt') is None:
+        return {}
+    uploaded_at = int(item['uploadedAt'])
+    # アップロードより前の時刻は、以前にアップロードされた画像の処理のもの
+    processed_at = {
+        x: int(item[y]) for x, y in PROCESSED_AT_ATTRIBUTES.items()
+        if item.get(y) is not None and int(item[y]) >= uploaded_at
+    }
+    latencies = {x: processed_at[x] - uploaded_at for x in stages if x in processed_at}
+    issued_at = item.get('uploadUrlIssuedAt')
+    if issued_at is None or trace_id is None or trace_id != item.get('traceId'):
+        return latencies
+    if len(processed_at) == len(PROCESSED_AT_ATTRIBUTES):
+        latencies['upload'] = uploaded_at - int(issued_at)
+        latencies['end_to_end'] = max(processed_at.values()) - int(issued_at)
+    return latencies
+
+
+def record_pipeline_latencies(metrics: StageMetrics, resp: Optional[dict], stages: List[str]) -> None:
+    """
+    metadataの更新結果から、アップロードからの遅延を求めてmetricsに記録する。更新しなかった場合は何もしない
+    """
+    if resp is None:
+        return
+    latencies = get_pipeline_latencies(resp['Attributes'], metrics.properties.get('traceId'), stages)
+    for stage, latency in latencies.items():
+        metrics.add_latency(stage, latency)
@@ -1,7 +1,11 @@
+import hashlib
 import json
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from io import BytesIO
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import boto3
 from boto3.dynamodb.conditions import Key
@@ -9,144 +13,516 @@ from boto3.resources.base import ServiceResource
 from botocore.client import BaseClient
 from PIL import Image
 
+from logger.get_logger import get_logger
+from logger.metrics import StageMetrics
+from pipeline.idempotency import (create_processed_condition, get_processed_object, get_processed_object_attribute,
+                                  get_table_name, run_unless_processed, update_unless_superseded)
+from pipeline.latency import (PROCESSED_AT_ATTRIBUTES, TRACE_ID_METADATA_KEY, get_event_time,
+                              record_pipeline_latencies)
+from pipeline.records import get_bucket, get_id, get_key, process_all_records
+
+logger = get_logger(__name__)
+
+# サムネイルとして出力できる形式と、その拡張子、ContentType
+THUMBNAIL_FORMATS = {
+    'PNG': ('png', 'image/png'),
+    'JPEG': ('jpg', 'image/jpeg'),
+    'WEBP': ('webp', 'image/webp')
+}
+# 透過を扱えない形式。アルファチャンネルやパレットを持つ画像はRGBに変換してから保存する
+RGB_ONLY_FORMATS = ['JPEG']
+RGB_COMPATIBLE_MODES = ['RGB', 'L']
+# このFunctionで行う処理の段階
+THUMBNAIL_STAGES = ['thumbnail']
+# 画像をダウンロードしながらハッシュ値を計算するときに、1回に読み込むバイト数
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# 画像の内容(ハッシュ値)ごとにサムネイルを置くprefix。内容と設定からKeyが決まるので、別の内容で上書きされることはない
+CONTENT_HASH_THUMBNAIL_PREFIX = 'thumbnails/by-hash/'
+# このFunctionで遅延を記録する段階
+THUMBNAIL_LATENCY_STAGES = ['thumbnail']
+
 
 def main(
         event: dict,
         s3_client: BaseClient = boto3.client('s3'),
-        dynamodb_resouce: ServiceResource = boto3.resource('dynamodb')) -> None:
+        dynamodb_resouce: ServiceResource = boto3.resource('dynamodb')) -> List[dict]:
     """
     Lambdaから呼ぶ処理
+    Eventに含まれる全てのRecordを並列に処理し、Recordごとの結果を返す。
     :param event: Lambdaで受け取ったevent
     :param s3_client: S3のClient
     :param dynamodb_resouce: DynamoDBのServiceResource。
     """
-    body = get_sns_message_json(event)
+    return process_all_records(event, process_record, s3_client, dynamodb_resouce)
+
 
-    bucket = get_bucket(body)
-    key = get_key(body)
+def process_record(record: dict, s3_client: BaseClient, dynamodb_resouce: ServiceResource) -> None:
+    """
+    1つのRecordの画像からサムネイルを生成してアップロードし、metadataを更新する。
+    metadataはサムネイルがあることを示すので、アップロードが成功してから更新する。
+    処理済みかどうかの確認と画像のダウンロード、ハッシュ値との対応の取得とデコード、
+    metadataの更新とハッシュ値との対応の記録は、それぞれ互いに依存しないので並列に行う。
+    同じ内容の画像のサムネイルが既にある場合は、生成もS3への書き込みもせずに、そのKeyをmetadataに記録する。
+    同じObjectを処理済みの場合(Eventの重複)や、より新しいObjectを処理済みの場合は何もしない。
+    処理の段階ごとにかかった時間とbyte数をログ(有効な場合はメトリクス)に出力する。
+    アップロードの時刻とサムネイルの作成が終わった時刻を記録し、アップロード用URLの発行からの遅延をメトリクスにする。
+    """
+    bucket = get_bucket(record)
+    key = get_key(record)
     id = get_id(key)
     filename = os.path.basename(key)
     name, ext = os.path.splitext(filename)
+    metrics = StageMetrics()
 
-    update_db_option = create_update_db_option(id)
+    processed_object = get_processed_object(record)
+    already_processed, downloaded = run_unless_processed(
+        id, THUMBNAIL_STAGES, processed_object, dynamodb_resouce,
+        lambda: metrics.measure('download', get_image_with_hash, bucket, key, s3_client, metrics)
+    )
+    if already_processed:
+        logger.info(f'skipped already processed record. key: {key}', extra={'processedObject': processed_object})
+        return
+    image, content_hash = downloaded
+    metrics.set_dimension('ImageFormat', image.format)
+    # 縮小してデコードするとimage.sizeが変わるので、先に元の解像度を取得しておく
+    width, height = image.size
+    decoded, content_hash_item = decode_with_content_hash_item(image, content_hash, dynamodb_resouce, metrics)
 
-    image = get_image(bucket, key, s3_client)
-    thumbnail = create_thumbnail(image)
-    upload_thumbnail(id, name, bucket, thumbnail, s3_client)
+    thumbnail_keys, is_new = put_thumbnails(
+        id, name, bucket, decoded, content_hash, content_hash_item, s3_client, metrics
+    )
+    update_db_option = create_update_db_option(id, thumbnail_keys, processed_object, get_event_time(record))
+    tasks = [
+        lambda: metrics.measure(
+            'update_db', update_unless_superseded, update_db, update_db_option, dynamodb_resouce, processed_object
+        )
+    ]
+    if is_new:
+        tasks.append(lambda: save_content_hash_item(
+            content_hash, get_thumbnail_variant(), thumbnail_keys, width, height, dynamodb_resouce
+        ))
+    with metrics.stage('io'):
+        resp = run_concurrently(*tasks)[0]
+    record_pipeline_latencies(metrics, resp, THUMBNAIL_LATENCY_STAGES)
+    logger.info(f'processed record. key: {key}', extra=metrics.create_log_extra())
+
+
+def decode_with_content_hash_item(
+        image: Image,
+        content_hash: str,
+        dynamodb_resource: ServiceResource,
+        metrics: StageMetrics) -> Tuple[Image, Optional[dict]]:
+    """
+    サムネイルに必要な大きさでのデコードと、ハッシュ値が同じ画像の処理結果の取得を並列に行う。
+    処理結果を再利用できる場合はデコードが無駄になるが、同じ内容の画像は少ないので、GetItemの待ち時間を隠す方を優先する。
+    ハッシュ値との対応を記録しない場合は、デコードだけを行う。
+    """
+    tasks = [lambda: metrics.measure('decode', decode_image, image, get_thumbnail_sizes()[0])]
+    if get_content_hash_table_name() is not None:
+        tasks.append(lambda: fetch_content_hash_item(content_hash, dynamodb_resource))
+    results = run_concurrently(*tasks)
+    return results[0], results[1] if len(results) > 1 else None
+
+
+def put_thumbnails(
+        id: str,
+        name: str,
+        bucket: str,
+        decoded: Image,
+        content_hash: str,
+        content_hash_item: Optional[dict],
+        s3_client: BaseClient,
+        metrics: StageMetrics) -> Tuple[Dict[str, str], bool]:
+    """
+    サムネイルを用意し、metadataに記録するKey(大きさ→Key)と、ハッシュ値との対応を新しく記録するかどうかを返す。
+    decodedはdecode_imageでデコード済みの画像。
+    同じ内容の画像から同じ設定で生成したサムネイルがある場合は、そのKeyをそのまま返す。縮小やS3への書き込みは行わない。
+    ハッシュ値との対応を記録する場合は、内容ごとのKey(内容と設定から決まり、上書きされないKey)にアップロードする。
+    記録しない場合は、idごとのKeyにアップロードする。
+    """
+    if content_hash_item is not None and is_reusable(content_hash_item, get_thumbnail_variant()):
+        return dict(content_hash_item['thumbnailKeys']), False
+    thumbnails = metrics.measure('resize', create_thumbnails, decoded)
+    sizes = list(thumbnails.keys())
+    is_indexed = get_content_hash_table_name() is not None
+    if is_indexed:
+        keys = create_content_hash_thumbnail_keys(content_hash, sizes)
+    else:
+        keys = create_thumbnail_keys(id, name, sizes)
+    thumbnail_keys = metrics.measure(
+        'upload', upload_thumbnails, id, name, bucket, thumbnails, s3_client, keys, metrics
+    )
+    return thumbnail_keys, is_indexed
 
-    update_db(update_db_option, dynamodb_resouce)
 
+def run_concurrently(*tasks: Callable[[], Any]) -> List[Any]:
+    """
+    互いに依存しない処理(S3やDynamoDBへのリクエストなど)をスレッドで並列に実行し、それぞれの戻り値を返す。
+    全ての処理が終わるのを待ってから、失敗した処理があれば最初の例外を送出する。
+    途中で例外を送出すると、残りの処理が終わる前にRecordの処理が終わったことになってしまうため。
+    処理が1つだけの場合は、スレッドを作らずにそのまま実行する。
+    """
+    if len(tasks) == 1:
+        return [tasks[0]()]
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = [executor.submit(x) for x in tasks]
+    errors = [e for e in (x.exception() for x in futures) if e is not None]
+    for error in errors[1:]:
+        logger.error(f'Exception occurred: {error}', exc_info=error)
+    if len(errors) > 0:
+        raise errors[0]
+    return [x.result() for x in futures]
+
+
+def get_image_with_hash(
+        bucket: str,
+        key: str,
+        s3_client: BaseClient,
+        metrics: Optional[StageMetrics] = None) -> Tuple[Image, str]:
+    """
+    S3から画像を取得し、画像の内容のハッシュ値(SHA-256)も返す。
+    ハッシュ値は、ダウンロードしながら少しずつ計算するので、もう一度全体を読み直すことはない。
+    metricsが指定された場合は、ダウンロードしたbyte数とObjectのmetadataのtrace idを記録する。
+    """
+    resp = s3_client.get_object(
+        Bucket=bucket,
+        Key=key
+    )
+    if metrics is not None:
+        metrics.set_property('traceId', resp.get('Metadata', {}).get(TRACE_ID_METADATA_KEY))
+    content_hash = hashlib.sha256()
+    io = BytesIO()
+    for chunk in resp['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+        content_hash.update(chunk)
+        io.write(chunk)
+    if metrics is not None:
+        metrics.add_bytes('download', io.tell())
+    io.seek(0)
+    image = Image.open(io)
+    return image, content_hash.hexdigest()
 
-def get_sns_message_json(event: dict) -> dict:
+
+def get_content_hash_table_name() -> Optional[str]:
     """
-    EventからSNSのMessageを取得し、JSONをパースする
+    環境変数から、画像のハッシュ値と処理結果の対応を記録するDynamoDBのTable名を取得する。
+    未設定の場合はnullを返す(同じ内容の画像でも処理結果を再利用しない)
     """
-    return json.loads(event['Records'][0]['Sns']['Message'])
+    return os.environ.get('CONTENT_HASH_TABLE_NAME')
 
 
-def get_bucket(event: dict) -> str:
+def fetch_content_hash_item(content_hash: str, dynamodb_resource: ServiceResource) -> Optional[dict]:
     """
-    S3 Bucket名を取得する
+    ハッシュ値が同じ画像の処理結果(解像度、サムネイルのKey)を取得する。なければnullを返す。
+    Recordごとのスレッドから呼ばれるので、スレッドセーフなClientを使う
     """
-    return event['Records'][0]['s3']['bucket']['name']
+    table_name = get_content_hash_table_name()
+    if table_name is None:
+        return None
+    resp = dynamodb_resource.meta.client.get_item(
+        TableName=table_name,
+        Key={
+            'contentHash': content_hash
+        }
+    )
+    return resp.get('Item')
 
 
-def get_key(event: dict) -> str:
+def save_content_hash_item(
+        content_hash: str,
+        variant: str,
+        keys: Dict[str, str],
+        width: int,
+        height: int,
+        dynamodb_resource: ServiceResource) -> None:
     """
-    S3のKeyを取得する
+    ハッシュ値と処理結果の対応を記録する。同じハッシュ値の記録があれば、新しい結果で上書きする。
+    Recordごとのスレッドから呼ばれるので、スレッドセーフなClientを使う
     """
-    return event['Records'][0]['s3']['object']['key']
+    table_name = get_content_hash_table_name()
+    if table_name is None:
+        return
+    dynamodb_resource.meta.client.put_item(
+        TableName=table_name,
+        Item={
+            'contentHash': content_hash,
+            'width': width,
+            'height': height,
+            'thumbnailVariant': variant,
+            'thumbnailKeys': keys,
+            'updatedAt': int(datetime.now(timezone.utc).timestamp() * 1000)
+        }
+    )
 
 
-def get_id(key: str) -> str:
+def get_thumbnail_variant() -> str:
     """
-    Keyからid(uuid)を取得する
+    サムネイルの生成の設定(大きさと形式、エンコードのOption)を表す文字列を生成する。
+    設定が変わった後は、以前のサムネイルを再利用しないようにするために使う。
     """
-    return key[7:43]
+    return json.dumps({'sizes': get_thumbnail_sizes(), **get_save_option()}, sort_keys=True)
 
 
-def get_image(bucket: str, key: str, s3_client: BaseClient) -> Image:
+def create_content_hash_thumbnail_keys(content_hash: str, sizes: List[int]) -> Dict[int, str]:
     """
-    S3から画像を取得する
+    画像の内容(ハッシュ値)と今の設定から、サムネイルを置くKeyを大きさごとに生成する。
+    設定が違えば別のKeyになるので、同じKeyには常に同じ内容のサムネイルが置かれる
     """
-    resp = s3_client.get_object(
-        Bucket=bucket,
-        Key=key
-    )
-    raw_bytes = resp['Body'].read()
-    image = Image.open(BytesIO(raw_bytes))
-    return image
+    ext, _ = THUMBNAIL_FORMATS[get_thumbnail_format()]
+    variant_hash = hashlib.sha256(get_thumbnail_variant().encode()).hexdigest()[:16]
+    return {size: f'{CONTENT_HASH_THUMBNAIL_PREFIX}{content_hash}/{variant_hash}/{size}.{ext}' for size in sizes}
+
+
+def is_reusable(content_hash_item: Optional[dict], variant: str) -> bool:
+    """
+    記録されているサムネイルを、今の設定のサムネイルとして再利用できるかどうか。
+    内容ごとのKeyを記録しているものだけを再利用する(以前のidごとのKeyは、上書きされている可能性がある)。
+    内容ごとのKeyのサムネイルは削除しないので、S3に存在するかは確かめない
+    """
+    if content_hash_item is None or content_hash_item.get('thumbnailVariant') != variant:
+        return False
+    expected_keys = create_content_hash_thumbnail_keys(content_hash_item['contentHash'], get_thumbnail_sizes())
+    return content_hash_item.get('thumbnailKeys') == {str(x): y for x, y in expected_keys.items()}
 
 
 def get_thumbnail_size() -> int:
     return int(os.environ['THUMBNAIL_SIZE'])
 
 
-def expand_to_square(image: Image) -> Image:
+def get_thumbnail_sizes() -> List[int]:
+    """
+    環境変数から生成するサムネイルの大きさ(px)を大きい順に取得する。
+    THUMBNAIL_SIZES(カンマ区切り)が未設定の場合は、THUMBNAIL_SIZEの1種類だけを生成する。
+    """
+    raw_sizes = os.environ.get('THUMBNAIL_SIZES')
+    if raw_sizes is None:
+        return [get_thumbnail_size()]
+    sizes = sorted({int(x) for x in raw_sizes.split(',') if x.strip() != ''}, reverse=True)
+    if len(sizes) == 0 or sizes[-1] < 1:
+        raise ValueError('THUMBNAIL_SIZES must be a comma separated list of positive integers.')
+    return sizes
+
+
+def get_fitted_range(offset: int, length: int, scale: float) -> Tuple[int, int, float, float]:
+    """
+    元の画像を中央に置いた正方形を縮小したときに、1つの軸で画像が配置される範囲を求める。
+    戻り値は、縮小後のピクセルの範囲(start, end)と、それに対応する元の画像の範囲(box_start, box_end)。
+    ピクセルの位置を丸めると画像全体がずれてしまうので、サンプリングの位置が正方形を縮小した場合と一致するように、元の画像の範囲を小数で指定する。
+    """
+    start = math.ceil(offset / scale)
+    end = max(math.floor((offset + length) / scale), start + 1)
+    # 縮小後に1ピクセルに満たない細い画像の場合でも、元の画像の範囲が空にならないようにする
+    box_start = max(min(start * scale - offset, length - 1), 0)
+    box_end = min(end * scale - offset, length)
+    return start, end, box_start, box_end
+
+
+def resize_to_square(image: Image, size: int) -> Image:
     """
-    余白を追加して正方形にする
+    アスペクト比を保ったままsize x sizeに収まるように縮小し、余白を追加して正方形にする。
+    元の解像度の正方形を作ってから縮小すると、余白の分も含めた大きな画像を確保することになるので、縮小を先に行う。
     """
     width, height = image.size
     background_color = (0, 0, 0)
-    if width == height:
+    longest = max(width, height)
+    scale = longest / size
+    left, right, box_left, box_right = get_fitted_range((longest - width) // 2, width, scale)
+    top, bottom, box_top, box_bottom = get_fitted_range((longest - height) // 2, height, scale)
+    resized = image.resize((right - left, bottom - top), Image.LANCZOS, box=(box_left, box_top, box_right, box_bottom))
+    if resized.size == (size, size):
+        return resized
+    result = Image.new(image.mode, (size, size), background_color)
+    result.paste(resized, (left, top))
+    return result
+
+
+def draft_image(image: Image, size: int) -> Image:
+    """
+    JPEGの場合、DCTのスケーリング(1/2, 1/4, 1/8)を使って、サムネイルに必要な大きさを下回らない最小のサイズでデコードする。
+    元の解像度で全体をデコードしてから縮小するよりも、デコードの時間とメモリを大きく減らせる。
+    デコード前(Image.openの直後)に呼ぶ必要がある。image.sizeはデコードされるサイズに変わる。
+    """
+    width, height = image.size
+    longest = max(width, height)
+    if image.format != 'JPEG' or longest <= size:
         return image
-    elif width > height:
-        result = Image.new(image.mode, (width, width), background_color)
-        result.paste(image, (0, (width - height) // 2))
-        return result
-    else:
-        result = Image.new(image.mode, (height, height), background_color)
-        result.paste(image, ((height - width) // 2, 0))
-        return result
+    # 長辺がsizeになるように縮小したときの大きさ。これ以上の大きさでデコードすれば、サムネイルの画質は変わらない
+    target = (math.ceil(width * size / longest), math.ceil(height * size / longest))
+    image.draft(image.mode, target)
+    return image
+
+
+def decode_image(image: Image, size: int) -> Image:
+    """
+    サムネイルに必要な大きさで画像をデコードする。
+    縮小とデコードを分けて計測するためのもので、デコード済みの画像に対するdraft_imageは何もしない。
+    """
+    image = draft_image(image, size)
+    image.load()
+    return image
+
+
+def create_thumbnails(image: Image) -> Dict[int, Image]:
+    """
+    1回だけデコードした画像から、全ての大きさのサムネイルを生成する。
+    大きいものから順に、1つ前に生成したサムネイルを縮小して次のサムネイルを作る。
+    """
+    sizes = get_thumbnail_sizes()
+    source = draft_image(image, sizes[0])
+    thumbnails = {}
+    for size in sizes:
+        thumbnail = resize_to_square(source, size)
+        thumbnails[size] = thumbnail
+        source = thumbnail
+    return thumbnails
 
 
-def create_thumbnail(image: Image) -> Image:
+def get_thumbnail_format() -> str:
     """
-    サムネイルを生成する
+    環境変数からサムネイルの形式(PNG, JPEG, WEBP)を取得する。未設定の場合はPNG
     """
-    size = get_thumbnail_size()
-    square_image = expand_to_square(image)
-    thumbnail = square_image.resize((size, size), Image.LANCZOS)
-    return thumbnail
+    format = os.environ.get('THUMBNAIL_FORMAT', 'PNG').upper()
+    if format not in THUMBNAIL_FORMATS:
+        raise ValueError(f'THUMBNAIL_FORMAT can use next values. {", ".join(THUMBNAIL_FORMATS.keys())}')
+    return format
 
 
-def convert_image_to_bytes(image: Image) -> bytes:
+def get_save_option() -> dict:
     """
-    Imageをbytesに変換する
+    環境変数からImage.saveに渡すエンコードのOptionを生成する。未設定の項目はPillowのデフォルトのままにする。
+    THUMBNAIL_QUALITY: JPEG, WEBPの画質(1〜100)
+    THUMBNAIL_OPTIMIZE: trueの場合、エンコードに時間をかけてサイズを小さくする(PNG, JPEG)
+    THUMBNAIL_PNG_COMPRESS_LEVEL: PNGの圧縮レベル(0〜9)
     """
+    format = get_thumbnail_format()
+    option: dict = {'format': format}
+    quality = os.environ.get('THUMBNAIL_QUALITY')
+    if quality is not None and format != 'PNG':
+        option['quality'] = int(quality)
+    if os.environ.get('THUMBNAIL_OPTIMIZE', 'false').lower() == 'true' and format != 'WEBP':
+        option['optimize'] = True
+    compress_level = os.environ.get('THUMBNAIL_PNG_COMPRESS_LEVEL')
+    if compress_level is not None and format == 'PNG':
+        option['compress_level'] = int(compress_level)
+    return option
+
+
+def convert_image_to_bytes(image: Image, save_option: Optional[dict] = None) -> bytes:
+    """
+    Imageをbytesに変換する。save_optionが指定されない場合はPNGにする
+    """
+    if save_option is None:
+        save_option = {'format': 'PNG'}
+    if save_option['format'] in RGB_ONLY_FORMATS and image.mode not in RGB_COMPATIBLE_MODES:
+        image = image.convert('RGB')
     io = BytesIO()
-    image.save(io, format='PNG')
+    image.save(io, **save_option)
     return io.getvalue()
 
 
-def upload_thumbnail(id: str, name: str, bucket: str, thumbnail: Image, s3_client: BaseClient) -> None:
+def create_thumbnail_key(id: str, name: str, size: int, is_multiple: bool, ext: str = 'png') -> str:
+    """
+    サムネイルのKeyを生成する。複数の大きさを生成する場合は、大きさごとにprefixを分ける
+    """
+    if not is_multiple:
+        return f'thumbnails/{id}/{name}.{ext}'
+    return f'thumbnails/{id}/{size}/{name}.{ext}'
+
+
+def create_thumbnail_keys(id: str, name: str, sizes: List[int]) -> Dict[int, str]:
+    """
+    生成するサムネイルの大きさごとに、アップロード先のKeyを生成する
+    """
+    ext, _ = THUMBNAIL_FORMATS[get_thumbnail_format()]
+    is_multiple = len(sizes) > 1
+    return {size: create_thumbnail_key(id, name, size, is_multiple, ext) for size in sizes}
+
+
+def upload_thumbnails(
+        id: str,
+        name: str,
+        bucket: str,
+        thumbnails: Dict[int, Image],
+        s3_client: BaseClient,
+        keys: Optional[Dict[int, str]] = None,
+        metrics: Optional[StageMetrics] = None) -> Dict[str, str]:
+    """
+    サムネイルを並列にエンコードしてアップロードする。PillowのエンコードはGILを解放するので、スレッドで並列化できる。
+    keysが指定されない場合は、アップロード先のKeyをここで生成する。
+    metricsが指定された場合は、エンコードの時間(各スレッドの合計)とアップロードしたbyte数を記録する。
+    大きさ(DynamoDBのMapのKeyにするため文字列)とS3のKeyの対応を返す。
+    """
+    save_option = get_save_option()
+    _, content_type = THUMBNAIL_FORMATS[save_option['format']]
+    if keys is None:
+        keys = create_thumbnail_keys(id, name, list(thumbnails.keys()))
+    with ThreadPoolExecutor(max_workers=len(thumbnails)) as executor:
+        futures = [
+            executor.submit(
+                upload_thumbnail, keys[size], bucket, thumbnail, s3_client, save_option, content_type, metrics
+            )
+            for size, thumbnail in thumbnails.items()
+        ]
+        # 1つでも失敗した場合は例外を送出する
+        for future in futures:
+            future.result()
+    return {str(size): key for size, key in keys.items()}
+
+
+def upload_thumbnail(
+        key: str,
+        bucket: str,
+        thumbnail: Image,
+        s3_client: BaseClient,
+        save_option: Optional[dict] = None,
+        content_type: str = 'image/png',
+        metrics: Optional[StageMetrics] = None) -> None:
     """
     サムネイルをアップロードする
     """
-    raw_bytes = convert_image_to_bytes(thumbnail)
-    key = f'thumbnails/{id}/{name}.png'
+    if metrics is None:
+        raw_bytes = convert_image_to_bytes(thumbnail, save_option)
+    else:
+        raw_bytes = metrics.measure('encode', convert_image_to_bytes, thumbnail, save_option)
+        metrics.add_bytes('upload', len(raw_bytes))
     s3_client.put_object(
         Bucket=bucket,
         Key=key,
         Body=raw_bytes,
-        ContentType='image/png'
+        ContentType=content_type
     )
 
 
-def create_update_db_option(id: str) -> dict:
+def create_update_db_option(
+        id: str,
+        thumbnail_keys: Dict[str, str],
+        processed_object: Optional[dict] = None,
+        uploaded_at: Optional[int] = None) -> dict:
     """
-    metadataを更新するためのOptionを生成する。ここではサムネイルを持っているかを示すattributeを追加している。
+    metadataを更新するためのOptionを生成する。ここではサムネイルを持っているかを示すattributeと、サムネイルのKeyを追加している。
+    processed_objectが指定された場合は、処理済みのObjectとして記録し、より新しいObjectを処理済みなら更新しない。
+    サムネイルのアップロードが終わってから呼び、サムネイルの作成が終わった時刻(呼んだ時刻)と、
+    uploaded_atが指定された場合はアップロードの時刻(S3のEventの発生時刻)も記録する。
     """
-    update_attributes = {
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    update_attributes: Dict[str, Any] = {
         'hasThumbnail': True,
-        'updatedAt': int(datetime.now(timezone.utc).timestamp() * 1000)
+        'thumbnailKeys': thumbnail_keys,
+        'updatedAt': now,
+        PROCESSED_AT_ATTRIBUTES['thumbnail']: now
     }
+    if uploaded_at is not None:
+        update_attributes['uploadedAt'] = uploaded_at
+    condition = Key('id').eq(id)
+    if processed_object is not None:
+        for stage in THUMBNAIL_STAGES:
+            update_attributes[get_processed_object_attribute(stage)] = processed_object
+        condition = condition & create_processed_condition(THUMBNAIL_STAGES, processed_object)
 
     option = {
         'Key': {
             'id': id
         },
-        'ConditionExpression': Key('id').eq(id),
+        'ConditionExpression': condition,
         'ReturnValues': 'ALL_NEW'
     }
 
@@ -158,17 +534,10 @@ def create_update_db_option(id: str) -> dict:
     return option
 
 
-def get_table_name():
-    """
-    環境変数からDynamoDBのTable名を取得する
-    """
-    return os.environ['DATA_TABLE_NAME']
-
-
 def update_db(option: dict, dynamodb_resource: ServiceResource) -> dict:
     """
-    metadataを更新する
+    metadataを更新する。
+    Recordごとのスレッドから呼ばれるので、スレッドセーフなClientを使う(ServiceResourceはスレッドセーフではない)。
+    ServiceResourceから取得したClientは、型の変換(DynamoDB JSON <-> Pythonの値)とConditionの変換も行ってくれる
     """
-    table = dynamodb_resource.Table(get_table_name())
-    resp = table.update_item(**option)
-    return resp
+    return dynamodb_resource.meta.client.update_item(TableName=get_table_name(), **option)
@@ -1,17 +1,57 @@
+import base64
+import binascii
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from decimal import Decimal
-from typing import List, Optional, Tuple
+from io import StringIO
+from queue import Queue
+from threading import Event
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 from uuid import UUID
 
 import boto3
 from boto3.resources.base import ServiceResource
 from botocore.client import BaseClient
+from botocore.config import Config
 
 from logger.get_logger import get_logger
+from logger.metrics import StageMetrics
+from pre_signer import BulkPreSigner
 
 logger = get_logger(__name__)
 
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+PRE_SIGNED_URL_EXPIRE = 3600
+# SigV4のPreSignedUrlに指定できる有効期限の上限(7日)
+MAX_PRE_SIGNED_URL_EXPIRE = 604800
+# サムネイルの大きさが1種類(THUMBNAIL_SIZE)だった頃の大きさ。thumbnail_urlは、これに近い大きさのサムネイルを返し続ける
+LEGACY_THUMBNAIL_SIZE = 250
+
+# fieldsで指定できるmetadataの属性
+METADATA_FIELDS = [
+    'id', 'filename', 'isUploaded', 'createdAt', 'updatedAt', 'size', 'width', 'height', 'hasThumbnail',
+    'thumbnailKeys', 'traceId', 'uploadUrlIssuedAt', 'uploadedAt', 'analyzedAt', 'thumbnailCreatedAt'
+]
+# PreSignedUrlの生成に必要な属性
+PRE_SIGNED_URL_FIELDS = ['id', 'filename', 'isUploaded', 'hasThumbnail', 'thumbnailKeys']
+# includeで指定できる値。urls: 画像とサムネイルのURL、thumbnails: サムネイルのURLのみ、none: URLを生成しない
+INCLUDE_VALUES = ['urls', 'thumbnails', 'none']
+
+# idsで一度に指定できるIDの数の上限
+MAX_IDS = 1000
+# BatchGetItemで1回のリクエストに指定できるKeyの数の上限
+BATCH_GET_CHUNK_SIZE = 100
+# BatchGetItemのUnprocessedKeysを再送する回数の上限と、待ち時間(秒)の初期値
+BATCH_GET_MAX_RETRIES = 8
+BATCH_GET_BASE_DELAY = 0.05
+
+# 並列Scanで各セグメントの終了を示すための目印
+SEGMENT_DONE = object()
+
 
 class ValidationError(Exception):
     """ValidationでErrorが起きたことを示す自作Errorクラス"""
@@ -28,15 +68,19 @@ def default(obj):
 def main(
         event: dict,
         dynamodb_resource: ServiceResource = boto3.resource('dynamodb'),
-        s3_client: BaseClient = boto3.client('s3')) -> Tuple[int, str]:
+        s3_client: BaseClient = boto3.client('s3', config=Config(signature_version='s3v4'))) -> Tuple[int, str]:
     """
     metadataを取得する処理
     """
-    id = get_id(event)
-    if id is None:
-        return get_all_metadata(dynamodb_resource, s3_client)
-    else:
-        return get_a_metadata(id, dynamodb_resource, s3_client)
+    metrics = StageMetrics()
+    try:
+        id = get_id(event)
+        if id is None:
+            return get_all_metadata(event, dynamodb_resource, s3_client, metrics)
+        else:
+            return get_a_metadata(id, event, dynamodb_resource, s3_client, metrics)
+    finally:
+        metrics.emit(logger)
 
 
 def get_id(event: dict) -> Optional[str]:
@@ -75,74 +119,509 @@ def get_bucket_name():
     return os.environ['DATA_BUCKET_NAME']
 
 
-def get_all_metadata(dynamodb_resource: ServiceResource, s3_client: BaseClient) -> Tuple[int, str]:
+def get_query_string_parameters(event: dict) -> dict:
+    """
+    QueryStringParameterを取得する。存在しない場合(API Gatewayではnullが入る)は空のdictを返す
+    """
+    return event.get('queryStringParameters') or {}
+
+
+def get_and_validate_ids(params: dict) -> Optional[List[str]]:
+    """
+    QueryStringParameterからids(カンマ区切り)を取得しつつValidationを行う。指定がなければnullを返す
+    """
+    raw_ids = params.get('ids')
+    if raw_ids is None:
+        return None
+    # BatchGetItemは重複したKeyを受け付けないので、指定された順序を保ちつつ重複を除く
+    ids = list(dict.fromkeys(x.strip() for x in raw_ids.split(',') if x.strip() != ''))
+    if len(ids) == 0:
+        raise ValidationError('ids is empty.')
+    if len(ids) > MAX_IDS:
+        raise ValidationError(f'ids can specify up to {MAX_IDS} ids.')
+    for id in ids:
+        validate_id(id)
+    return ids
+
+
+def is_paginated(params: dict) -> bool:
+    """
+    limitかnextTokenが指定されていればページ単位の取得とみなす。
+    どちらも指定されていない場合は、後方互換のため全件取得を行う。
+    """
+    return 'limit' in params or 'nextToken' in params
+
+
+def get_and_validate_limit(params: dict) -> int:
+    """
+    QueryStringParameterからlimitを取得しつつValidationを行う。指定がなければデフォルト値を返す
+    """
+    raw_limit = params.get('limit')
+    if raw_limit is None:
+        return DEFAULT_PAGE_LIMIT
+    try:
+        limit = int(raw_limit)
+    except (TypeError, ValueError) as e:
+        logger.warning(f'Exception occurred: {e}', exc_info=True)
+        raise ValidationError('limit is not integer.')
+    if limit < 1 or limit > MAX_PAGE_LIMIT:
+        raise ValidationError(f'limit must be between 1 and {MAX_PAGE_LIMIT}.')
+    return limit
+
+
+def encode_next_token(last_evaluated_key: Optional[dict]) -> Optional[str]:
+    """
+    LastEvaluatedKeyをクライアントに返すための不透明なトークンに変換する。続きがなければnullを返す
+    """
+    if last_evaluated_key is None:
+        return None
+    raw = json.dumps(last_evaluated_key, default=default, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_next_token(token: Optional[str]) -> Optional[dict]:
+    """
+    nextTokenをExclusiveStartKeyに変換する。形式が不正な場合はValidationErrorとする
+    """
+    if token is None:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        logger.warning(f'Exception occurred: {e}', exc_info=True)
+        raise ValidationError('nextToken is invalid.')
+    # テーブルのキーはidのみなので、それ以外の形式は受け付けない
+    if not isinstance(key, dict) or set(key.keys()) != {'id'} or not isinstance(key['id'], str):
+        raise ValidationError('nextToken is invalid.')
+    return key
+
+
+def get_and_validate_fields(params: dict) -> Optional[List[str]]:
     """
-    metadata全件取得のレスポンスを作成する
+    QueryStringParameterからfields(カンマ区切り)を取得しつつValidationを行う。指定がなければnullを返す(全属性)
     """
-    all_metadata = scan_metadata(dynamodb_resource)
-    pre_signed_urls = [
-        create_pre_signed_url_for_get(x['id'], x['filename'], x.get('hasThumbnail'), s3_client)
-        # isUploadedがfalseの場合、アップロードされたファイルがないのでPreSignedUrlを生成しない
-        for x in all_metadata if x['isUploaded']
-    ]
-    result = {
-        'metadata': all_metadata,
-        'preSignedUrls': pre_signed_urls
+    raw_fields = params.get('fields')
+    if raw_fields is None:
+        return None
+    # 重複を除きつつ、指定された順序を保つ
+    fields = list(dict.fromkeys(x.strip() for x in raw_fields.split(',') if x.strip() != ''))
+    if len(fields) == 0:
+        raise ValidationError('fields is empty.')
+    if any(x not in METADATA_FIELDS for x in fields):
+        raise ValidationError(f'fields can use next values. {", ".join(METADATA_FIELDS)}')
+    return fields
+
+
+def get_and_validate_include(params: dict) -> str:
+    """
+    QueryStringParameterからincludeを取得しつつValidationを行う。指定がなければurls(従来通り)とする
+    """
+    include = params.get('include', 'urls')
+    if include not in INCLUDE_VALUES:
+        raise ValidationError(f'include can use next values. {", ".join(INCLUDE_VALUES)}')
+    return include
+
+
+def create_projection_option(fields: Optional[List[str]], include: str) -> dict:
+    """
+    fieldsとincludeから、DynamoDBから読み込む属性を絞るためのOption(ProjectionExpression)を生成する。
+    PreSignedUrlを生成する場合は、生成に必要な属性も読み込む。
+    """
+    if fields is None:
+        return {}
+    attributes = list(fields)
+    if include != 'none':
+        attributes += [x for x in PRE_SIGNED_URL_FIELDS if x not in attributes]
+    # sizeなどは予約語なので、ExpressionAttributeNamesを使う
+    return {
+        'ProjectionExpression': ', '.join(f'#{x}' for x in attributes),
+        'ExpressionAttributeNames': {f'#{x}': x for x in attributes}
     }
-    return (200, json.dumps(result, default=default))
 
 
-def scan_metadata(dynamodb_resource: ServiceResource, last_evaluated_key: Optional[dict] = None) -> List[dict]:
+def select_fields(metadata: dict, fields: Optional[List[str]]) -> dict:
     """
-    DynamoDBからmetadataを全件取得する。
-    scanではデータ量が多いと一度で取得できない場合があるので、再帰的に処理を行い全件取得するようにしている。
+    metadataからfieldsで指定された属性だけを取り出す。fieldsがnullの場合はそのまま返す
+    """
+    if fields is None:
+        return metadata
+    return {x: metadata[x] for x in fields if x in metadata}
+
+
+def needs_pre_signed_url(metadata: dict, include: str) -> bool:
+    """
+    metadataに対してPreSignedUrlを生成するかどうか
+    """
+    # isUploadedがfalseの場合、アップロードされたファイルがないのでPreSignedUrlを生成しない
+    if include == 'none' or not metadata['isUploaded']:
+        return False
+    if include == 'thumbnails':
+        return bool(metadata.get('hasThumbnail'))
+    return True
+
+
+def get_scan_total_segments() -> int:
+    """
+    環境変数から並列Scanのセグメント数を取得する。未設定の場合は1(並列化しない)
+    """
+    total_segments = int(os.environ.get('SCAN_TOTAL_SEGMENTS', '1'))
+    if total_segments < 1:
+        raise ValueError('SCAN_TOTAL_SEGMENTS must be greater than 0.')
+    return total_segments
+
+
+def get_all_metadata(
+        event: dict,
+        dynamodb_resource: ServiceResource,
+        s3_client: BaseClient,
+        metrics: Optional[StageMetrics] = None) -> Tuple[int, str]:
+    """
+    metadata全件取得(またはページ単位の取得)のレスポンスを作成する。
+    Scanはレスポンスのエンコードと同時に少しずつ行うので、Scanの時間はresponseの段階に含まれる
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    try:
+        params = get_query_string_parameters(event)
+        fields = get_and_validate_fields(params)
+        include = get_and_validate_include(params)
+        projection_option = create_projection_option(fields, include)
+        ids = get_and_validate_ids(params)
+        next_token = None
+        all_metadata: Iterable[dict]
+        if ids is not None:
+            # 並べ替えにidを使うので、fieldsにidが含まれていなくても読み込む
+            if fields is not None and 'id' not in fields:
+                projection_option = create_projection_option(fields + ['id'], include)
+            all_metadata = metrics.measure('get_db', batch_get_metadata, ids, dynamodb_resource, projection_option)
+        elif is_paginated(params):
+            limit = get_and_validate_limit(params)
+            exclusive_start_key = decode_next_token(params.get('nextToken'))
+            all_metadata, last_evaluated_key = scan_metadata_page(
+                dynamodb_resource, limit, exclusive_start_key, projection_option
+            )
+            next_token = encode_next_token(last_evaluated_key)
+        else:
+            all_metadata = scan_all_metadata(dynamodb_resource, projection_option)
+        chunks = encode_all_metadata(all_metadata, s3_client, next_token, fields, include, metrics)
+        body = metrics.measure('response', join_chunks, chunks)
+        metrics.add_bytes('response', len(body))
+        return (200, body)
+    except ValidationError as e:
+        return (400, json.dumps({'message': str(e)}))
+
+
+def batch_get_metadata(
+        ids: List[str],
+        dynamodb_resource: ServiceResource,
+        projection_option: Optional[dict] = None) -> List[dict]:
+    """
+    DynamoDBからidsで指定されたmetadataをBatchGetItemでまとめて取得する。
+    BatchGetItemは1回に100件までなので、100件ずつに分けて取得する。
+    存在しないidは結果に含めない。結果はidsで指定された順序に並べ替える。
+    """
+    table_name = get_table_name()
+    found: Dict[str, dict] = {}
+    for start in range(0, len(ids), BATCH_GET_CHUNK_SIZE):
+        keys = [{'id': x} for x in ids[start:start + BATCH_GET_CHUNK_SIZE]]
+        for metadata in batch_get_chunk(table_name, keys, dynamodb_resource, projection_option):
+            found[metadata['id']] = metadata
+    return [found[x] for x in ids if x in found]
+
+
+def batch_get_chunk(
+        table_name: str,
+        keys: List[dict],
+        dynamodb_resource: ServiceResource,
+        projection_option: Optional[dict] = None) -> List[dict]:
+    """
+    BatchGetItemを1回分(100件まで)行う。
+    UnprocessedKeysが返された場合は、待ち時間を倍にしながら(exponential backoff)再送する。
+    再送の回数が上限を超えた場合はRuntimeErrorとする。
+    """
+    request_items: Dict[str, Any] = {
+        table_name: {
+            'Keys': keys,
+            **(projection_option or {})
+        }
+    }
+    items = []
+    for attempt in range(BATCH_GET_MAX_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(BATCH_GET_BASE_DELAY * 2 ** (attempt - 1))
+        resp = dynamodb_resource.batch_get_item(RequestItems=request_items)
+        items += resp.get('Responses', {}).get(table_name, [])
+        request_items = resp.get('UnprocessedKeys') or {}
+        if len(request_items) == 0:
+            return items
+    raise RuntimeError(f'UnprocessedKeys remained after {BATCH_GET_MAX_RETRIES} retries.')
+
+
+def scan_metadata_page(
+        dynamodb_resource: ServiceResource,
+        limit: int,
+        exclusive_start_key: Optional[dict] = None,
+        projection_option: Optional[dict] = None) -> Tuple[List[dict], Optional[dict]]:
+    """
+    DynamoDBからmetadataを1ページ分だけ取得する。
+    続きがある場合はLastEvaluatedKeyも返す(続きがなければnull)。
     """
     table = dynamodb_resource.Table(get_table_name())
-    option = {}
-    if last_evaluated_key is not None:
-        option['ExclusiveStartKey'] = last_evaluated_key
+    option: Dict[str, Any] = {
+        'Limit': limit,
+        **(projection_option or {})
+    }
+    if exclusive_start_key is not None:
+        option['ExclusiveStartKey'] = exclusive_start_key
     resp = table.scan(**option)
-    result = resp.get('Items', [])
-    if 'LastEvaluatedKey' in resp:
-        result += scan_metadata(dynamodb_resource, last_evaluated_key=resp['LastEvaluatedKey'])
-    return result
+    return resp.get('Items', []), resp.get('LastEvaluatedKey')
 
 
-def create_pre_signed_url_for_get(id: str, filename: str, has_thumbnail: Optional[bool], s3_client: BaseClient) -> dict:
-    bucket = get_bucket_name()
-    expire = 3600
+def scan_metadata(dynamodb_resource: ServiceResource, projection_option: Optional[dict] = None) -> Iterator[dict]:
+    """
+    DynamoDBからmetadataを全件取得する。
+    scanではデータ量が多いと一度で取得できない場合があるので、LastEvaluatedKeyがなくなるまで繰り返しScanする。
+    取得したページから順に返すgeneratorなので、全件分のリストを作らない。
+    """
+    table = dynamodb_resource.Table(get_table_name())
+    option: Dict[str, Any] = dict(projection_option or {})
+    while True:
+        resp = table.scan(**option)
+        yield from resp.get('Items', [])
+        if 'LastEvaluatedKey' not in resp:
+            return
+        option['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def scan_all_metadata(dynamodb_resource: ServiceResource, projection_option: Optional[dict] = None) -> Iterator[dict]:
+    """
+    DynamoDBからmetadataを全件取得する。
+    SCAN_TOTAL_SEGMENTSが2以上の場合は、テーブルを分割して並列にScanする。
+    """
+    total_segments = get_scan_total_segments()
+    if total_segments > 1:
+        return parallel_scan_metadata(dynamodb_resource, total_segments, projection_option)
+    return scan_metadata(dynamodb_resource, projection_option)
+
+
+def parallel_scan_metadata(
+        dynamodb_resource: ServiceResource,
+        total_segments: int,
+        projection_option: Optional[dict] = None) -> Iterator[dict]:
+    """
+    テーブルをtotal_segments個のセグメントに分割し、スレッドプール上で並列にScanする。
+    取得できたページから順にmetadataを返すgeneratorなので、全件が揃うのを待つ必要はない。
+    順序は保証されない。
+    """
+    # ServiceResourceはスレッドセーフではないため、スレッドセーフなClientを共有して使う。
+    # ServiceResourceから取得したClientは、型の変換(DynamoDB JSON <-> Pythonの値)も行ってくれる
+    client = dynamodb_resource.meta.client
+    table_name = get_table_name()
+    pages: Queue = Queue()
+    stop = Event()
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        for segment in range(total_segments):
+            executor.submit(
+                scan_segment, client, table_name, segment, total_segments, pages, stop, projection_option
+            )
+        try:
+            finished = 0
+            while finished < total_segments:
+                page = pages.get()
+                if page is SEGMENT_DONE:
+                    finished += 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            # 途中で例外が起きた場合やgeneratorが閉じられた場合に、残りのセグメントのScanを打ち切る
+            stop.set()
+
+
+def scan_segment(
+        client: BaseClient,
+        table_name: str,
+        segment: int,
+        total_segments: int,
+        pages: Queue,
+        stop: Event,
+        projection_option: Optional[dict] = None) -> None:
+    """
+    1セグメント分のScanを行い、取得したページをQueueに積む。
+    最後にSEGMENT_DONEを積む。例外が起きた場合は例外そのものを積む。
+    """
+    option: Dict[str, Any] = {
+        'TableName': table_name,
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        **(projection_option or {})
+    }
+    try:
+        while not stop.is_set():
+            resp = client.scan(**option)
+            pages.put(resp.get('Items', []))
+            if 'LastEvaluatedKey' not in resp:
+                break
+            option['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+        pages.put(SEGMENT_DONE)
+    except Exception as e:
+        logger.warning(f'Exception occurred: {e}', exc_info=True)
+        pages.put(e)
+
+
+def encode_all_metadata(
+        all_metadata: Iterable[dict],
+        s3_client: BaseClient,
+        next_token: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        include: str = 'urls',
+        metrics: Optional[StageMetrics] = None) -> Iterator[str]:
+    """
+    全件取得のレスポンスBody({"metadata": [...], "preSignedUrls": [...], "nextToken": ...})を少しずつJSONにする。
+    metadataは1件ずつエンコードしてすぐに手放すので、全件分のdictとJSON文字列を同時にメモリに持たない。
+    PreSignedUrlの生成に必要な情報(id, filename, hasThumbnail, thumbnailKeys)だけを保持しておき、最後にまとめて署名する。
+    fieldsが指定された場合はその属性だけを、includeで指定された種類のPreSignedUrlだけを出力する。
+    出力はjson.dumpsで一括エンコードした場合と同じ文字列になる。
+    metricsが指定された場合は、署名にかかった時間を記録する。
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    uploaded = []
+    yield '{"metadata": ['
+    for index, metadata in enumerate(all_metadata):
+        if index > 0:
+            yield ', '
+        yield json.dumps(select_fields(metadata, fields), default=default)
+        if needs_pre_signed_url(metadata, include):
+            uploaded.append(
+                (metadata['id'], metadata['filename'], metadata.get('hasThumbnail'), metadata.get('thumbnailKeys'))
+            )
+    yield '], "preSignedUrls": ['
+    if len(uploaded) > 0:
+        pre_signer = create_pre_signer(s3_client)
+        for index, (id, filename, has_thumbnail, thumbnail_keys) in enumerate(uploaded):
+            if index > 0:
+                yield ', '
+            with metrics.stage('pre_sign'):
+                pre_signed_url = create_pre_signed_url_for_get(
+                    id, filename, has_thumbnail, s3_client, pre_signer, include, thumbnail_keys
+                )
+            yield json.dumps(pre_signed_url)
+    yield f'], "nextToken": {json.dumps(next_token)}}}'
+
+
+def join_chunks(chunks: Iterable[str]) -> str:
+    """
+    encode_all_metadataが返すJSONの断片を、リストを作らずに1つの文字列にまとめる
+    """
+    buffer = StringIO()
+    for chunk in chunks:
+        buffer.write(chunk)
+    return buffer.getvalue()
+
+
+def get_pre_signed_url_time_window() -> int:
+    """
+    環境変数からPreSignedUrlの署名時刻を丸める単位(秒)を取得する。未設定または0の場合は丸めない
+    """
+    window = int(os.environ.get('PRE_SIGNED_URL_TIME_WINDOW', '0'))
+    if window < 0 or PRE_SIGNED_URL_EXPIRE + window > MAX_PRE_SIGNED_URL_EXPIRE:
+        raise ValueError(
+            f'PRE_SIGNED_URL_TIME_WINDOW must be between 0 and {MAX_PRE_SIGNED_URL_EXPIRE - PRE_SIGNED_URL_EXPIRE}.'
+        )
+    return window
+
+
+def create_pre_signer(s3_client: BaseClient) -> BulkPreSigner:
+    """
+    ダウンロード用のPreSignedUrlをまとめて生成するBulkPreSignerを作る。
+    PRE_SIGNED_URL_TIME_WINDOWが設定されている場合は、署名時刻をその秒数単位で切り捨てる。
+    同じ時間枠の間は同じObjectに同じURLを発行するので、ブラウザやCDNのキャッシュが効くようになる。
+    切り捨てた分だけ有効期限を延ばして、発行した時点から少なくともexpiresIn秒は有効になるようにしている。
+    botocoreで署名する場合(SigV4以外など)は署名時刻を指定できず、時間枠が効かないので、通常の有効期限で署名する。
+    """
+    window = get_pre_signed_url_time_window()
+    if window == 0:
+        return BulkPreSigner(s3_client, get_bucket_name(), PRE_SIGNED_URL_EXPIRE)
+    now = int(datetime.now(timezone.utc).timestamp())
+    signed_at = datetime.fromtimestamp(now - now % window, timezone.utc)
+    pre_signer = BulkPreSigner(s3_client, get_bucket_name(), PRE_SIGNED_URL_EXPIRE + window, signed_at=signed_at)
+    if pre_signer.is_local_signing:
+        return pre_signer
+    logger.warning('PRE_SIGNED_URL_TIME_WINDOW does not apply because pre-signed urls are signed by botocore.')
+    return BulkPreSigner(s3_client, get_bucket_name(), PRE_SIGNED_URL_EXPIRE)
+
+
+def create_pre_signed_url_for_get(
+        id: str,
+        filename: str,
+        has_thumbnail: Optional[bool],
+        s3_client: BaseClient,
+        pre_signer: Optional[BulkPreSigner] = None,
+        include: str = 'urls',
+        thumbnail_keys: Optional[Dict[str, str]] = None) -> dict:
+    """
+    ダウンロード用のPreSignedUrlを生成する。
+    pre_signerが渡された場合は、botocoreを経由せずにまとめて署名する(一覧取得用)
+    includeがthumbnailsの場合は、サムネイルのURLだけを生成する(urlはnullになる)
+    サムネイルのKey(thumbnailKeys)が記録されている場合は、大きさごとのURLをthumbnail_urlsに追加し、
+    thumbnail_urlには、以前のクライアントのためにselect_thumbnail_sizeで選んだ大きさのURLを入れる(署名はthumbnail_urlsと共有する)。
+    記録されていない場合(大きさが1種類だった頃のmetadata)は、thumbnails/{id}/{filename}のURLを入れる
+    """
     method = 'GET'
-    url = s3_client.generate_presigned_url(
-        ClientMethod='get_object',
-        Params={
-            'Bucket': bucket,
-            'Key': f'images/{id}/{filename}'
-        },
-        ExpiresIn=expire,
-        HttpMethod=method
-    )
-    option = {
+    url = None
+    if include != 'thumbnails':
+        url = generate_pre_signed_url_for_get(f'images/{id}/{filename}', s3_client, pre_signer)
+    option: Dict[str, Any] = {
         'id': id,
         'url': url,
         'thumbnail_url': None,
         'method': method,
-        'expiresIn': expire
+        'expiresIn': PRE_SIGNED_URL_EXPIRE
     }
-    if has_thumbnail:
-        thumbnail_url = s3_client.generate_presigned_url(
-            ClientMethod='get_object',
-            Params={
-                'Bucket': bucket,
-                'Key': f'thumbnails/{id}/{filename}'
-            },
-            ExpiresIn=expire,
-            HttpMethod=method
-        )
-        option['thumbnail_url'] = thumbnail_url
+    if has_thumbnail and thumbnail_keys:
+        option['thumbnail_urls'] = {
+            size: generate_pre_signed_url_for_get(key, s3_client, pre_signer) for size, key in thumbnail_keys.items()
+        }
+        option['thumbnail_url'] = option['thumbnail_urls'][select_thumbnail_size(list(thumbnail_keys.keys()))]
+    elif has_thumbnail:
+        option['thumbnail_url'] = generate_pre_signed_url_for_get(f'thumbnails/{id}/{filename}', s3_client, pre_signer)
     return option
 
 
-def fetch_a_metadata(id: str, dynamodb_resource: ServiceResource) -> Optional[dict]:
+def select_thumbnail_size(sizes: List[str]) -> str:
+    """
+    thumbnail_urlに使うサムネイルの大きさを選ぶ。
+    LEGACY_THUMBNAIL_SIZE以上で一番小さいもの、なければ一番大きいものを返す(大きさは文字列なので数値で比較する)
+    """
+    large_sizes = [x for x in sizes if int(x) >= LEGACY_THUMBNAIL_SIZE]
+    if len(large_sizes) > 0:
+        return min(large_sizes, key=int)
+    return max(sizes, key=int)
+
+
+def generate_pre_signed_url_for_get(key: str, s3_client: BaseClient, pre_signer: Optional[BulkPreSigner]) -> str:
+    """
+    KeyのダウンロードURLに署名する
+    """
+    if pre_signer is not None:
+        return pre_signer.generate(key)
+    return s3_client.generate_presigned_url(
+        ClientMethod='get_object',
+        Params={
+            'Bucket': get_bucket_name(),
+            'Key': key
+        },
+        ExpiresIn=PRE_SIGNED_URL_EXPIRE,
+        HttpMethod='GET'
+    )
+
+
+def fetch_a_metadata(
+        id: str,
+        dynamodb_resource: ServiceResource,
+        projection_option: Optional[dict] = None) -> Optional[dict]:
     """
     DynamoDBからmetadataを単件取得する。該当するmetadataがなければnullを返す(not found)。
     """
@@ -150,29 +629,51 @@ def fetch_a_metadata(id: str, dynamodb_resource: ServiceResource) -> Optional[di
     resp = table.get_item(
         Key={
             'id': id
-        }
+        },
+        **(projection_option or {})
     )
     return resp.get('Item')
 
 
-def get_a_metadata(id: str, dynamodb_resource: ServiceResource, s3_client: BaseClient) -> Tuple[int, str]:
+def get_a_metadata(
+        id: str,
+        event: dict,
+        dynamodb_resource: ServiceResource,
+        s3_client: BaseClient,
+        metrics: Optional[StageMetrics] = None) -> Tuple[int, str]:
     """
     metadataを単件取得する場合のレスポンスを作成する
     """
+    if metrics is None:
+        metrics = StageMetrics()
     try:
         validate_id(id)
-        metadata = fetch_a_metadata(id, dynamodb_resource)
+        params = get_query_string_parameters(event)
+        fields = get_and_validate_fields(params)
+        include = get_and_validate_include(params)
+        metadata = metrics.measure(
+            'get_db', fetch_a_metadata, id, dynamodb_resource, create_projection_option(fields, include)
+        )
         if metadata is None:
             return (404, json.dumps({'message': 'not found'}))
         pre_signed_url = None
 
-        if metadata['isUploaded']:
-            pre_signed_url = create_pre_signed_url_for_get(
-                id, metadata['filename'], metadata.get('hasThumbnail'), s3_client
-            )
+        if needs_pre_signed_url(metadata, include):
+            # 署名時刻を丸める場合は、一覧取得と同じURLになるようにBulkPreSignerで署名する
+            with metrics.stage('pre_sign'):
+                pre_signer = create_pre_signer(s3_client) if get_pre_signed_url_time_window() > 0 else None
+                pre_signed_url = create_pre_signed_url_for_get(
+                    id,
+                    metadata['filename'],
+                    metadata.get('hasThumbnail'),
+                    s3_client,
+                    pre_signer,
+                    include,
+                    metadata.get('thumbnailKeys')
+                )
 
         result = {
-            'metadata': metadata,
+            'metadata': select_fields(metadata, fields),
             'preSignedUrl': pre_signed_url
         }
         return (200, json.dumps(result, default=default))
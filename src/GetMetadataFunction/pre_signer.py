@@ -0,0 +1,144 @@
+import hmac
+from datetime import datetime, timezone
+from hashlib import sha256
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qsl, quote, urlsplit
+
+from botocore.client import BaseClient
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+SIGNED_HEADERS = 'host'
+TIMESTAMP_FORMAT = '%Y%m%dT%H%M%SZ'
+# URLの組み立て方(エンドポイント、アドレススタイル、署名するリージョン)をbotocoreから得るためのKey
+PROBE_KEY = '_'
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443
+}
+CLIENT_METHODS = {
+    'GET': 'get_object',
+    'PUT': 'put_object'
+}
+
+
+class BulkPreSigner(object):
+    """
+    同じBucketに対するPreSignedUrl(SigV4のクエリ文字列認証)をまとめて生成するクラス。
+
+    generate_presigned_urlはKeyごとにbotocoreのリクエスト組み立て処理を一通り実行するため、件数が多いと遅い。
+    このクラスではbotocoreでの署名を最初に1回だけ行ってURLの組み立て方を調べ、署名鍵もリクエストごとに1回だけ導出する。
+    以降はKeyごとにHMACを2回計算するだけで、botocoreと同じ文字列のURLを生成する。
+
+    s3_clientがSigV4で署名しない場合など、botocoreと同じURLを生成できないときは、Keyごとにbotocoreで署名する。
+    """
+
+    def __init__(
+            self,
+            s3_client: BaseClient,
+            bucket: str,
+            expires_in: int,
+            method: str = 'GET',
+            signed_at: Optional[datetime] = None) -> None:
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.expires_in = expires_in
+        self.method = method
+        self.signed_at = signed_at if signed_at is not None else datetime.now(timezone.utc)
+        self.is_local_signing = self.prepare()
+
+    def generate(self, key: str) -> str:
+        """
+        KeyのPreSignedUrlを生成する
+        """
+        if not self.is_local_signing:
+            return self.generate_with_botocore(key)
+        path = self.path_prefix + quote(key.encode('utf-8'), safe='/~')
+        canonical_request = '\n'.join([
+            self.method,
+            path,
+            self.canonical_query_string,
+            f'host:{self.host}\n',
+            SIGNED_HEADERS,
+            UNSIGNED_PAYLOAD
+        ])
+        string_to_sign = self.string_to_sign_prefix + sha256(canonical_request.encode('utf-8')).hexdigest()
+        signature = hmac.new(self.signing_key, string_to_sign.encode('utf-8'), sha256).hexdigest()
+        return f'{self.origin}{path}?{self.query_string}&X-Amz-Signature={signature}'
+
+    def generate_with_botocore(self, key: str) -> str:
+        """
+        botocoreでKeyのPreSignedUrlを生成する
+        """
+        return self.s3_client.generate_presigned_url(
+            ClientMethod=CLIENT_METHODS[self.method],
+            Params={
+                'Bucket': self.bucket,
+                'Key': key
+            },
+            ExpiresIn=self.expires_in,
+            HttpMethod=self.method
+        )
+
+    def prepare(self) -> bool:
+        """
+        Keyによらない部分(URLの接頭辞、クエリ文字列、署名鍵)を事前に計算する。
+        botocoreと同じURLを生成できない場合はFalseを返す。
+        """
+        probe = urlsplit(self.generate_with_botocore(PROBE_KEY))
+        params = dict(parse_qsl(probe.query, keep_blank_values=True))
+        if params.get('X-Amz-Algorithm') != ALGORITHM or params.get('X-Amz-SignedHeaders') != SIGNED_HEADERS:
+            return False
+        # 認証用以外のパラメータが付く場合は、組み立て方が変わるので対象外とする
+        if any(not k.startswith('X-Amz-') for k in params.keys()) or not probe.path.endswith(f'/{PROBE_KEY}'):
+            return False
+
+        credentials = self.s3_client._get_credentials().get_frozen_credentials()
+        access_key, _, region, service, _ = params['X-Amz-Credential'].split('/')
+        if access_key != credentials.access_key:
+            return False
+
+        timestamp = self.signed_at.strftime(TIMESTAMP_FORMAT)
+        scope = f'{timestamp[0:8]}/{region}/{service}/aws4_request'
+        auth_params: List[Tuple[str, str]] = [
+            ('X-Amz-Algorithm', ALGORITHM),
+            ('X-Amz-Credential', f'{credentials.access_key}/{scope}'),
+            ('X-Amz-Date', timestamp),
+            ('X-Amz-Expires', str(self.expires_in)),
+            ('X-Amz-SignedHeaders', SIGNED_HEADERS)
+        ]
+        if credentials.token is not None:
+            auth_params.append(('X-Amz-Security-Token', credentials.token))
+        encoded_params = [(k, quote(v.encode('utf-8'), safe='-_.~')) for k, v in auth_params]
+
+        self.origin = f'{probe.scheme}://{probe.netloc}'
+        self.path_prefix = probe.path[:-len(PROBE_KEY)]
+        self.host = get_host(probe.scheme, probe.hostname, probe.port)
+        self.query_string = '&'.join(f'{k}={v}' for k, v in encoded_params)
+        self.canonical_query_string = '&'.join(f'{k}={v}' for k, v in sorted(encoded_params))
+        self.string_to_sign_prefix = f'{ALGORITHM}\n{timestamp}\n{scope}\n'
+        self.signing_key = derive_signing_key(credentials.secret_key, timestamp[0:8], region, service)
+        return True
+
+
+def get_host(scheme: str, hostname: Optional[str], port: Optional[int]) -> str:
+    """
+    署名に使うhostヘッダの値を求める。デフォルトのポートの場合はポート番号を含めない
+    """
+    host = f'{hostname}'
+    if ':' in host:
+        # IPv6のアドレスの場合
+        host = f'[{host}]'
+    if port is None or port == DEFAULT_PORTS.get(scheme):
+        return host
+    return f'{host}:{port}'
+
+
+def derive_signing_key(secret_key: str, date: str, region: str, service: str) -> bytes:
+    """
+    SigV4の署名鍵を導出する
+    """
+    key = f'AWS4{secret_key}'.encode('utf-8')
+    for msg in [date, region, service, 'aws4_request']:
+        key = hmac.new(key, msg.encode('utf-8'), sha256).digest()
+    return key
@@ -1,116 +1,270 @@
-import json
-import os
 from datetime import datetime, timezone
 from io import BytesIO
-from typing import Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import boto3
 from boto3.dynamodb.conditions import Key
 from boto3.resources.base import ServiceResource
 from botocore.client import BaseClient
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 
 from logger.get_logger import get_logger
+from logger.metrics import StageMetrics
+from pipeline.idempotency import (create_processed_condition, get_processed_object, get_processed_object_attribute,
+                                  get_table_name, run_unless_processed, update_unless_superseded)
+from pipeline.latency import PROCESSED_AT_ATTRIBUTES, TRACE_ID_METADATA_KEY, get_event_time, record_pipeline_latencies
+from pipeline.records import get_bucket, get_id, get_key, get_size, process_all_records
 
 logger = get_logger(__name__)
 
+# 解像度を読み取るために先頭から取得するバイト数。足りない場合は順に大きくし、最後はObject全体を取得する
+PROBE_LENGTHS = [64 * 1024, 1024 * 1024]
+
+# 画像フォーマットごとのマジックナンバー(ファイル先頭のバイト列)。これ以外の形式はPillowで判別する
+MAGIC_NUMBERS = [
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+    (b'II*\x00', 'TIFF'),
+    (b'MM\x00*', 'TIFF')
+]
+
+
+# このFunctionで行う処理の段階
+ANALYZER_STAGES = ['analyzer']
+# このFunctionで遅延を記録する段階
+ANALYZER_LATENCY_STAGES = ['analyze']
+
+
+class UnsupportedImageError(Exception):
+    """アップロードされたObjectが対応している画像ではないことを示す自作Errorクラス"""
+    pass
+
 
 def main(
         event: dict,
         s3_client: BaseClient = boto3.client('s3'),
-        dynamodb_resouce: ServiceResource = boto3.resource('dynamodb')):
+        dynamodb_resouce: ServiceResource = boto3.resource('dynamodb')) -> List[dict]:
     """
-    アップロードされた画像を読み込んでmetadataを更新する
+    アップロードされた画像を読み込んでmetadataを更新する。
+    Eventに含まれる全てのRecordを並列に処理し、Recordごとの結果を返す。
+    1つでも失敗したRecordがある場合は、全てのRecordを処理し終えてからRecordProcessingErrorを送出する。
     """
-    body = get_sns_message_json(event)
-    logger.info('MessageJson', body)
-
-    bucket = get_bucket(body)
-    key = get_key(body)
-    size = get_size(body)
-    id = get_id(key)
-    raw_bytes = get_image_bytes(bucket, key, s3_client)
-    width, height = get_image_resolution(raw_bytes)
-    update_option = create_update_option(id, size, width, height)
-    update_metadata(update_option, dynamodb_resouce)
+    return process_all_records(event, process_record, s3_client, dynamodb_resouce)
 
 
-def get_sns_message_json(event: dict) -> dict:
+def process_record(record: dict, s3_client: BaseClient, dynamodb_resouce: ServiceResource) -> None:
     """
-    EventからSNSのMessageを取得し、JSONをパースする
+    1つのRecordの画像を読み込んでmetadataを更新する。
+    処理済みかどうかの確認(GetItem)と画像の読み込み(S3)は並列に行う。
+    metadataの更新には読み込んだ解像度が必要なので、更新は読み込みが終わってから行う。
+    アップロードの時刻と解析が終わった時刻を記録し、アップロード用URLの発行からの遅延をメトリクスにする。
+    同じObjectを処理済みの場合(Eventの重複)や、より新しいObjectを処理済みの場合は何もしない。
+    処理の段階ごとにかかった時間とbyte数をログ(有効な場合はメトリクス)に出力する。
     """
-    return json.loads(event['Records'][0]['Sns']['Message'])
+    bucket = get_bucket(record)
+    key = get_key(record)
+    size = get_size(record)
+    id = get_id(key)
+    metrics = StageMetrics()
+    processed_object = get_processed_object(record)
+    already_processed, probed = run_unless_processed(
+        id, ANALYZER_STAGES, processed_object, dynamodb_resouce,
+        lambda: metrics.measure('probe', probe_image, bucket, key, size, s3_client, metrics)
+    )
+    if already_processed:
+        logger.info(f'skipped already processed record. key: {key}', extra={'processedObject': processed_object})
+        return
+    width, height, format = probed
+    metrics.set_dimension('ImageFormat', format)
+    logger.info(f'image format: {format}, width: {width}, height: {height}, key: {key}')
+    update_option = create_update_option(id, size, width, height, processed_object, get_event_time(record))
+    with metrics.stage('update_db'):
+        resp = update_unless_superseded(update_metadata, update_option, dynamodb_resouce, processed_object)
+    record_pipeline_latencies(metrics, resp, ANALYZER_LATENCY_STAGES)
+    logger.info(f'processed record. key: {key}', extra=metrics.create_log_extra())
 
 
-def get_bucket(event: dict) -> str:
+def get_image_bytes(
+        bucket: str,
+        key: str,
+        s3_client: BaseClient,
+        length: Optional[int] = None,
+        metrics: Optional[StageMetrics] = None) -> bytes:
     """
-    S3 Bucket名を取得する
+    S3から画像のbytesを取得する。lengthが指定された場合は、先頭からlengthバイトだけを取得する。
+    metricsが指定された場合は、Objectのmetadataのtrace idを記録する
     """
-    return event['Records'][0]['s3']['bucket']['name']
+    option = {
+        'Bucket': bucket,
+        'Key': key
+    }
+    if length is not None:
+        option['Range'] = f'bytes=0-{length - 1}'
+    resp = s3_client.get_object(**option)
+    if metrics is not None:
+        metrics.set_property('traceId', resp.get('Metadata', {}).get(TRACE_ID_METADATA_KEY))
+    return resp['Body'].read()
 
 
-def get_key(event: dict) -> str:
+def probe_image(
+        bucket: str,
+        key: str,
+        size: int,
+        s3_client: BaseClient,
+        metrics: Optional[StageMetrics] = None) -> Tuple[int, int, str]:
     """
-    S3のKeyを取得する
+    画像の先頭部分だけを取得して、横幅、縦幅、フォーマットを取得する。
+    解像度はヘッダに書かれているので、Object全体をダウンロードする必要はない。
+    ヘッダが取得した範囲に収まっていない場合は、範囲を広げて取得し直す。
+    画像ではないObject(マジックナンバーにもPillowにも判別できないもの)は、最初に取得した範囲ですぐにエラーにする。
+    metricsが指定された場合は、取得したbyte数とtrace idを記録する。
     """
-    return event['Records'][0]['s3']['object']['key']
+    if size == 0:
+        raise UnsupportedImageError('object is empty.')
+    format = None
+    for length in PROBE_LENGTHS + [None]:
+        # 前回の取得でObject全体を読み込めている場合は、これ以上範囲を広げても意味がない
+        is_last = length is None or length >= size
+        raw_bytes = get_image_bytes(bucket, key, s3_client, None if is_last else length, metrics)
+        if metrics is not None:
+            metrics.add_bytes('probe', len(raw_bytes))
+        if format is None:
+            format = detect_image_format(raw_bytes)
+        if format is None:
+            # Pillowが対応している形式だが、ヘッダが取得した範囲に収まっていない
+            if is_last:
+                raise UnsupportedImageError('failed to read image header.')
+            logger.warning(f'failed to read header in {length} bytes.')
+            continue
+        try:
+            width, height = get_image_resolution(raw_bytes, format)
+            return width, height, format
+        except Exception as e:
+            if is_last:
+                raise
+            logger.warning(f'failed to read header in {length} bytes: {e}', exc_info=True)
+    raise UnsupportedImageError('failed to read image header.')
 
 
-def get_size(event: dict) -> int:
+def detect_image_format(raw_bytes: bytes) -> Optional[str]:
     """
-    S3のObjectの容量を取得する
+    先頭のバイト列(マジックナンバー)から画像のフォーマットを判定する。
+    マジックナンバーの表にない形式(ICO, PPM, JPEG 2000など)は、Pillowで判別する。
+    Pillowも判別できない場合はエラーにする。
+    Pillowが判別した形式でも、ヘッダが範囲に収まっていない場合はnullを返す(範囲を広げて判定し直す)
     """
-    return event['Records'][0]['s3']['object']['size']
+    if raw_bytes[0:4] == b'RIFF' and raw_bytes[8:12] == b'WEBP':
+        return 'WEBP'
+    for magic_number, format in MAGIC_NUMBERS:
+        if raw_bytes.startswith(magic_number):
+            return format
+    try:
+        return Image.open(BytesIO(raw_bytes)).format
+    except UnidentifiedImageError:
+        # ICOのように、ヘッダが範囲に収まっていないだけでも判別できないことがあるので、先頭のバイト列でも確認する
+        if is_accepted_by_pillow(raw_bytes):
+            return None
+        raise UnsupportedImageError('object is not a supported image.')
+    except Exception as e:
+        logger.warning(f'failed to detect image format: {e}', exc_info=True)
+        return None
 
 
-def get_id(key: str) -> str:
+def is_accepted_by_pillow(raw_bytes: bytes) -> bool:
     """
-    Keyからid(uuid)を取得する
+    Pillowが対応している形式のいずれかが、先頭のバイト列を自身の形式として受け付けるかを判定する
     """
-    return key[7:43]
+    Image.init()
+    prefix = raw_bytes[:16]
+    for id in Image.ID:
+        _, accept = Image.OPEN[id]
+        if accept is None:
+            continue
+        try:
+            result = accept(prefix)
+        except Exception:
+            continue
+        # 警告メッセージ(文字列)を返す形式は、受け付けていない扱いにする
+        if result and not isinstance(result, str):
+            return True
+    return False
 
 
-def get_image_bytes(bucket: str, key: str, s3_client: BaseClient) -> bytes:
+def get_image_resolution(raw_bytes: bytes, format: Optional[str] = None) -> Tuple[int, int]:
     """
-    S3から画像のbytesを取得する
+    画像のbytesを読み込んで、画像の横幅と縦幅を取得する
     """
-    resp = s3_client.get_object(
-        Bucket=bucket,
-        Key=key
-    )
-    return resp['Body'].read()
+    if format == 'WEBP':
+        # PillowはWebPを開く際にデータ全体を必要とするので、ヘッダを直接読む
+        return get_webp_resolution(raw_bytes)
+    image = Image.open(BytesIO(raw_bytes))
+    return image.size
 
 
-def get_image_resolution(raw_bytes: bytes) -> Tuple[int, int]:
+def get_webp_resolution(raw_bytes: bytes) -> Tuple[int, int]:
     """
-    画像のbytesを読み込んで、画像の横幅と縦幅を取得する
+    WebPのヘッダから横幅と縦幅を読み取る
+    https://developers.google.com/speed/webp/docs/riff_container
     """
-    image = Image.open(BytesIO(raw_bytes))
-    return image.size
+    chunk = raw_bytes[12:16]
+    if chunk == b'VP8X' and len(raw_bytes) >= 30:
+        # 拡張フォーマット: Canvasの横幅-1, 縦幅-1が24bitのリトルエンディアンで入っている
+        width = int.from_bytes(raw_bytes[24:27], 'little') + 1
+        height = int.from_bytes(raw_bytes[27:30], 'little') + 1
+        return width, height
+    if chunk == b'VP8 ' and len(raw_bytes) >= 30 and raw_bytes[23:26] == b'\x9d\x01\x2a':
+        # 非可逆圧縮: フレームヘッダのstart codeの後に、14bitの横幅と縦幅が入っている
+        width = int.from_bytes(raw_bytes[26:28], 'little') & 0x3fff
+        height = int.from_bytes(raw_bytes[28:30], 'little') & 0x3fff
+        return width, height
+    if chunk == b'VP8L' and len(raw_bytes) >= 25 and raw_bytes[20] == 0x2f:
+        # 可逆圧縮: signatureの後に、14bitずつ横幅-1と縦幅-1が入っている
+        bits = int.from_bytes(raw_bytes[21:25], 'little')
+        width = (bits & 0x3fff) + 1
+        height = ((bits >> 14) & 0x3fff) + 1
+        return width, height
+    raise UnsupportedImageError('failed to read WebP header.')
 
 
 def create_update_option(
         id: str,
         size: int,
         width: int,
-        height: int) -> dict:
+        height: int,
+        processed_object: Optional[dict] = None,
+        uploaded_at: Optional[int] = None) -> dict:
     """
-    metadataを更新するためのDynamoDBのOptionを生成する
+    metadataを更新するためのDynamoDBのOptionを生成する。
+    processed_objectが指定された場合は、処理済みのObjectとして記録し、より新しいObjectを処理済みなら更新しない。
+    解析が終わった時刻と、uploaded_atが指定された場合はアップロードの時刻(S3のEventの発生時刻)も記録する。
     """
+    condition = Key('id').eq(id)
+    if processed_object is not None:
+        condition = condition & create_processed_condition(ANALYZER_STAGES, processed_object)
     option = {
         'Key': {
             'id': id
         },
-        'ConditionExpression': Key('id').eq(id),
+        'ConditionExpression': condition,
         'ReturnValues': 'ALL_NEW'
     }
-    update_attributes = {
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    update_attributes: Dict[str, Any] = {
         'size': size,
         'width': width,
         'height': height,
-        'updatedAt': int(datetime.now(timezone.utc).timestamp() * 1000),
-        'isUploaded': True
+        'updatedAt': now,
+        'isUploaded': True,
+        PROCESSED_AT_ATTRIBUTES['analyze']: now
     }
+    if uploaded_at is not None:
+        update_attributes['uploadedAt'] = uploaded_at
+    if processed_object is not None:
+        for stage in ANALYZER_STAGES:
+            update_attributes[get_processed_object_attribute(stage)] = processed_object
     update_expression_array = [f'#{x} = :{x}' for x in update_attributes.keys()]
     option['UpdateExpression'] = f'SET {", ".join(update_expression_array)}'
     option['ExpressionAttributeNames'] = {f'#{x}': x for x in update_attributes.keys()}
@@ -119,14 +273,10 @@ def create_update_option(
     return option
 
 
-def get_table_name():
-    return os.environ['DATA_TABLE_NAME']
-
-
 def update_metadata(option: dict, dynamodb_resource: ServiceResource) -> dict:
     """
-    metadataを更新する
+    metadataを更新する。
+    Recordごとのスレッドから呼ばれるので、スレッドセーフなClientを使う(ServiceResourceはスレッドセーフではない)。
+    ServiceResourceから取得したClientは、型の変換(DynamoDB JSON <-> Pythonの値)とConditionの変換も行ってくれる
     """
-    table = dynamodb_resource.Table(get_table_name())
-    resp = table.update_item(**option)
-    return resp
+    return dynamodb_resource.meta.client.update_item(TableName=get_table_name(), **option)
@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from logging import Logger
+from typing import Any, Callable, Dict, Iterator, Optional
+
+
+def is_metrics_enabled() -> bool:
+    """
+    環境変数METRICS_ENABLEDがtrueの場合、計測した値をCloudWatchのメトリクスとして出力する
+    """
+    return os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+
+
+def get_namespace() -> str:
+    """
+    環境変数からメトリクスのNamespaceを取得する
+    """
+    return os.environ.get('METRICS_NAMESPACE', 'PyconServerlessTutorial')
+
+
+def create_metric_name(stage: str, suffix: str) -> str:
+    """
+    段階名(update_dbなど)から、メトリクス名(updateDbTimeなど)を生成する
+    """
+    head, *tail = stage.split('_')
+    return head + ''.join(x.capitalize() for x in tail) + suffix
+
+
+class StageMetrics(object):
+    """
+    1回の処理(Record、Request)の段階ごとの時間(ミリ秒)とbyte数を集める。
+    アップロードから画像の処理までのように、複数のFunctionにまたがる段階の遅延(ミリ秒)も記録できる。
+    有効な場合は、CloudWatchのEmbedded Metric Format(EMF)でLogに出力し、メトリクスにする。
+    無効な場合の計測はperf_counterを2回呼ぶだけで、メトリクスのためのLogは出力しない。
+    """
+
+    def __init__(self, dimensions: Optional[Dict[str, str]] = None):
+        self.enabled = is_metrics_enabled()
+        self.dimensions = {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')}
+        self.dimensions.update(dimensions or {})
+        self.timings: Dict[str, float] = {}
+        self.byte_counts: Dict[str, int] = {}
+        self.latencies: Dict[str, float] = {}
+        self.properties: Dict[str, Any] = {}
+        # 並列に実行している処理からも記録するので、加算はLockの中で行う
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        with句の中の処理にかかった時間を、nameの段階の時間として記録する。例外が起きた場合も記録する。
+        同じ段階を複数回計測した場合(並列に行うエンコードなど)は合計する
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.timings[name] = round(self.timings.get(name, 0) + elapsed, 3)
+
+    def measure(self, name: str, function: Callable[..., Any], *args: Any) -> Any:
+        """
+        functionを呼び出し、かかった時間をnameの段階の時間として記録する
+        """
+        with self.stage(name):
+            return function(*args)
+
+    def add_bytes(self, name: str, count: int) -> None:
+        """
+        nameの段階で読み書きしたbyte数を加算する
+        """
+        with self._lock:
+            self.byte_counts[name] = self.byte_counts.get(name, 0) + count
+
+    def add_latency(self, name: str, milliseconds: float) -> None:
+        """
+        複数のFunctionにまたがる段階(nameの段階)の遅延を記録する
+        """
+        self.latencies[name] = milliseconds
+
+    def set_property(self, name: str, value: Any) -> None:
+        """
+        メトリクスにはしないが、Logで検索できるようにする値(trace idなど)を追加する
+        """
+        self.properties[name] = value
+
+    def set_dimension(self, name: str, value: Optional[str]) -> None:
+        """
+        メトリクスのDimensionを追加する(画像の形式など、処理の途中で分かるもの)
+        """
+        self.dimensions[name] = value if value is not None else 'unknown'
+
+    def create_log_extra(self) -> dict:
+        """
+        Logのextraに渡す値を生成する。
+        有効な場合は、EMFの定義(_aws)と、メトリクスの値(updateDbTime, downloadBytes, uploadLatencyなど)、
+        Dimensionをトップレベルに追加する
+        """
+        extra: Dict[str, Any] = {'stageTimings': self.timings, 'stageBytes': self.byte_counts}
+        if len(self.latencies) > 0:
+            extra['pipelineLatencies'] = self.latencies
+        extra.update(self.properties)
+        if not self.enabled:
+            return extra
+        values: Dict[str, Any] = {}
+        units = {}
+        for stage, elapsed in self.timings.items():
+            values[create_metric_name(stage, 'Time')] = elapsed
+            units[create_metric_name(stage, 'Time')] = 'Milliseconds'
+        for stage, count in self.byte_counts.items():
+            values[create_metric_name(stage, 'Bytes')] = count
+            units[create_metric_name(stage, 'Bytes')] = 'Bytes'
+        for stage, latency in self.latencies.items():
+            values[create_metric_name(stage, 'Latency')] = latency
+            units[create_metric_name(stage, 'Latency')] = 'Milliseconds'
+        extra['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': get_namespace(),
+                    'Dimensions': [list(self.dimensions.keys())],
+                    'Metrics': [{'Name': x, 'Unit': y} for x, y in units.items()]
+                }
+            ]
+        }
+        extra.update(self.dimensions)
+        extra.update(values)
+        return extra
+
+    def emit(self, logger: Logger, message: str = 'metrics') -> None:
+        """
+        有効な場合だけ、メトリクスをLogに出力する
+        """
+        if self.enabled:
+            logger.info(message, extra=self.create_log_extra())
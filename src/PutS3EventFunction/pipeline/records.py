@@ -0,0 +1,156 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from boto3.resources.base import ServiceResource
+from botocore.client import BaseClient
+
+from logger.event_logger import log_event
+from logger.get_logger import get_logger
+
+logger = get_logger(__name__)
+
+# 同時に処理するRecord数のデフォルト。画像を同時にメモリに持つ数になるので、大きくしすぎない
+DEFAULT_MAX_CONCURRENT_RECORDS = 4
+
+
+class RecordProcessingError(Exception):
+    """Eventに含まれるRecordのいずれかの処理に失敗したことを示す自作Errorクラス"""
+
+    def __init__(self, results: List[dict]) -> None:
+        self.results = results
+        failed = [str(x['key'] or x['messageId']) for x in results if not x['succeeded']]
+        super().__init__(f'{len(failed)} of {len(results)} records failed. keys: {", ".join(failed)}')
+
+
+def process_all_records(
+        event: dict,
+        process: Callable[[dict, BaseClient, ServiceResource], None],
+        s3_client: BaseClient,
+        dynamodb_resouce: ServiceResource) -> List[dict]:
+    """
+    Eventの全てのRecordを上限付きのスレッドプールで並列に処理し、Recordごとの結果を返す。
+    SNSから直接呼ばれた場合と、SQSからまとめて呼ばれた場合のどちらにも対応する。
+    1つでも失敗したRecordがある場合は、全てのRecordを処理し終えてからRecordProcessingErrorを送出する。
+    """
+    results = []
+    records: List[Tuple[Optional[str], dict]] = []
+    for message_id, message in get_messages(event):
+        try:
+            records += [(message_id, x) for x in get_s3_records(message)]
+        except Exception as e:
+            # 壊れたMessageがあっても、他のMessageは処理する
+            logger.error(f'Exception occurred: {e}, messageId: {message_id}', exc_info=True)
+            results.append(create_result(message_id, None, e))
+    if len(records) > 0:
+        max_workers = min(get_max_concurrent_records(), len(records))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(run_record, process, message_id, record, s3_client, dynamodb_resouce)
+                for message_id, record in records
+            ]
+            results += [x.result() for x in futures]
+    succeeded_count = len([x for x in results if x['succeeded']])
+    logger.info(f'processed records. succeeded: {succeeded_count}, failed: {len(results) - succeeded_count}')
+    if succeeded_count < len(results):
+        raise RecordProcessingError(results)
+    return results
+
+
+def run_record(
+        process: Callable[[dict, BaseClient, ServiceResource], None],
+        message_id: Optional[str],
+        record: dict,
+        s3_client: BaseClient,
+        dynamodb_resouce: ServiceResource) -> dict:
+    """
+    1つのRecordを処理する。
+    失敗しても例外は送出せず、他のRecordの処理を続けられるように結果として返す。
+    """
+    key = None
+    try:
+        key = get_key(record)
+        process(record, s3_client, dynamodb_resouce)
+        return create_result(message_id, key)
+    except Exception as e:
+        logger.error(f'Exception occurred: {e}, key: {key}', exc_info=True)
+        return create_result(message_id, key, e)
+
+
+def create_result(message_id: Optional[str], key: Optional[str], error: Optional[Exception] = None) -> dict:
+    """
+    Recordの処理結果を生成する。messageIdはSQSから呼ばれた場合のみ入る
+    """
+    result: Dict[str, Any] = {
+        'messageId': message_id,
+        'key': key,
+        'succeeded': error is None,
+        'error': None if error is None else str(error)
+    }
+    return result
+
+
+def get_messages(event: dict) -> List[Tuple[Optional[str], str]]:
+    """
+    Eventから、S3のEventが入ったMessage(JSON)を取り出す。
+    SQSから呼ばれた場合は、失敗したMessageを報告するためにmessageIdも返す(SNSの場合はnull)
+    """
+    messages: List[Tuple[Optional[str], str]] = []
+    for record in event['Records']:
+        if record.get('eventSource') == 'aws:sqs':
+            messages.append((record['messageId'], record['body']))
+        else:
+            messages.append((None, record['Sns']['Message']))
+    return messages
+
+
+def get_s3_records(message: str) -> List[dict]:
+    """
+    MessageからS3のEventのRecordを取り出す
+    """
+    body = json.loads(message)
+    log_event(logger, body, 'MessageJson')
+    # SNSからSQSにRaw message deliveryを使わずに配信された場合は、SNSのMessageの中にS3のEventが入っている
+    if body.get('Type') == 'Notification':
+        body = json.loads(body['Message'])
+    # S3のテストイベント(s3:TestEvent)にはRecordsがない
+    return body.get('Records', [])
+
+
+def get_max_concurrent_records() -> int:
+    """
+    環境変数から同時に処理するRecord数を取得する
+    """
+    max_concurrent_records = int(os.environ.get('MAX_CONCURRENT_RECORDS', str(DEFAULT_MAX_CONCURRENT_RECORDS)))
+    if max_concurrent_records < 1:
+        raise ValueError('MAX_CONCURRENT_RECORDS must be greater than 0.')
+    return max_concurrent_records
+
+
+def get_bucket(record: dict) -> str:
+    """
+    S3 Bucket名を取得する
+    """
+    return record['s3']['bucket']['name']
+
+
+def get_key(record: dict) -> str:
+    """
+    S3のKeyを取得する
+    """
+    return record['s3']['object']['key']
+
+
+def get_size(record: dict) -> int:
+    """
+    S3のObjectの容量を取得する
+    """
+    return record['s3']['object']['size']
+
+
+def get_id(key: str) -> str:
+    """
+    Keyからid(uuid)を取得する
+    """
+    return key[7:43]
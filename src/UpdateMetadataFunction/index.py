@@ -1,7 +1,8 @@
 import json
 from typing import Any
 
-from logger.get_logger import get_logger
+from logger.event_logger import log_error_with_event, log_event
+from logger.get_logger import flush_logs, get_logger
 from metadata_updater import main
 
 logger = get_logger(__name__)
@@ -22,16 +23,19 @@ def handler(event: dict, context: Any) -> dict:
         'body': '{}'
     }
     try:
-        logger.info('event', event)
+        log_event(logger, event)
         status_code, body = main(event)
         result['statusCode'] = status_code
         result['body'] = body
     except Exception as e:
-        logger.error(f'Exception occurred: {e}', exc_info=True)
+        log_error_with_event(logger, f'Exception occurred: {e}', event)
         result['statusCode'] = 500
         result['body'] = json.dumps(
             {
                 'message': 'InternalServerError'
             }
         )
+    finally:
+        # Lambdaはhandlerから戻ると停止するので、Queueに残っているLogはここで出力しておく
+        flush_logs()
     return result
@@ -0,0 +1,96 @@
+import json
+import os
+import random
+from logging import Logger
+from typing import Any, FrozenSet, Optional
+
+# 値を隠す項目(大文字小文字は区別しない)。API GatewayのHeaderの認証情報など
+DEFAULT_REDACTED_KEYS = 'authorization,cookie,set-cookie,x-amz-security-token,x-api-key'
+REDACTED_VALUE = '***'
+
+
+def get_sample_rate() -> float:
+    """
+    Eventを出力する割合(0から1)。環境変数LOG_EVENT_SAMPLE_RATEで指定し、デフォルトでは全て出力する
+    """
+    return float(os.environ.get('LOG_EVENT_SAMPLE_RATE', '1'))
+
+
+def get_max_size() -> int:
+    """
+    出力するEventのJSONの最大の文字数。環境変数LOG_EVENT_MAX_SIZEで指定する
+    """
+    return int(os.environ.get('LOG_EVENT_MAX_SIZE', '8192'))
+
+
+def get_max_value_length() -> int:
+    """
+    Eventに含まれる文字列の最大の長さ。API GatewayのbodyやSNSのMessageなどは、これより後ろを切り詰める。
+    環境変数LOG_EVENT_MAX_VALUE_LENGTHで指定する
+    """
+    return int(os.environ.get('LOG_EVENT_MAX_VALUE_LENGTH', '1024'))
+
+
+def get_redacted_keys() -> FrozenSet[str]:
+    """
+    値を隠す項目。環境変数LOG_EVENT_REDACTED_KEYS(カンマ区切り)で指定する
+    """
+    keys = os.environ.get('LOG_EVENT_REDACTED_KEYS', DEFAULT_REDACTED_KEYS)
+    return frozenset(x.strip().lower() for x in keys.split(',') if x.strip())
+
+
+def is_sampled(sample_rate: float) -> bool:
+    """
+    Eventを出力するかどうかを決める
+    """
+    return sample_rate >= 1 or random.random() < sample_rate
+
+
+def redact(value: Any, redacted_keys: FrozenSet[str], max_value_length: Optional[int] = None) -> Any:
+    """
+    dictとlistを辿って、redacted_keysの項目の値を隠す。
+    max_value_lengthを指定した場合は、それより長い文字列を切り詰める
+    """
+    if isinstance(value, dict):
+        return {
+            k: REDACTED_VALUE if str(k).lower() in redacted_keys else redact(v, redacted_keys, max_value_length)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(x, redacted_keys, max_value_length) for x in value]
+    if isinstance(value, str) and max_value_length is not None and len(value) > max_value_length:
+        return f'{value[:max_value_length]}...({len(value)} chars)'
+    return value
+
+
+def create_event_log(event: Any) -> Any:
+    """
+    Logに出力するEventを作る。
+    値を隠して長い文字列を切り詰めた上で、JSONが最大の文字数を超える場合は先頭だけを文字列で残す
+    """
+    trimmed = redact(event, get_redacted_keys(), get_max_value_length())
+    max_size = get_max_size()
+    serialized = json.dumps(trimmed, ensure_ascii=False, default=str)
+    if len(serialized) <= max_size:
+        return trimmed
+    return {
+        'truncated': True,
+        'size': len(serialized),
+        'preview': serialized[:max_size]
+    }
+
+
+def log_event(logger: Logger, event: Any, message: str = 'event') -> None:
+    """
+    サンプリングしたEventだけを、値を隠して大きさを制限した上でINFOで出力する
+    """
+    if not is_sampled(get_sample_rate()):
+        return
+    logger.info(message, extra={'event': create_event_log(event)})
+
+
+def log_error_with_event(logger: Logger, message: str, event: Any) -> None:
+    """
+    エラーの調査のために、サンプリングや切り詰めを行わずにEventをERRORで出力する。値を隠す項目だけは隠す
+    """
+    logger.error(message, exc_info=True, extra={'event': redact(event, get_redacted_keys())})
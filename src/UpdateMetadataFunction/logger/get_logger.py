@@ -1,5 +1,22 @@
+import atexit
 import logging
 import logging.config
+import logging.handlers
+import os
+import queue
+import threading
+from typing import Optional
+
+# ロガーごとに設定するHandler。dictConfigのloggersとrootに対応する
+CONFIGURED_LOGGERS = ['', 'console', 'botocore']
+
+# flush_logsでQueueに残っているLogの出力を待つ最大の秒数。Listenerのスレッドが止まっていても戻れるようにする
+FLUSH_TIMEOUT_SECONDS = 2.0
+
+_configure_lock = threading.Lock()
+_configured = False
+# LOG_QUEUE_ENABLEDの場合に、Queueに積まれたLogを出力しているListener
+_listener: Optional['FlushableQueueListener'] = None
 
 
 def get_logging_config():
@@ -35,6 +52,129 @@ def get_logging_config():
     }
 
 
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    LogRecordをQueueに積むだけのHandler。JSONへの変換と出力は、QueueListenerのスレッドで行う。
+    標準のQueueHandlerはmsgとargsを文字列にまとめてしまうので、JsonLogFormatterが使うargsはそのまま残す。
+    """
+
+    def prepare(self, record):
+        # tracebackはスレッドをまたいで持ち回らずに、ここで文字列にしておく
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class FlushRequest(object):
+    """
+    flush_logsがQueueに積む目印。ListenerがこれをQueueから取り出した時点で、それより前に積まれたLogは出力済みになる
+    """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+
+
+class FlushableQueueListener(logging.handlers.QueueListener):
+    """
+    スレッドを動かしたまま、Queueに残っているLogの出力を待てるQueueListener。
+    Queueに積まれたFlushRequestに達したら、そのEventをセットする。
+    """
+
+    def __init__(self, log_queue, *handlers, respect_handler_level=False) -> None:
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.is_running = False
+
+    def start(self) -> None:
+        super().start()
+        self.is_running = True
+
+    def stop(self) -> None:
+        """
+        Queueに残っているLogを出力してからスレッドを止める。既に止まっている場合は何もしない
+        """
+        if not self.is_running:
+            return
+        self.is_running = False
+        super().stop()
+
+    def handle(self, record) -> None:
+        if isinstance(record, FlushRequest):
+            record.done.set()
+            return
+        super().handle(record)
+
+    def flush(self, timeout: float) -> bool:
+        """
+        ここまでにQueueに積まれたLogが全て出力されるのを待つ。timeout秒以内に出力されなかった場合はfalseを返す
+        """
+        request = FlushRequest()
+        self.queue.put_nowait(request)
+        return request.done.wait(timeout)
+
+
+def is_log_queue_enabled() -> bool:
+    """
+    環境変数LOG_QUEUE_ENABLEDがtrueの場合、Logの出力を別スレッドで行う
+    """
+    return os.environ.get('LOG_QUEUE_ENABLED', 'false').lower() == 'true'
+
+
+def enable_log_queue() -> FlushableQueueListener:
+    """
+    設定済みのHandlerをQueueListenerに移し、各ロガーにはQueueに積むだけのHandlerを設定する。
+    Lambdaでは停止したまま回収された実行環境でatexitが呼ばれるとは限らないので、
+    handlerの最後にflush_logsを呼んでQueueに残っているLogを出力する(atexitは通常のプロセス用)。
+    """
+    handlers = []
+    for name in CONFIGURED_LOGGERS:
+        for handler in logging.getLogger(name).handlers:
+            if handler not in handlers:
+                handlers.append(handler)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    for name in CONFIGURED_LOGGERS:
+        logging.getLogger(name).handlers = [queue_handler]
+    listener = FlushableQueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_log_queue, listener)
+    return listener
+
+
+def stop_log_queue(listener: FlushableQueueListener):
+    """
+    Queueに残っているLogを出力してからListenerを止める。既に止まっている場合は何もしない
+    """
+    listener.stop()
+
+
+def flush_logs():
+    """
+    Queueに残っているLogを全て出力する。Queueを使っていない場合は何もしない。
+    Lambdaはhandlerから戻ると実行環境を停止するので、各handlerの最後に呼ぶ。
+    ListenerのスレッドはそのままにしてQueueに目印を積み、そこまで出力されるのを待つ(最大FLUSH_TIMEOUT_SECONDS秒)。
+    """
+    listener = _listener
+    if listener is None or not listener.is_running:
+        return
+    listener.flush(FLUSH_TIMEOUT_SECONDS)
+
+
+def configure_logging():
+    """
+    ロギングの設定を行う。設定はプロセスで1回だけ行い、2回目以降は何もしない
+    """
+    global _configured, _listener
+    with _configure_lock:
+        if _configured:
+            return
+        logging.config.dictConfig(get_logging_config())
+        if is_log_queue_enabled():
+            _listener = enable_log_queue()
+        _configured = True
+
+
 def get_logger(name):
-    logging.config.dictConfig(get_logging_config())
+    configure_logging()
     return logging.getLogger(name)
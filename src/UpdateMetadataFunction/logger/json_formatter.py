@@ -4,24 +4,46 @@ import os
 
 
 class JsonLogFormatter(logging.Formatter):
-    def format(self, record):
-        result = {}
+    """
+    LogRecordを1行のJSONにするFormatter。
+    LogRecordの全ての属性を調べるのではなく、決まった属性(FIELDS)とextraで渡された属性だけを出力する。
+    JSONへの変換は1回だけ行い、変換できない値はstrにする。
+    """
+    # LogRecordの標準の属性のうち、出力するもの
+    FIELDS = ('name', 'msg', 'args', 'levelname', 'module', 'funcName', 'lineno', 'created', 'exc_info', 'stack_info')
+    # LogRecordの標準の属性。これ以外の属性はextraで渡されたものとみなして出力する
+    RESERVED_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
 
-        for attr, value in record.__dict__.items():
-            if attr == 'asctime':
-                value = self.formatTime(record)
-            if attr == 'exc_info' and value is not None:
-                value = self.formatException(value)
-            if attr == 'stack_info' and value is not None:
-                value = self.formatStack(value)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 環境変数はLogごとに読まずに、Formatterの生成時に1回だけ読む
+        self.lambda_request_id = os.environ.get('LAMBDA_REQUEST_ID')
 
-            try:
-                json.dumps(value)
-            except Exception:
-                value = str(value)
+    def format(self, record):
+        result = {x: getattr(record, x, None) for x in self.FIELDS}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            # Queueを経由した場合は、exc_infoではなく文字列にしたexc_textだけが残っている
+            result['exc_info'] = record.exc_text
+        if record.stack_info:
+            result['stack_info'] = self.formatStack(record.stack_info)
+        for attr, value in record.__dict__.items():
+            if attr not in self.RESERVED_ATTRS:
+                result[attr] = value
 
-            result[attr] = value
+        result['lambda_request_id'] = self.lambda_request_id
 
-        result['lambda_request_id'] = os.environ.get('LAMBDA_REQUEST_ID')
+        try:
+            return json.dumps(result, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            # Keyが文字列でないdictや循環参照など、defaultでは変換できない値はstrにする
+            return json.dumps({k: self.to_serializable(v) for k, v in result.items()}, ensure_ascii=False)
 
-        return json.dumps(result, ensure_ascii=False)
+    @staticmethod
+    def to_serializable(value):
+        try:
+            json.dumps(value, default=str)
+            return value
+        except (TypeError, ValueError):
+            return str(value)
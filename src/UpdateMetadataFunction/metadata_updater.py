@@ -3,8 +3,8 @@ import os
 import re
 from datetime import datetime, timezone
 from decimal import Decimal
-from typing import Optional, Tuple
-from uuid import UUID
+from typing import Any, Dict, Optional, Tuple
+from uuid import UUID, uuid4
 
 import boto3
 from boto3.dynamodb.conditions import Key
@@ -12,9 +12,13 @@ from boto3.resources.base import ServiceResource
 from botocore.client import BaseClient
 
 from logger.get_logger import get_logger
+from logger.metrics import StageMetrics
 
 logger = get_logger(__name__)
 
+# アップロードされた画像に付けるtrace idのObjectのmetadataのKey(HTTPのHeaderはx-amz-meta-trace-id)
+TRACE_ID_METADATA_KEY = 'trace-id'
+
 
 class ValidationError(Exception):
     pass
@@ -34,23 +38,26 @@ def main(
         dynamodb_resource: ServiceResource = boto3.resource('dynamodb'),
         s3_client: BaseClient = boto3.client('s3')) -> Tuple[int, str]:
     """
-    metadataを更新し、画像アップロード用のPreSignedUrlを発行する
+    metadataを更新し、画像アップロード用のPreSignedUrlを発行する。
+    存在確認を兼ねた条件付きのupdate_item 1回だけで更新する。
+    filenameが指定されない場合も新しいURLを発行するので、trace idとURLの発行時刻だけを新しくする。
     """
+    metrics = StageMetrics()
     try:
         id = get_id(event)
         validate_id(id)
-        metadata = get_a_metadata(id, dynamodb_resource)
+        body = get_json_request_body(event)
+        latest_filename = get_and_validate_file_name(body) if body is not None else None
+        option = create_update_option(id, latest_filename)
+        metadata = metrics.measure('update_db', update_metadata, option, dynamodb_resource)
         if metadata is None:
             return (404, json.dumps({'message': 'not found'}))
         filename = get_filename(metadata)
-        body = get_json_request_body(event)
-        if body is not None:
-            latest_filename = get_and_validate_file_name(body)
-            if latest_filename is not None:
-                filename = latest_filename
-                option = create_update_option(id, latest_filename)
-                metadata = update_metadata(option, dynamodb_resource)
-        pre_signed_url = create_pre_signed_url_for_put(id, filename, s3_client)
+        trace_id = metadata.get('traceId')
+        metrics.set_property('traceId', trace_id)
+        pre_signed_url = metrics.measure(
+            'pre_sign', create_pre_signed_url_for_put, id, filename, s3_client, trace_id
+        )
         result = {
             'metadata': metadata,
             'preSignedUrl': pre_signed_url
@@ -58,6 +65,8 @@ def main(
         return (200, json.dumps(result, default=default))
     except ValidationError as e:
         return (400, json.dumps({'message': str(e)}))
+    finally:
+        metrics.emit(logger)
 
 
 def get_id(event: dict) -> str:
@@ -86,19 +95,6 @@ def get_bucket_name():
     return os.environ['DATA_BUCKET_NAME']
 
 
-def get_a_metadata(id: str, dynamodb_resource: ServiceResource) -> Optional[dict]:
-    """
-    IDを使って、metadataを取得する
-    """
-    table = dynamodb_resource.Table(get_table_name())
-    resp = table.get_item(
-        Key={
-            'id': id
-        }
-    )
-    return resp.get('Item')
-
-
 def get_filename(metadata: dict) -> str:
     """
     metadataからfilenameを取得する
@@ -131,9 +127,12 @@ def get_and_validate_file_name(body: dict) -> Optional[str]:
     return name
 
 
-def create_update_option(id: str, filename: str) -> dict:
+def create_update_option(id: str, filename: Optional[str] = None) -> dict:
     """
-    metadataを更新するためのオプションを生成する
+    metadataを更新するためのオプションを生成する。
+    新しいアップロード用URLを発行するので、trace idとURLの発行時刻も新しくする。
+    (古いURLでアップロードされた画像はtrace idが一致しないので、URLの発行からの遅延を計測しない)
+    filenameが指定されない場合は、trace idとURLの発行時刻だけを更新する
     """
     option = {
         'Key': {
@@ -142,11 +141,17 @@ def create_update_option(id: str, filename: str) -> dict:
         'ConditionExpression': Key('id').eq(id),
         'ReturnValues': 'ALL_NEW'
     }
-    update_attributes = {
-        'updatedAt': int(datetime.now(timezone.utc).timestamp() * 1000),
-        'isUploaded': False,  # filenameが変更になるので未アップロードとみなす
-        'filename': filename
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    update_attributes: Dict[str, Any] = {
+        'traceId': str(uuid4()),
+        'uploadUrlIssuedAt': now
     }
+    if filename is not None:
+        update_attributes.update({
+            'updatedAt': now,
+            'isUploaded': False,  # filenameが変更になるので未アップロードとみなす
+            'filename': filename
+        })
     update_expression_array = [f'#{x} = :{x}' for x in update_attributes.keys()]
     option['UpdateExpression'] = f'SET {", ".join(update_expression_array)}'
     option['ExpressionAttributeNames'] = {f'#{x}': x for x in update_attributes.keys()}
@@ -155,28 +160,43 @@ def create_update_option(id: str, filename: str) -> dict:
     return option
 
 
-def update_metadata(option: dict, dynamodb_resource: ServiceResource) -> dict:
+def update_metadata(option: dict, dynamodb_resource: ServiceResource) -> Optional[dict]:
     """
-    metadataを更新する
+    metadataを更新し、更新後のmetadataを返す。
+    ConditionExpressionに失敗した(metadataが存在しない)場合はnullを返す(not found)。
     """
     table = dynamodb_resource.Table(get_table_name())
-    resp = table.update_item(**option)
+    try:
+        resp = table.update_item(**option)
+    except dynamodb_resource.meta.client.exceptions.ConditionalCheckFailedException as e:
+        logger.warning(f'Exception occurred: {e}', exc_info=True)
+        return None
     return resp['Attributes']
 
 
-def create_pre_signed_url_for_put(id: str, filename: str, s3_client: BaseClient) -> dict:
+def create_pre_signed_url_for_put(
+        id: str,
+        filename: str,
+        s3_client: BaseClient,
+        trace_id: Optional[str] = None) -> dict:
     """
-    アップロード用のPreSignedUrlを生成する
+    アップロード用のPreSignedUrlを生成する。
+    trace_idが指定された場合は、ObjectのmetadataとしてHeaderごと署名するので、headersのHeaderを付けないとアップロードできない
     """
     bucket = get_bucket_name()
     expire = 3600
     method = 'PUT'
+    params: Dict[str, Any] = {
+        'Bucket': bucket,
+        'Key': f'images/{id}/{filename}'
+    }
+    headers = {}
+    if trace_id is not None:
+        params['Metadata'] = {TRACE_ID_METADATA_KEY: trace_id}
+        headers[f'x-amz-meta-{TRACE_ID_METADATA_KEY}'] = trace_id
     url = s3_client.generate_presigned_url(
         ClientMethod='put_object',
-        Params={
-            'Bucket': bucket,
-            'Key': f'images/{id}/{filename}'
-        },
+        Params=params,
         ExpiresIn=expire,
         HttpMethod=method
     )
@@ -184,5 +204,6 @@ def create_pre_signed_url_for_put(id: str, filename: str, s3_client: BaseClient)
         'id': id,
         'url': url,
         'method': 'PUT',
-        'expiresIn': expire
+        'expiresIn': expire,
+        'headers': headers
     }
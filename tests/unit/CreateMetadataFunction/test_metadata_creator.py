@@ -1,7 +1,10 @@
 import json
+from urllib.parse import parse_qs, urlparse
 
+import boto3
 import pytest
 import requests
+from botocore.client import Config
 from freezegun import freeze_time
 
 import metadata_creator
@@ -92,22 +95,25 @@ class TestGetAndValidateFileName(object):
 
 class TestCreateMetadataItem(object):
     @pytest.mark.parametrize(
-        'id, filename, expected', [
+        'id, filename, trace_id, expected', [
             (
                 'test_id',
                 'test.png',
+                'test_trace_id',
                 {
                     'id': 'test_id',
                     'filename': 'test.png',
                     'isUploaded': False,
-                    'createdAt': 1554120000000
+                    'createdAt': 1554120000000,
+                    'traceId': 'test_trace_id',
+                    'uploadUrlIssuedAt': 1554120000000
                 }
             )
         ]
     )
     @freeze_time('2019/04/01 12:00:00+00:00')
-    def test_normal(self, id, filename, expected):
-        actual = metadata_creator.create_metadata_item(id, filename)
+    def test_normal(self, id, filename, trace_id, expected):
+        actual = metadata_creator.create_metadata_item(id, filename, trace_id)
         assert actual == expected
 
 
@@ -200,15 +206,40 @@ class TestPreSignedUrlForPut(object):
     @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
     def test_normal(self, s3_client, bucket_name, id, filename):
         actual = metadata_creator.create_pre_signed_url_for_put(id, filename, s3_client)
-        assert set(actual.keys()) == {'id', 'url', 'method', 'expiresIn'}
+        assert set(actual.keys()) == {'id', 'url', 'method', 'expiresIn', 'headers'}
         assert actual['id'] == id
         assert actual['method'] == 'PUT'
         assert actual['expiresIn'] == 3600
+        assert actual['headers'] == {}
         assert actual['url'].find(f'http://localhost:4572/{bucket_name}/images/{id}/{filename}?') == 0
 
         resp = requests.put(actual['url'], data='test data'.encode())
         assert resp.status_code == 200
 
+    @pytest.mark.parametrize(
+        'set_environ, id, filename, trace_id', [
+            (
+                {'DATA_BUCKET_NAME': 'data_bucket'},
+                'test_id',
+                'test.png',
+                'test_trace_id'
+            )
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_trace_id(self, id, filename, trace_id):
+        s3_client = boto3.client(
+            's3',
+            region_name='us-east-1',
+            aws_access_key_id='dummy',
+            aws_secret_access_key='dummy',
+            config=Config(signature_version='s3v4')
+        )
+        actual = metadata_creator.create_pre_signed_url_for_put(id, filename, s3_client, trace_id)
+        assert actual['headers'] == {'x-amz-meta-trace-id': trace_id}
+        # trace idのHeaderも署名の対象になっている
+        assert 'x-amz-meta-trace-id' in parse_qs(urlparse(actual['url']).query)['X-Amz-SignedHeaders'][0]
+
 
 class TestMain(object):
     @pytest.mark.parametrize(
@@ -235,7 +266,9 @@ class TestMain(object):
                     'id': 'test_id',
                     'filename': 'test.png',
                     'isUploaded': False,
-                    'createdAt': 1554120000000
+                    'createdAt': 1554120000000,
+                    'traceId': 'test_id',
+                    'uploadUrlIssuedAt': 1554120000000
                 }
             )
         ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
@@ -250,4 +283,138 @@ class TestMain(object):
         assert set(actual.keys()) == {'metadata', 'preSignedUrl'}
         assert actual['metadata'] == expected_metadata
         assert actual['preSignedUrl']['id'] == id
+        assert actual['preSignedUrl']['headers'] == {'x-amz-meta-trace-id': id}
         assert actual['preSignedUrl']['url'].find(f'http://localhost:4572/{bucket_name}/images/{id}/{filename}?') == 0
+
+
+class TestGetAndValidateFileNames(object):
+    @pytest.mark.parametrize(
+        'body', [
+            ({}),
+            ({'filenames': 'test.png'}),
+            ({'filenames': []}),
+            ({'filenames': ['test.png'] * (metadata_creator.MAX_BATCH_SIZE + 1)})
+        ]
+    )
+    def test_exception(self, body):
+        with pytest.raises(metadata_creator.ValidationError):
+            metadata_creator.get_and_validate_file_names(body)
+
+    @pytest.mark.parametrize(
+        'body, expected', [
+            ({'filenames': ['test.png']}, ['test.png']),
+            ({'filenames': ['test.png', 'test/.png', 1]}, ['test.png', 'test/.png', 1])
+        ]
+    )
+    def test_normal(self, body, expected):
+        actual = metadata_creator.get_and_validate_file_names(body)
+        assert actual == expected
+
+
+class TestPutMetadataItems(object):
+    @pytest.mark.parametrize(
+        'dynamodb, set_environ, table_name, count', [
+            (
+                [
+                    ['data_table']
+                ],
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                },
+                'data_table',
+                0
+            ),
+            (
+                [
+                    ['data_table']
+                ],
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                },
+                'data_table',
+                60
+            )
+        ], indirect=['dynamodb', 'set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self, dynamodb, table_name, count):
+        metadata_items = [
+            {
+                'id': f'test_id_{i:02}',
+                'filename': 'test.png',
+                'isUploaded': False,
+                'createdAt': 1234567890
+            } for i in range(count)
+        ]
+        metadata_creator.put_metadata_items(metadata_items, dynamodb)
+
+        table = dynamodb.Table(table_name)
+        resp = table.scan()
+        assert sorted(resp['Items'], key=lambda x: x['id']) == metadata_items
+
+
+class TestCreateMetadataBatch(object):
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, table_name, bucket_name, event', [
+            (
+                [
+                    ['data_table']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'DATA_BUCKET_NAME': 'data_bucket'
+                },
+                'data_table',
+                'data_bucket',
+                {
+                    'resource': '/metadata/batch',
+                    'headers': {
+                        'Content-Type': 'application/json'
+                    },
+                    'body': json.dumps({'filenames': ['test_01.png', 'test/.png', None, 'test_02.png']})
+                }
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    @freeze_time('2019/04/01 12:00:00+00:00')
+    def test_normal(self, monkeypatch, s3_client, dynamodb, table_name, bucket_name, event):
+        ids = iter(['test_id_01', 'test_trace_id_01', 'test_id_02', 'test_trace_id_02'])
+        monkeypatch.setattr(metadata_creator, 'uuid4', lambda: next(ids))
+        status_code, raw_actual = metadata_creator.main(event, dynamodb_resouce=dynamodb, s3_client=s3_client)
+        actual = json.loads(raw_actual)
+        assert status_code == 200
+        assert set(actual.keys()) == {'metadata', 'preSignedUrls', 'errors'}
+        assert actual['metadata'] == [
+            {
+                'id': 'test_id_01', 'filename': 'test_01.png', 'isUploaded': False, 'createdAt': 1554120000000,
+                'traceId': 'test_trace_id_01', 'uploadUrlIssuedAt': 1554120000000
+            },
+            {
+                'id': 'test_id_02', 'filename': 'test_02.png', 'isUploaded': False, 'createdAt': 1554120000000,
+                'traceId': 'test_trace_id_02', 'uploadUrlIssuedAt': 1554120000000
+            }
+        ]
+        assert [x['id'] for x in actual['preSignedUrls']] == ['test_id_01', 'test_id_02']
+        assert [x['headers'] for x in actual['preSignedUrls']] == [
+            {'x-amz-meta-trace-id': 'test_trace_id_01'}, {'x-amz-meta-trace-id': 'test_trace_id_02'}
+        ]
+        assert actual['preSignedUrls'][0]['url'].find(
+            f'http://localhost:4572/{bucket_name}/images/test_id_01/test_01.png?') == 0
+        assert [(x['index'], x['filename']) for x in actual['errors']] == [(1, 'test/.png'), (2, None)]
+
+        resp = dynamodb.Table(table_name).scan()
+        assert sorted(resp['Items'], key=lambda x: x['id']) == actual['metadata']
+
+    @pytest.mark.parametrize(
+        'event', [
+            ({'resource': '/metadata/batch', 'headers': {'Content-Type': 'text/plain'}, 'body': '{}'}),
+            ({'resource': '/metadata/batch', 'headers': {'Content-Type': 'application/json'}, 'body': 'hoge'}),
+            ({'resource': '/metadata/batch', 'headers': {'Content-Type': 'application/json'}, 'body': '{}'})
+        ]
+    )
+    def test_bad_request(self, event):
+        status_code, raw_actual = metadata_creator.main(event, dynamodb_resouce=None, s3_client=None)
+        assert status_code == 400
+        assert set(json.loads(raw_actual).keys()) == {'message'}
@@ -0,0 +1,215 @@
+import json
+from io import BytesIO
+
+import pytest
+from freezegun import freeze_time
+from PIL import Image
+
+import image_processor
+from pipeline import records
+
+
+def create_sns_event(bucket_name, key, size):
+    message = {
+        'Records': [
+            {
+                's3': {
+                    'bucket': {'name': bucket_name},
+                    'object': {'key': key, 'size': size}
+                }
+            }
+        ]
+    }
+    return {'Records': [{'Sns': {'Message': json.dumps(message)}}]}
+
+
+def create_image_bytes(width, height, format='PNG'):
+    io = BytesIO()
+    Image.new('RGB', (width, height), (255, 0, 0)).save(io, format=format)
+    return io.getvalue()
+
+
+class TestCreateUpdateOption(object):
+    @pytest.mark.parametrize(
+        'id, size, width, height, thumbnail_keys, expected', [
+            (
+                'test_id',
+                100,
+                640,
+                480,
+                {'250': 'thumbnails/test_id/dog.png'},
+                {
+                    'Key': {'id': 'test_id'},
+                    'ReturnValues': 'ALL_NEW',
+                    'UpdateExpression': (
+                        'SET #size = :size, #width = :width, #height = :height, '
+                        '#updatedAt = :updatedAt, #isUploaded = :isUploaded, #hasThumbnail = :hasThumbnail, '
+                        '#thumbnailKeys = :thumbnailKeys, #analyzedAt = :analyzedAt, '
+                        '#thumbnailCreatedAt = :thumbnailCreatedAt'
+                    ),
+                    'ExpressionAttributeNames': {
+                        '#size': 'size',
+                        '#width': 'width',
+                        '#height': 'height',
+                        '#updatedAt': 'updatedAt',
+                        '#isUploaded': 'isUploaded',
+                        '#hasThumbnail': 'hasThumbnail',
+                        '#thumbnailKeys': 'thumbnailKeys',
+                        '#analyzedAt': 'analyzedAt',
+                        '#thumbnailCreatedAt': 'thumbnailCreatedAt'
+                    },
+                    'ExpressionAttributeValues': {
+                        ':size': 100,
+                        ':width': 640,
+                        ':height': 480,
+                        ':updatedAt': 1554120000000,
+                        ':isUploaded': True,
+                        ':hasThumbnail': True,
+                        ':thumbnailKeys': {'250': 'thumbnails/test_id/dog.png'},
+                        ':analyzedAt': 1554120000000,
+                        ':thumbnailCreatedAt': 1554120000000
+                    }
+                }
+            )
+        ]
+    )
+    @freeze_time('2019/04/01 12:00:00+00:00')
+    def test_normal(self, id, size, width, height, thumbnail_keys, expected):
+        actual = image_processor.create_update_option(id, size, width, height, thumbnail_keys)
+        del actual['ConditionExpression']
+        assert actual == expected
+
+
+class TestMain(object):
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name, id, width, height', [
+            (
+                [
+                    ['data_table', 'single data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'THUMBNAIL_SIZE': '50'
+                },
+                'data_bucket',
+                '34d4b1ab-edfb-4b21-83e9-642e2f623345',
+                200,
+                100
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_normal(self, s3_client, dynamodb, bucket_name, id, width, height):
+        key = f'images/{id}/dog.png'
+        raw_bytes = create_image_bytes(width, height)
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=raw_bytes)
+
+        event = create_sns_event(bucket_name, key, len(raw_bytes))
+        image_processor.main(event, s3_client=s3_client, dynamodb_resouce=dynamodb)
+
+        item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+        assert item['size'] == len(raw_bytes)
+        assert (item['width'], item['height']) == (width, height)
+        assert item['isUploaded'] is True
+        assert item['hasThumbnail'] is True
+        assert item['thumbnailKeys'] == {'50': f'thumbnails/{id}/dog.png'}
+
+        resp = s3_client.get_object(Bucket=bucket_name, Key=f'thumbnails/{id}/dog.png')
+        assert Image.open(BytesIO(resp['Body'].read())).size == (50, 50)
+
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name, id', [
+            (
+                [
+                    ['data_table', 'single data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'THUMBNAIL_SIZE': '50'
+                },
+                'data_bucket',
+                '34d4b1ab-edfb-4b21-83e9-642e2f623345'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_upload_failure(self, monkeypatch, s3_client, dynamodb, bucket_name, id):
+        """
+        サムネイルのアップロードに失敗した場合は、metadataを更新しない
+        """
+        key = f'images/{id}/dog.png'
+        raw_bytes = create_image_bytes(200, 100)
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=raw_bytes)
+
+        def put_object(**kwargs):
+            raise ValueError('upload failed')
+        monkeypatch.setattr(s3_client, 'put_object', put_object)
+
+        event = create_sns_event(bucket_name, key, len(raw_bytes))
+        with pytest.raises(records.RecordProcessingError):
+            image_processor.main(event, s3_client=s3_client, dynamodb_resouce=dynamodb)
+
+        item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+        assert {'hasThumbnail', 'thumbnailKeys', 'thumbnailCreatedAt', 'analyzedAt'} & set(item.keys()) == set()
+
+
+class TestIdempotency(object):
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name, processed_stages, expected_updates', [
+            (
+                [
+                    ['data_table', 'single data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'THUMBNAIL_SIZE': '50'
+                },
+                'data_bucket',
+                processed_stages,
+                expected_updates
+            ) for processed_stages, expected_updates in [
+                ([], 1),
+                (['analyzer'], 1),
+                (['analyzer', 'thumbnail'], 0)
+            ]
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_normal(self, monkeypatch, s3_client, dynamodb, bucket_name, processed_stages, expected_updates):
+        """
+        全ての段階で処理済みの場合だけ、metadataを更新せずに成功とする
+        """
+        id = '34d4b1ab-edfb-4b21-83e9-642e2f623345'
+        key = f'images/{id}/dog.png'
+        raw_bytes = create_image_bytes(200, 100)
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=raw_bytes)
+        processed_object = {'key': key, 'sequencer': '0' * 30 + '0A'}
+        table = dynamodb.Table('data_table')
+        for stage in processed_stages:
+            table.update_item(
+                Key={'id': id},
+                UpdateExpression='SET #processed = :processed',
+                ExpressionAttributeNames={'#processed': f'{stage}ProcessedObject'},
+                ExpressionAttributeValues={':processed': processed_object}
+            )
+        original_update_metadata = image_processor.update_metadata
+        updated = []
+
+        def update_metadata(*args):
+            updated.append(args)
+            return original_update_metadata(*args)
+        monkeypatch.setattr(image_processor, 'update_metadata', update_metadata)
+
+        event = create_sns_event(bucket_name, key, len(raw_bytes))
+        message = json.loads(event['Records'][0]['Sns']['Message'])
+        message['Records'][0]['s3']['object']['sequencer'] = '0A'
+        event['Records'][0]['Sns']['Message'] = json.dumps(message)
+        image_processor.main(event, s3_client=s3_client, dynamodb_resouce=dynamodb)
+
+        assert len(updated) == expected_updates
+        item = table.get_item(Key={'id': id})['Item']
+        assert item['analyzerProcessedObject'] == processed_object
+        assert item['thumbnailProcessedObject'] == processed_object
@@ -0,0 +1,770 @@
+import hashlib
+import json
+import threading
+import time
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageChops
+
+import thumbnail_creator
+from logger.metrics import StageMetrics
+from pipeline import idempotency, records
+
+
+def open_image(width, height, format):
+    io = BytesIO()
+    Image.new('RGB', (width, height), (255, 0, 0)).save(io, format=format)
+    return Image.open(BytesIO(io.getvalue()))
+
+
+def create_noise_image(width, height):
+    return Image.effect_noise((max(width // 8, 1), max(height // 8, 1)), 64).convert('RGB').resize((width, height))
+
+
+def resize_square_canvas(image, size):
+    """
+    元の解像度の正方形を作ってから縮小する、以前の方法
+    """
+    width, height = image.size
+    longest = max(width, height)
+    square_image = Image.new(image.mode, (longest, longest), (0, 0, 0))
+    square_image.paste(image, ((longest - width) // 2, (longest - height) // 2))
+    return square_image.resize((size, size), Image.LANCZOS)
+
+
+class TestGetFittedRange(object):
+    @pytest.mark.parametrize(
+        'offset, length, scale, expected', [
+            (0, 6000, 24.0, (0, 250, 0, 6000)),
+            (1000, 4000, 24.0, (42, 208, 8, 3992)),
+            (999, 1, 8.0, (125, 126, 0, 1))
+        ]
+    )
+    def test_normal(self, offset, length, scale, expected):
+        assert thumbnail_creator.get_fitted_range(offset, length, scale) == expected
+
+
+class TestResizeToSquare(object):
+    @pytest.mark.parametrize(
+        'width, height, size, inner_box', [
+            (6000, 4000, 250, (0, 45, 250, 205)),
+            (4000, 6000, 250, (45, 0, 205, 250)),
+            (1001, 333, 250, (0, 87, 250, 163)),
+            (640, 480, 250, (0, 35, 250, 215)),
+            (300, 300, 250, (0, 0, 250, 250)),
+            (100, 70, 250, (0, 46, 250, 204))
+        ]
+    )
+    def test_equivalent(self, width, height, size, inner_box):
+        """
+        余白との境界から数ピクセル(LANCZOSで余白の黒が混ざる範囲)を除いて、以前の方法と同じ画像になる
+        """
+        image = create_noise_image(width, height)
+        actual = thumbnail_creator.resize_to_square(image, size)
+        expected = resize_square_canvas(image, size)
+        assert actual.size == (size, size)
+        diff = ImageChops.difference(actual, expected).crop(inner_box)
+        assert max(x[1] for x in diff.getextrema()) <= 1
+
+    @pytest.mark.parametrize(
+        'width, height', [
+            (2000, 1),
+            (1, 2000),
+            (1, 1)
+        ]
+    )
+    def test_thin_image(self, width, height):
+        actual = thumbnail_creator.resize_to_square(Image.new('RGB', (width, height), (255, 0, 0)), 250)
+        assert actual.size == (250, 250)
+
+
+class TestDraftImage(object):
+    @pytest.mark.parametrize(
+        'width, height, format, size, expected', [
+            (4000, 3000, 'JPEG', 250, (500, 375)),
+            (3000, 4000, 'JPEG', 250, (375, 500)),
+            (1000, 750, 'JPEG', 250, (500, 375)),
+            (600, 400, 'JPEG', 250, (300, 200)),
+            (200, 100, 'JPEG', 250, (200, 100)),
+            (4000, 3000, 'PNG', 250, (4000, 3000))
+        ]
+    )
+    def test_normal(self, width, height, format, size, expected):
+        image = thumbnail_creator.draft_image(open_image(width, height, format), size)
+        assert image.size == expected
+
+
+class TestGetThumbnailSizes(object):
+    @pytest.mark.parametrize(
+        'set_environ, expected', [
+            ({'THUMBNAIL_SIZE': '250'}, [250]),
+            ({'THUMBNAIL_SIZE': '250', 'THUMBNAIL_SIZES': '64,250,800'}, [800, 250, 64]),
+            ({'THUMBNAIL_SIZES': ' 250, 64 ,250,'}, [250, 64])
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self, expected):
+        assert thumbnail_creator.get_thumbnail_sizes() == expected
+
+    @pytest.mark.parametrize(
+        'set_environ', [
+            {'THUMBNAIL_SIZES': ''},
+            {'THUMBNAIL_SIZES': '64,0'},
+            {'THUMBNAIL_SIZES': 'large'}
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_exception(self):
+        with pytest.raises(ValueError):
+            thumbnail_creator.get_thumbnail_sizes()
+
+
+class TestCreateThumbnails(object):
+    @pytest.mark.parametrize(
+        'set_environ, width, height, format, expected', [
+            ({'THUMBNAIL_SIZE': '250'}, 4000, 3000, 'JPEG', [250]),
+            ({'THUMBNAIL_SIZE': '250'}, 3000, 4000, 'JPEG', [250]),
+            ({'THUMBNAIL_SIZE': '250'}, 200, 100, 'JPEG', [250]),
+            ({'THUMBNAIL_SIZE': '250'}, 1000, 750, 'PNG', [250]),
+            ({'THUMBNAIL_SIZES': '64,250,800'}, 4000, 3000, 'JPEG', [800, 250, 64]),
+            ({'THUMBNAIL_SIZES': '64,250,800'}, 1000, 750, 'PNG', [800, 250, 64])
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self, width, height, format, expected):
+        thumbnails = thumbnail_creator.create_thumbnails(open_image(width, height, format))
+        assert list(thumbnails.keys()) == expected
+        for size, thumbnail in thumbnails.items():
+            assert thumbnail.size == (size, size)
+
+
+class TestCreateThumbnailKey(object):
+    @pytest.mark.parametrize(
+        'size, is_multiple, expected', [
+            (250, False, 'thumbnails/test_id/dog.png'),
+            (250, True, 'thumbnails/test_id/250/dog.png')
+        ]
+    )
+    def test_normal(self, size, is_multiple, expected):
+        assert thumbnail_creator.create_thumbnail_key('test_id', 'dog', size, is_multiple) == expected
+
+
+class TestCreateThumbnailKeys(object):
+    @pytest.mark.parametrize(
+        'set_environ, sizes, expected', [
+            ({}, [250], {250: 'thumbnails/test_id/dog.png'}),
+            (
+                {'THUMBNAIL_FORMAT': 'WEBP'},
+                [800, 64],
+                {800: 'thumbnails/test_id/800/dog.webp', 64: 'thumbnails/test_id/64/dog.webp'}
+            )
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self, sizes, expected):
+        actual = thumbnail_creator.create_thumbnail_keys('test_id', 'dog', sizes)
+        assert actual == expected
+
+
+class TestUploadThumbnails(object):
+    @pytest.mark.parametrize(
+        'create_s3_bucket, bucket_name, sizes, expected', [
+            (
+                'data_bucket',
+                'data_bucket',
+                [250],
+                {'250': 'thumbnails/test_id/dog.png'}
+            ),
+            (
+                'data_bucket',
+                'data_bucket',
+                [800, 250, 64],
+                {
+                    '800': 'thumbnails/test_id/800/dog.png',
+                    '250': 'thumbnails/test_id/250/dog.png',
+                    '64': 'thumbnails/test_id/64/dog.png'
+                }
+            )
+        ], indirect=['create_s3_bucket']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket')
+    def test_normal(self, s3_client, bucket_name, sizes, expected):
+        thumbnails = {x: Image.new('RGB', (x, x), (255, 0, 0)) for x in sizes}
+        actual = thumbnail_creator.upload_thumbnails('test_id', 'dog', bucket_name, thumbnails, s3_client)
+        assert actual == expected
+        for size, key in actual.items():
+            resp = s3_client.get_object(Bucket=bucket_name, Key=key)
+            assert resp['ContentType'] == 'image/png'
+            assert Image.open(BytesIO(resp['Body'].read())).size == (int(size), int(size))
+
+    @pytest.mark.parametrize(
+        'create_s3_bucket, set_environ, bucket_name, expected_key, expected_content_type, expected_format', [
+            (
+                'data_bucket',
+                {'THUMBNAIL_FORMAT': 'WEBP', 'THUMBNAIL_QUALITY': '80'},
+                'data_bucket',
+                'thumbnails/test_id/dog.webp',
+                'image/webp',
+                'WEBP'
+            ),
+            (
+                'data_bucket',
+                {'THUMBNAIL_FORMAT': 'JPEG'},
+                'data_bucket',
+                'thumbnails/test_id/dog.jpg',
+                'image/jpeg',
+                'JPEG'
+            )
+        ], indirect=['create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_format(self, s3_client, bucket_name, expected_key, expected_content_type, expected_format):
+        thumbnails = {250: Image.new('RGB', (250, 250), (255, 0, 0))}
+        actual = thumbnail_creator.upload_thumbnails('test_id', 'dog', bucket_name, thumbnails, s3_client)
+        assert actual == {'250': expected_key}
+        resp = s3_client.get_object(Bucket=bucket_name, Key=expected_key)
+        assert resp['ContentType'] == expected_content_type
+        assert Image.open(BytesIO(resp['Body'].read())).format == expected_format
+
+
+class TestGetSaveOption(object):
+    @pytest.mark.parametrize(
+        'set_environ, expected', [
+            ({}, {'format': 'PNG'}),
+            (
+                {'THUMBNAIL_FORMAT': 'png', 'THUMBNAIL_QUALITY': '80', 'THUMBNAIL_PNG_COMPRESS_LEVEL': '9'},
+                {'format': 'PNG', 'compress_level': 9}
+            ),
+            (
+                {'THUMBNAIL_FORMAT': 'JPEG', 'THUMBNAIL_QUALITY': '85', 'THUMBNAIL_OPTIMIZE': 'true'},
+                {'format': 'JPEG', 'quality': 85, 'optimize': True}
+            ),
+            (
+                {'THUMBNAIL_FORMAT': 'webp', 'THUMBNAIL_QUALITY': '80', 'THUMBNAIL_OPTIMIZE': 'true'},
+                {'format': 'WEBP', 'quality': 80}
+            )
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self, expected):
+        assert thumbnail_creator.get_save_option() == expected
+
+    @pytest.mark.parametrize(
+        'set_environ', [
+            {'THUMBNAIL_FORMAT': 'GIF'}
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_exception(self):
+        with pytest.raises(ValueError):
+            thumbnail_creator.get_save_option()
+
+
+class TestConvertImageToBytes(object):
+    @pytest.mark.parametrize(
+        'mode, save_option, expected', [
+            ('RGB', None, 'PNG'),
+            ('RGBA', {'format': 'PNG', 'compress_level': 1}, 'PNG'),
+            ('RGBA', {'format': 'JPEG', 'quality': 80}, 'JPEG'),
+            ('P', {'format': 'JPEG'}, 'JPEG'),
+            ('RGBA', {'format': 'WEBP', 'quality': 80}, 'WEBP')
+        ]
+    )
+    def test_normal(self, mode, save_option, expected):
+        raw_bytes = thumbnail_creator.convert_image_to_bytes(Image.new(mode, (64, 64)), save_option)
+        image = Image.open(BytesIO(raw_bytes))
+        assert image.format == expected
+        assert image.size == (64, 64)
+
+
+def create_sns_event(bucket_name, *keys):
+    message = {'Records': [{'s3': {'bucket': {'name': bucket_name}, 'object': {'key': x}}} for x in keys]}
+    return {'Records': [{'Sns': {'Message': json.dumps(message)}}]}
+
+
+class TestMain(object):
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'THUMBNAIL_SIZE': '50',
+                    'MAX_CONCURRENT_RECORDS': '2'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_partial_failure(self, s3_client, dynamodb, bucket_name):
+        """
+        処理に失敗するRecordがあっても、他のRecordは処理される
+        """
+        objects = [
+            ('images/34d4b1ab-edfb-4b21-83e9-642e2f623345/dog.png', 'PNG'),
+            ('images/8d2a4a6f-0bd3-4a56-b4d1-5d9ec1a1c1f4/cat.txt', None),
+            ('images/e6bbfdce-5e2d-4088-a516-b088088aa95c/bird.jpg', 'JPEG')
+        ]
+        for key, format in objects:
+            if format is None:
+                body = b'not an image'
+            else:
+                io = BytesIO()
+                Image.new('RGB', (200, 100), (255, 0, 0)).save(io, format=format)
+                body = io.getvalue()
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+        event = create_sns_event(bucket_name, *[key for key, _ in objects])
+
+        with pytest.raises(records.RecordProcessingError) as e:
+            thumbnail_creator.main(event, s3_client=s3_client, dynamodb_resouce=dynamodb)
+
+        assert [(x['key'], x['succeeded']) for x in e.value.results] == [
+            (objects[0][0], True),
+            (objects[1][0], False),
+            (objects[2][0], True)
+        ]
+        table = dynamodb.Table('data_table')
+        succeeded = [('34d4b1ab-edfb-4b21-83e9-642e2f623345', 'dog'), ('e6bbfdce-5e2d-4088-a516-b088088aa95c', 'bird')]
+        for id, name in succeeded:
+            item = table.get_item(Key={'id': id})['Item']
+            assert item['hasThumbnail'] is True
+            assert item['thumbnailKeys'] == {'50': f'thumbnails/{id}/{name}.png'}
+        failed = table.get_item(Key={'id': '8d2a4a6f-0bd3-4a56-b4d1-5d9ec1a1c1f4'})['Item']
+        assert 'thumbnailKeys' not in failed
+
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'THUMBNAIL_SIZE': '50'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_upload_failure(self, monkeypatch, s3_client, dynamodb, bucket_name):
+        """
+        サムネイルのアップロードに失敗した場合は、サムネイルがあることをmetadataに記録しない
+        """
+        id = '34d4b1ab-edfb-4b21-83e9-642e2f623345'
+        key = f'images/{id}/dog.png'
+        io = BytesIO()
+        Image.new('RGB', (200, 100), (255, 0, 0)).save(io, format='PNG')
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=io.getvalue())
+
+        def put_object(**kwargs):
+            raise ValueError('upload failed')
+        monkeypatch.setattr(s3_client, 'put_object', put_object)
+
+        with pytest.raises(records.RecordProcessingError):
+            thumbnail_creator.main(create_sns_event(bucket_name, key), s3_client=s3_client, dynamodb_resouce=dynamodb)
+
+        item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+        assert {'hasThumbnail', 'thumbnailKeys', 'thumbnailCreatedAt'} & set(item.keys()) == set()
+
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data'],
+                    ['content_hash_table']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'CONTENT_HASH_TABLE_NAME': 'content_hash_table',
+                    'THUMBNAIL_SIZE': '50',
+                    'MAX_CONCURRENT_RECORDS': '2'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_thread_safe_client(self, monkeypatch, s3_client, dynamodb, bucket_name):
+        """
+        Recordごとのスレッドでは、スレッドセーフではないServiceResourceのTableを使わない
+        """
+        ids = ['34d4b1ab-edfb-4b21-83e9-642e2f623345', 'e6bbfdce-5e2d-4088-a516-b088088aa95c']
+        io = BytesIO()
+        Image.new('RGB', (200, 100), (255, 0, 0)).save(io, format='PNG')
+        for id in ids:
+            s3_client.put_object(Bucket=bucket_name, Key=f'images/{id}/dog.png', Body=io.getvalue())
+        event = create_sns_event(bucket_name, *[f'images/{id}/dog.png' for id in ids])
+        message = json.loads(event['Records'][0]['Sns']['Message'])
+        for record in message['Records']:
+            record['s3']['object']['eTag'] = 'etag_01'
+        event['Records'][0]['Sns']['Message'] = json.dumps(message)
+
+        def table(*args):
+            raise AssertionError('ServiceResource.Table is called in a worker thread.')
+        monkeypatch.setattr(dynamodb, 'Table', table)
+        thumbnail_creator.main(event, s3_client=s3_client, dynamodb_resouce=dynamodb)
+        monkeypatch.undo()
+
+        for id in ids:
+            item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+            assert item['thumbnailProcessedObject'] == {'key': f'images/{id}/dog.png', 'eTag': 'etag_01'}
+
+
+class TestRunConcurrently(object):
+    def test_normal(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def task(value):
+            # 2つの処理が同時に実行されていなければ、Barrierがタイムアウトする
+            barrier.wait()
+            return value
+        actual = thumbnail_creator.run_concurrently(lambda: task(1), lambda: task(2))
+        assert actual == [1, 2]
+
+    def test_exception(self):
+        finished = []
+
+        def slow_task():
+            time.sleep(0.05)
+            finished.append(True)
+
+        def failed_task():
+            raise ValueError('error')
+        with pytest.raises(ValueError):
+            thumbnail_creator.run_concurrently(failed_task, slow_task)
+        # 例外を送出する前に、残りの処理が終わるのを待っている
+        assert finished == [True]
+
+    def test_single_task(self):
+        """
+        処理が1つだけの場合は、スレッドを作らずに呼び出したスレッドで実行する
+        """
+        actual = thumbnail_creator.run_concurrently(threading.get_ident)
+        assert actual == [threading.get_ident()]
+
+
+class TestDecodeWithContentHashItem(object):
+    @pytest.mark.parametrize(
+        'set_environ', [
+            {
+                'CONTENT_HASH_TABLE_NAME': 'content_hash_table',
+                'THUMBNAIL_SIZE': '50'
+            }
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self, monkeypatch):
+        barrier = threading.Barrier(2, timeout=5)
+        original_decode_image = thumbnail_creator.decode_image
+
+        def decode_image(*args):
+            # デコードと処理結果の取得が同時に実行されていなければ、Barrierがタイムアウトする
+            barrier.wait()
+            return original_decode_image(*args)
+
+        def fetch_content_hash_item(*args):
+            barrier.wait()
+            return {'contentHash': 'hash'}
+        monkeypatch.setattr(thumbnail_creator, 'decode_image', decode_image)
+        monkeypatch.setattr(thumbnail_creator, 'fetch_content_hash_item', fetch_content_hash_item)
+        image = Image.new('RGB', (200, 100), (255, 0, 0))
+        decoded, content_hash_item = thumbnail_creator.decode_with_content_hash_item(
+            image, 'hash', None, StageMetrics()
+        )
+        assert decoded.size == (200, 100)
+        assert content_hash_item == {'contentHash': 'hash'}
+
+    @pytest.mark.parametrize('set_environ', [{'THUMBNAIL_SIZE': '50'}], indirect=['set_environ'])
+    @pytest.mark.usefixtures('set_environ')
+    def test_without_content_hash_table(self, monkeypatch):
+        """
+        ハッシュ値との対応を記録しない場合は、デコードだけを行う
+        """
+        def fetch_content_hash_item(*args):
+            raise AssertionError('fetch_content_hash_item is called.')
+        monkeypatch.delenv('CONTENT_HASH_TABLE_NAME', raising=False)
+        monkeypatch.setattr(thumbnail_creator, 'fetch_content_hash_item', fetch_content_hash_item)
+        image = Image.new('RGB', (200, 100), (255, 0, 0))
+        decoded, content_hash_item = thumbnail_creator.decode_with_content_hash_item(
+            image, 'hash', None, StageMetrics()
+        )
+        assert decoded.size == (200, 100)
+        assert content_hash_item is None
+
+
+class TestIdempotency(object):
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'THUMBNAIL_SIZE': '50'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_normal(self, monkeypatch, s3_client, dynamodb, bucket_name):
+        """
+        同じEventや古いEventが届いた場合は、サムネイルを生成せず、metadataも更新せずに成功とする
+        (画像のダウンロードは処理済みかどうかの確認と並列に始まる)
+        """
+        id = '34d4b1ab-edfb-4b21-83e9-642e2f623345'
+        key = f'images/{id}/dog.png'
+        io = BytesIO()
+        Image.new('RGB', (200, 100), (255, 0, 0)).save(io, format='PNG')
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=io.getvalue())
+        original_upload_thumbnails = thumbnail_creator.upload_thumbnails
+        uploaded = []
+
+        def upload_thumbnails(*args):
+            uploaded.append(args)
+            return original_upload_thumbnails(*args)
+        monkeypatch.setattr(thumbnail_creator, 'upload_thumbnails', upload_thumbnails)
+
+        def create_event(e_tag):
+            event = create_sns_event(bucket_name, key)
+            message = json.loads(event['Records'][0]['Sns']['Message'])
+            message['Records'][0]['s3']['object']['eTag'] = e_tag
+            event['Records'][0]['Sns']['Message'] = json.dumps(message)
+            return event
+
+        thumbnail_creator.main(create_event('etag_01'), s3_client=s3_client, dynamodb_resouce=dynamodb)
+        thumbnail_creator.main(create_event('etag_01'), s3_client=s3_client, dynamodb_resouce=dynamodb)
+        assert len(uploaded) == 1
+        thumbnail_creator.main(create_event('etag_02'), s3_client=s3_client, dynamodb_resouce=dynamodb)
+        assert len(uploaded) == 2
+
+        item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+        assert item['thumbnailProcessedObject'] == {'key': key, 'eTag': 'etag_02'}
+
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'THUMBNAIL_SIZE': '50'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_retry_after_upload_failure(self, monkeypatch, s3_client, dynamodb, bucket_name):
+        """
+        アップロードに失敗したObjectは処理済みとして記録しないので、再配信されたEventで処理し直す
+        """
+        id = '34d4b1ab-edfb-4b21-83e9-642e2f623345'
+        key = f'images/{id}/dog.png'
+        io = BytesIO()
+        Image.new('RGB', (200, 100), (255, 0, 0)).save(io, format='PNG')
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=io.getvalue())
+        event = create_sns_event(bucket_name, key)
+        message = json.loads(event['Records'][0]['Sns']['Message'])
+        message['Records'][0]['s3']['object']['sequencer'] = '0A'
+        event['Records'][0]['Sns']['Message'] = json.dumps(message)
+        original_put_object = s3_client.put_object
+
+        def put_object(**kwargs):
+            raise ValueError('upload failed')
+        monkeypatch.setattr(s3_client, 'put_object', put_object)
+        with pytest.raises(records.RecordProcessingError):
+            thumbnail_creator.main(event, s3_client=s3_client, dynamodb_resouce=dynamodb)
+        item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+        assert 'thumbnailProcessedObject' not in item
+
+        monkeypatch.setattr(s3_client, 'put_object', original_put_object)
+        actual = thumbnail_creator.main(event, s3_client=s3_client, dynamodb_resouce=dynamodb)
+        assert [x['succeeded'] for x in actual] == [True]
+        resp = s3_client.get_object(Bucket=bucket_name, Key=f'thumbnails/{id}/dog.png')
+        assert Image.open(BytesIO(resp['Body'].read())).size == (50, 50)
+        item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+        assert item['thumbnailProcessedObject'] == {'key': key, 'sequencer': '0' * 30 + '0A'}
+
+    @pytest.mark.parametrize(
+        'dynamodb, set_environ', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                }
+            )
+        ], indirect=['dynamodb', 'set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_superseded(self, dynamodb):
+        """
+        処理中により新しいObjectが処理済みになった場合は、古い結果で上書きしない
+        """
+        id = '34d4b1ab-edfb-4b21-83e9-642e2f623345'
+        newer = {'key': f'images/{id}/dog.png', 'sequencer': '0B'}
+        older = {'key': f'images/{id}/dog.png', 'sequencer': '0A'}
+        newer_option = thumbnail_creator.create_update_db_option(id, {'50': 'newer'}, newer)
+        idempotency.update_unless_superseded(thumbnail_creator.update_db, newer_option, dynamodb, newer)
+
+        older_option = thumbnail_creator.create_update_db_option(id, {'50': 'older'}, older)
+        actual = idempotency.update_unless_superseded(thumbnail_creator.update_db, older_option, dynamodb, older)
+        assert actual is None
+        item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+        assert item['thumbnailKeys'] == {'50': 'newer'}
+
+
+class TestGetImageWithHash(object):
+    @pytest.mark.parametrize(
+        'create_s3_bucket, bucket_name', [
+            ('data_bucket', 'data_bucket')
+        ], indirect=['create_s3_bucket']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket')
+    def test_normal(self, monkeypatch, s3_client, bucket_name):
+        # 複数のchunkに分かれて読み込まれる場合を確認する
+        monkeypatch.setattr(thumbnail_creator, 'DOWNLOAD_CHUNK_SIZE', 1024)
+        io = BytesIO()
+        create_noise_image(200, 100).save(io, format='PNG')
+        raw_bytes = io.getvalue()
+        s3_client.put_object(Bucket=bucket_name, Key='images/test_id/dog.png', Body=raw_bytes)
+
+        image, content_hash = thumbnail_creator.get_image_with_hash(bucket_name, 'images/test_id/dog.png', s3_client)
+        assert content_hash == hashlib.sha256(raw_bytes).hexdigest()
+        assert image.size == (200, 100)
+
+
+class TestContentHashDeduplication(object):
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data'],
+                    ['content_hash_table']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'CONTENT_HASH_TABLE_NAME': 'content_hash_table',
+                    'THUMBNAIL_SIZES': '50,20'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_normal(self, monkeypatch, s3_client, dynamodb, bucket_name):
+        """
+        同じ内容の画像は、サムネイルを生成せず、S3にも書き込まずに、内容ごとのKeyをmetadataに記録する。
+        設定が変わった場合は生成し直す
+        """
+        io = BytesIO()
+        Image.new('RGB', (200, 100), (255, 0, 0)).save(io, format='PNG')
+        raw_bytes = io.getvalue()
+        ids = [
+            '34d4b1ab-edfb-4b21-83e9-642e2f623345',
+            '8d2a4a6f-0bd3-4a56-b4d1-5d9ec1a1c1f4',
+            'e6bbfdce-5e2d-4088-a516-b088088aa95c'
+        ]
+        for id in ids:
+            s3_client.put_object(Bucket=bucket_name, Key=f'images/{id}/dog.png', Body=raw_bytes)
+        original_create_thumbnails = thumbnail_creator.create_thumbnails
+        created = []
+
+        def create_thumbnails(image):
+            created.append(image)
+            return original_create_thumbnails(image)
+        monkeypatch.setattr(thumbnail_creator, 'create_thumbnails', create_thumbnails)
+        writes = []
+        for method in ['put_object', 'copy_object']:
+            original = getattr(s3_client, method)
+
+            def write(original=original, **kwargs):
+                writes.append(kwargs['Key'])
+                return original(**kwargs)
+            monkeypatch.setattr(s3_client, method, write)
+
+        def process(id):
+            event = create_sns_event(bucket_name, f'images/{id}/dog.png')
+            thumbnail_creator.main(event, s3_client=s3_client, dynamodb_resouce=dynamodb)
+            return dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+
+        content_hash = hashlib.sha256(raw_bytes).hexdigest()
+        first = process(ids[0])
+        assert len(created) == 1
+        assert len(writes) == 2
+        # idごとのKeyではなく、内容ごとのKeyに置いて、そのKeyをmetadataに記録する
+        assert first['thumbnailKeys']['50'].startswith(f'thumbnails/by-hash/{content_hash}/')
+        assert first['thumbnailKeys']['50'].endswith('/50.png')
+        for size in [50, 20]:
+            resp = s3_client.get_object(Bucket=bucket_name, Key=first['thumbnailKeys'][str(size)])
+            assert Image.open(BytesIO(resp['Body'].read())).size == (size, size)
+
+        second = process(ids[1])
+        assert len(created) == 1
+        assert len(writes) == 2
+        assert second['thumbnailKeys'] == first['thumbnailKeys']
+        assert second['hasThumbnail'] is True
+
+        monkeypatch.setenv('THUMBNAIL_FORMAT', 'JPEG')
+        third = process(ids[2])
+        assert len(created) == 2
+        assert len(writes) == 4
+        assert third['thumbnailKeys']['50'].endswith('/50.jpg')
+
+        content_hash_item = dynamodb.Table('content_hash_table').get_item(Key={'contentHash': content_hash})['Item']
+        assert content_hash_item['thumbnailKeys'] == third['thumbnailKeys']
+        assert (content_hash_item['width'], content_hash_item['height']) == (200, 100)
+
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data'],
+                    ['content_hash_table']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'CONTENT_HASH_TABLE_NAME': 'content_hash_table',
+                    'THUMBNAIL_SIZE': '50'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_reupload(self, s3_client, dynamodb, bucket_name):
+        """
+        同じidで別の画像がアップロードされても、同じ内容の画像には元の画像のサムネイルを使う
+        """
+        ids = ['34d4b1ab-edfb-4b21-83e9-642e2f623345', '8d2a4a6f-0bd3-4a56-b4d1-5d9ec1a1c1f4']
+
+        def process(id, color):
+            io = BytesIO()
+            Image.new('RGB', (200, 100), color).save(io, format='PNG')
+            key = f'images/{id}/dog.png'
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=io.getvalue())
+            thumbnail_creator.main(create_sns_event(bucket_name, key), s3_client=s3_client, dynamodb_resouce=dynamodb)
+            item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+            resp = s3_client.get_object(Bucket=bucket_name, Key=item['thumbnailKeys']['50'])
+            # 正方形の余白ではなく、中央のピクセルの色
+            return Image.open(BytesIO(resp['Body'].read())).convert('RGB').getpixel((25, 25))
+
+        assert process(ids[0], (255, 0, 0)) == (255, 0, 0)
+        assert process(ids[0], (0, 0, 255)) == (0, 0, 255)
+        assert process(ids[1], (255, 0, 0)) == (255, 0, 0)
@@ -0,0 +1,89 @@
+import json
+import logging
+
+import pytest
+
+from logger import event_logger
+
+
+class TestRedact(object):
+    @pytest.mark.parametrize(
+        'value, max_value_length, expected', [
+            (
+                {'headers': {'Authorization': 'token', 'Host': 'example.com'}, 'body': None},
+                None,
+                {'headers': {'Authorization': '***', 'Host': 'example.com'}, 'body': None}
+            ),
+            (
+                {'multiValueHeaders': {'cookie': ['a=b']}, 'Records': [{'body': 'x' * 20}]},
+                10,
+                {'multiValueHeaders': {'cookie': '***'}, 'Records': [{'body': 'xxxxxxxxxx...(20 chars)'}]}
+            ),
+            (
+                {'body': 'x' * 20, 'size': 20},
+                None,
+                {'body': 'x' * 20, 'size': 20}
+            )
+        ]
+    )
+    def test_normal(self, value, max_value_length, expected):
+        actual = event_logger.redact(value, event_logger.get_redacted_keys(), max_value_length)
+        assert actual == expected
+
+
+class TestCreateEventLog(object):
+    @pytest.mark.parametrize(
+        'set_environ, event, expected', [
+            (
+                {},
+                {'body': 'x' * 2000},
+                {'body': 'x' * 1024 + '...(2000 chars)'}
+            ),
+            (
+                {'LOG_EVENT_MAX_SIZE': '20', 'LOG_EVENT_MAX_VALUE_LENGTH': '10'},
+                {'body': 'x' * 20},
+                {'truncated': True, 'size': 35, 'preview': '{"body": "xxxxxxxxxx'}
+            )
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self, event, expected):
+        assert event_logger.create_event_log(event) == expected
+
+
+class TestLogEvent(object):
+    @pytest.mark.parametrize(
+        'set_environ, random_value, expected', [
+            ({}, 0.99, [{'id': 'test_id'}]),
+            ({'LOG_EVENT_SAMPLE_RATE': '0.1'}, 0.05, [{'id': 'test_id'}]),
+            ({'LOG_EVENT_SAMPLE_RATE': '0.1'}, 0.5, []),
+            ({'LOG_EVENT_SAMPLE_RATE': '0'}, 0.0, [])
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self, monkeypatch, caplog, random_value, expected):
+        monkeypatch.setattr(event_logger.random, 'random', lambda: random_value)
+        logger = logging.getLogger('test_event_logger')
+        with caplog.at_level(logging.INFO, logger='test_event_logger'):
+            event_logger.log_event(logger, {'id': 'test_id'})
+        assert [x.event for x in caplog.records] == expected
+
+    @pytest.mark.parametrize(
+        'set_environ', [
+            ({'LOG_EVENT_SAMPLE_RATE': '0', 'LOG_EVENT_MAX_SIZE': '10', 'LOG_EVENT_MAX_VALUE_LENGTH': '10'})
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_error(self, caplog):
+        event = {'headers': {'X-Api-Key': 'key'}, 'body': json.dumps({'filename': 'x' * 100})}
+        logger = logging.getLogger('test_event_logger')
+        with caplog.at_level(logging.INFO, logger='test_event_logger'):
+            try:
+                raise ValueError('test error')
+            except ValueError as e:
+                event_logger.log_error_with_event(logger, f'Exception occurred: {e}', event)
+        # エラーの場合はサンプリングや切り詰めを行わない
+        assert len(caplog.records) == 1
+        assert caplog.records[0].levelname == 'ERROR'
+        assert caplog.records[0].exc_info is not None
+        assert caplog.records[0].event == {'headers': {'X-Api-Key': '***'}, 'body': event['body']}
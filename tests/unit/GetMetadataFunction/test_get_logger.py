@@ -0,0 +1,122 @@
+import io
+import json
+import logging
+import logging.config
+import queue
+
+import pytest
+
+from logger import get_logger
+
+
+@pytest.fixture()
+def reset_logging(monkeypatch):
+    """
+    テストの前後でロギングの設定をやり直せるようにする
+    """
+    monkeypatch.setattr(get_logger, '_configured', False)
+    monkeypatch.setattr(get_logger, '_listener', None)
+    yield
+    logging.config.dictConfig(get_logger.get_logging_config())
+
+
+class TestConfigureLogging(object):
+    @pytest.mark.usefixtures('reset_logging')
+    def test_normal(self, monkeypatch):
+        calls = []
+        original_dict_config = logging.config.dictConfig
+        monkeypatch.setattr(logging.config, 'dictConfig', lambda x: calls.append(x) or original_dict_config(x))
+
+        loggers = [get_logger.get_logger(x) for x in ['index', 'metadata_getter', 'index']]
+        assert len(calls) == 1
+        assert loggers[0] is loggers[2]
+        assert loggers[0].name == 'index'
+
+
+class TestEnableLogQueue(object):
+    @pytest.mark.parametrize(
+        'set_environ', [
+            ({'LOG_QUEUE_ENABLED': 'true'})
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ', 'reset_logging')
+    def test_normal(self, monkeypatch):
+        stream = io.StringIO()
+        original_get_logging_config = get_logger.get_logging_config
+
+        def get_logging_config():
+            config = original_get_logging_config()
+            config['handlers']['consoleHandler']['stream'] = stream
+            return config
+        monkeypatch.setattr(get_logger, 'get_logging_config', get_logging_config)
+        listeners = []
+        original_enable_log_queue = get_logger.enable_log_queue
+        monkeypatch.setattr(get_logger, 'enable_log_queue', lambda: listeners.append(original_enable_log_queue()))
+
+        logger = get_logger.get_logger('test_queue')
+        assert isinstance(logging.getLogger().handlers[0], get_logger.DeferredQueueHandler)
+        logger.info('event', {'id': 'test_id'})
+        try:
+            raise ValueError('test error')
+        except ValueError:
+            logger.error('error', exc_info=True)
+        # Queueに残っているLogを出力してからListenerを止める
+        get_logger.stop_log_queue(listeners[0])
+
+        actual = [json.loads(x) for x in stream.getvalue().splitlines()]
+        assert [(x['name'], x['msg']) for x in actual] == [('test_queue', 'event'), ('test_queue', 'error')]
+        assert actual[0]['args'] == {'id': 'test_id'}
+        assert 'ValueError: test error' in actual[1]['exc_info']
+
+    @pytest.mark.parametrize(
+        'set_environ', [
+            ({'LOG_QUEUE_ENABLED': 'true'})
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ', 'reset_logging')
+    def test_flush(self, monkeypatch):
+        """
+        flush_logsを呼ぶと、Listenerを動かしたままQueueに残っているLogが全て出力される
+        """
+        stream = io.StringIO()
+        original_get_logging_config = get_logger.get_logging_config
+
+        def get_logging_config():
+            config = original_get_logging_config()
+            config['handlers']['consoleHandler']['stream'] = stream
+            return config
+        monkeypatch.setattr(get_logger, 'get_logging_config', get_logging_config)
+
+        logger = get_logger.get_logger('test_queue')
+        listener = get_logger._listener
+
+        def restart():
+            raise AssertionError('listener is restarted.')
+        monkeypatch.setattr(listener, 'start', restart)
+        monkeypatch.setattr(listener, 'stop', restart)
+        for index in range(100):
+            logger.error('error', {'index': index})
+        get_logger.flush_logs()
+        assert len(stream.getvalue().splitlines()) == 100
+
+        logger.info('after flush')
+        get_logger.flush_logs()
+        assert json.loads(stream.getvalue().splitlines()[-1])['msg'] == 'after flush'
+        del listener.start, listener.stop
+        get_logger.stop_log_queue(listener)
+        # 止めた後に呼んでも何もしない
+        get_logger.stop_log_queue(listener)
+        get_logger.flush_logs()
+
+    def test_flush_timeout(self):
+        """
+        Listenerのスレッドが動いていない場合も、timeout秒で戻る
+        """
+        listener = get_logger.FlushableQueueListener(queue.SimpleQueue())
+        assert listener.flush(0.01) is False
+
+    @pytest.mark.usefixtures('reset_logging')
+    def test_flush_without_queue(self):
+        get_logger.get_logger('test_queue')
+        # Queueを使っていない場合は何もしない
+        get_logger.flush_logs()
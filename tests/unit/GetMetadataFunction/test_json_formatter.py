@@ -0,0 +1,56 @@
+import json
+import logging
+import sys
+from decimal import Decimal
+
+import pytest
+
+from logger.json_formatter import JsonLogFormatter
+
+
+def create_record(msg, args=(), exc_info=None, extra=None):
+    record = logging.LogRecord('test', logging.INFO, __file__, 10, msg, args, exc_info)
+    for key, value in (extra or {}).items():
+        setattr(record, key, value)
+    return record
+
+
+class TestJsonLogFormatter(object):
+    @pytest.mark.parametrize(
+        'set_environ', [
+            ({'LAMBDA_REQUEST_ID': 'test_request_id'})
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self):
+        formatter = JsonLogFormatter()
+        record = create_record('event', ({'id': 'test_id', 'size': Decimal(10)},), extra={'stageTimings': {'io': 1.5}})
+        actual = json.loads(formatter.format(record))
+        assert set(actual.keys()) == set(JsonLogFormatter.FIELDS) | {'stageTimings', 'lambda_request_id'}
+        assert actual['msg'] == 'event'
+        assert actual['args'] == {'id': 'test_id', 'size': '10'}
+        assert actual['levelname'] == 'INFO'
+        assert actual['stageTimings'] == {'io': 1.5}
+        assert actual['lambda_request_id'] == 'test_request_id'
+
+    def test_levelname(self):
+        # CloudWatch LogsのMetricFilterは'"levelname": "ERROR"'で検索している
+        record = create_record('error')
+        record.levelname = 'ERROR'
+        assert '"levelname": "ERROR"' in JsonLogFormatter().format(record)
+
+    def test_exc_info(self):
+        try:
+            raise ValueError('test error')
+        except ValueError:
+            record = create_record('error', exc_info=sys.exc_info())
+        actual = json.loads(JsonLogFormatter().format(record))
+        assert 'ValueError: test error' in actual['exc_info']
+
+    def test_unserializable(self):
+        circular = {}
+        circular['self'] = circular
+        record = create_record('event', ({(1, 2): 'tuple key'},), extra={'circular': circular})
+        actual = json.loads(JsonLogFormatter().format(record))
+        assert actual['args'] == str({(1, 2): 'tuple key'})
+        assert isinstance(actual['circular'], str)
@@ -0,0 +1,148 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from logger.json_formatter import JsonLogFormatter
+from logger.metrics import StageMetrics, create_metric_name
+
+
+class TestCreateMetricName(object):
+    @pytest.mark.parametrize(
+        'stage, suffix, expected', [
+            ('download', 'Time', 'downloadTime'),
+            ('update_db', 'Time', 'updateDbTime'),
+            ('pre_sign', 'Bytes', 'preSignBytes')
+        ]
+    )
+    def test_normal(self, stage, suffix, expected):
+        assert create_metric_name(stage, suffix) == expected
+
+
+class TestStage(object):
+    def test_normal(self):
+        metrics = StageMetrics()
+        with metrics.stage('sleep'):
+            time.sleep(0.01)
+        assert set(metrics.timings.keys()) == {'sleep'}
+        assert metrics.timings['sleep'] >= 10
+
+    def test_exception(self):
+        metrics = StageMetrics()
+        with pytest.raises(ValueError):
+            with metrics.stage('error'):
+                raise ValueError('error')
+        assert set(metrics.timings.keys()) == {'error'}
+
+    def test_concurrent(self):
+        """
+        並列に計測した同じ段階の時間とbyte数は合計される
+        """
+        metrics = StageMetrics()
+        barrier = threading.Barrier(2, timeout=5)
+
+        def task():
+            with metrics.stage('encode'):
+                barrier.wait()
+                time.sleep(0.01)
+            metrics.add_bytes('upload', 100)
+        threads = [threading.Thread(target=task) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert metrics.timings['encode'] >= 20
+        assert metrics.byte_counts == {'upload': 200}
+
+
+class TestCreateLogExtra(object):
+    @pytest.mark.parametrize(
+        'set_environ', [
+            ({'AWS_LAMBDA_FUNCTION_NAME': 'test_function'})
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_disabled(self):
+        metrics = StageMetrics()
+        metrics.measure('download', lambda: None)
+        metrics.add_bytes('download', 10)
+        actual = metrics.create_log_extra()
+        assert set(actual.keys()) == {'stageTimings', 'stageBytes'}
+        assert actual['stageBytes'] == {'download': 10}
+
+    @pytest.mark.parametrize(
+        'set_environ', [
+            (
+                {
+                    'AWS_LAMBDA_FUNCTION_NAME': 'test_function',
+                    'METRICS_ENABLED': 'true',
+                    'METRICS_NAMESPACE': 'test_namespace'
+                }
+            )
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_enabled(self):
+        metrics = StageMetrics()
+        metrics.measure('download', lambda: None)
+        metrics.add_bytes('download', 10)
+        metrics.set_dimension('ImageFormat', 'PNG')
+        record = logging.LogRecord('test', logging.INFO, __file__, 10, 'processed record', (), None)
+        record.__dict__.update(metrics.create_log_extra())
+        # CloudWatchはLogのトップレベルにある_awsをEMFとして解釈する
+        actual = json.loads(JsonLogFormatter().format(record))
+        assert actual['_aws']['CloudWatchMetrics'] == [
+            {
+                'Namespace': 'test_namespace',
+                'Dimensions': [['FunctionName', 'ImageFormat']],
+                'Metrics': [
+                    {'Name': 'downloadTime', 'Unit': 'Milliseconds'},
+                    {'Name': 'downloadBytes', 'Unit': 'Bytes'}
+                ]
+            }
+        ]
+        assert isinstance(actual['_aws']['Timestamp'], int)
+        assert actual['FunctionName'] == 'test_function'
+        assert actual['ImageFormat'] == 'PNG'
+        assert actual['downloadTime'] == metrics.timings['download']
+        assert actual['downloadBytes'] == 10
+
+    @pytest.mark.parametrize(
+        'set_environ', [
+            ({'METRICS_ENABLED': 'true'})
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_latency(self):
+        """
+        Functionをまたぐ遅延はメトリクスにし、trace idはメトリクスにせずにLogで検索できるようにする
+        """
+        metrics = StageMetrics()
+        metrics.add_latency('end_to_end', 4800)
+        metrics.set_property('traceId', 'test_trace_id')
+        actual = metrics.create_log_extra()
+        assert actual['pipelineLatencies'] == {'end_to_end': 4800}
+        assert actual['traceId'] == 'test_trace_id'
+        assert actual['endToEndLatency'] == 4800
+        assert actual['_aws']['CloudWatchMetrics'][0]['Metrics'] == [
+            {'Name': 'endToEndLatency', 'Unit': 'Milliseconds'}
+        ]
+
+
+class TestEmit(object):
+    @pytest.mark.parametrize(
+        'set_environ, expected', [
+            ({}, 0),
+            ({'METRICS_ENABLED': 'true'}, 1)
+        ], indirect=['set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_normal(self, caplog, expected):
+        metrics = StageMetrics()
+        metrics.measure('get_db', lambda: None)
+        logger = logging.getLogger('test_metrics')
+        with caplog.at_level(logging.INFO, logger='test_metrics'):
+            metrics.emit(logger)
+        assert len(caplog.records) == expected
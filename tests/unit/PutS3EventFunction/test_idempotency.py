@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from pipeline import idempotency
+
+
+class TestGetProcessedObject(object):
+    @pytest.mark.parametrize(
+        's3_object, expected', [
+            (
+                {'key': 'images/test/dog.png', 'eTag': 'etag', 'sequencer': '0055aed6dcd90281e5'},
+                {'key': 'images/test/dog.png', 'sequencer': '0' * 14 + '0055AED6DCD90281E5'}
+            ),
+            (
+                {'key': 'images/test/dog.png', 'eTag': 'etag'},
+                {'key': 'images/test/dog.png', 'eTag': 'etag'}
+            ),
+            ({'key': 'images/test/dog.png'}, None)
+        ]
+    )
+    def test_normal(self, s3_object, expected):
+        actual = idempotency.get_processed_object({'s3': {'object': s3_object}})
+        assert actual == expected
+
+
+class TestIsProcessed(object):
+    @pytest.mark.parametrize(
+        'processed, current, expected', [
+            (None, {'key': 'a', 'sequencer': '02'}, False),
+            ({'key': 'b', 'sequencer': '03'}, {'key': 'a', 'sequencer': '02'}, False),
+            ({'key': 'a', 'sequencer': '01'}, {'key': 'a', 'sequencer': '02'}, False),
+            ({'key': 'a', 'sequencer': '02'}, {'key': 'a', 'sequencer': '02'}, True),
+            ({'key': 'a', 'sequencer': '03'}, {'key': 'a', 'sequencer': '02'}, True),
+            ({'key': 'a', 'eTag': 'x'}, {'key': 'a', 'sequencer': '02'}, False),
+            ({'key': 'a', 'eTag': 'x'}, {'key': 'a', 'eTag': 'x'}, True),
+            ({'key': 'a', 'eTag': 'y'}, {'key': 'a', 'eTag': 'x'}, False)
+        ]
+    )
+    def test_normal(self, processed, current, expected):
+        assert idempotency.is_processed(processed, current) == expected
+
+
+class TestRunUnlessProcessed(object):
+    @pytest.mark.parametrize('processed, expected', [(False, (False, 'image')), (True, (True, None))])
+    def test_normal(self, monkeypatch, processed, expected):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def is_already_processed(*args):
+            # 確認とtaskが同時に実行されていなければ、Barrierがタイムアウトする
+            barrier.wait()
+            return processed
+
+        def task():
+            barrier.wait()
+            return 'image'
+        monkeypatch.setattr(idempotency, 'is_already_processed', is_already_processed)
+        actual = idempotency.run_unless_processed('id', ['analyzer'], {'key': 'a', 'eTag': 'b'}, None, task)
+        assert actual == expected
+
+    def test_processed_with_failed_task(self, monkeypatch):
+        """
+        処理済みの場合は、taskの例外を送出しない
+        """
+        def task():
+            raise ValueError('not found')
+        monkeypatch.setattr(idempotency, 'is_already_processed', lambda *args: True)
+        actual = idempotency.run_unless_processed('id', ['analyzer'], {'key': 'a', 'eTag': 'b'}, None, task)
+        assert actual == (True, None)
+
+    def test_exception(self, monkeypatch):
+        """
+        確認に失敗した場合は、taskが終わるのを待ってから例外を送出する
+        """
+        finished = []
+
+        def is_already_processed(*args):
+            raise ValueError('metadata is not found.')
+
+        def task():
+            time.sleep(0.05)
+            finished.append(True)
+        monkeypatch.setattr(idempotency, 'is_already_processed', is_already_processed)
+        with pytest.raises(ValueError):
+            idempotency.run_unless_processed('id', ['analyzer'], {'key': 'a', 'eTag': 'b'}, None, task)
+        assert finished == [True]
+
+    def test_without_processed_object(self):
+        """
+        RecordのObjectを識別できない場合は、確認せずにtaskを呼び出したスレッドで実行する
+        """
+        actual = idempotency.run_unless_processed('id', ['analyzer'], None, None, threading.get_ident)
+        assert actual == (False, threading.get_ident())
@@ -0,0 +1,386 @@
+import json
+import logging
+from io import BytesIO
+
+import pytest
+from freezegun import freeze_time
+from PIL import Image
+
+import image_analyzer
+from pipeline import idempotency, records
+
+
+def create_image_bytes(width, height, format, **kwargs):
+    io = BytesIO()
+    Image.new('RGB', (width, height), (255, 0, 0)).save(io, format=format, **kwargs)
+    return io.getvalue()
+
+
+def insert_jpeg_segments(raw_bytes, count):
+    """
+    SOIの直後に大きなAPPセグメントを挟み、解像度の情報(SOF)を先頭から遠ざける
+    """
+    payload = b'\x00' * 65000
+    segment = b'\xff\xef' + (len(payload) + 2).to_bytes(2, 'big') + payload
+    return raw_bytes[:2] + segment * count + raw_bytes[2:]
+
+
+def create_sns_event(*messages):
+    return {'Records': [{'Sns': {'Message': json.dumps(x)}} for x in messages]}
+
+
+def create_s3_message(bucket_name, *objects):
+    return {
+        'Records': [
+            {
+                's3': {
+                    'bucket': {'name': bucket_name},
+                    'object': {'key': key, 'size': size}
+                }
+            } for key, size in objects
+        ]
+    }
+
+
+class TestDetectImageFormat(object):
+    @pytest.mark.parametrize(
+        'raw_bytes, expected', [
+            (create_image_bytes(10, 10, 'PNG'), 'PNG'),
+            (create_image_bytes(10, 10, 'JPEG'), 'JPEG'),
+            (create_image_bytes(10, 10, 'GIF'), 'GIF'),
+            (create_image_bytes(10, 10, 'WEBP'), 'WEBP'),
+            (create_image_bytes(10, 10, 'BMP'), 'BMP'),
+            (create_image_bytes(10, 10, 'TIFF'), 'TIFF'),
+            # マジックナンバーの表にない形式は、Pillowで判別する
+            (create_image_bytes(10, 10, 'PPM'), 'PPM'),
+            (create_image_bytes(10, 10, 'TGA'), 'TGA')
+        ]
+    )
+    def test_normal(self, raw_bytes, expected):
+        actual = image_analyzer.detect_image_format(raw_bytes[:64])
+        assert actual == expected
+
+    def test_truncated(self):
+        """
+        Pillowが判別できる形式でも、ヘッダが範囲に収まっていない場合はnullを返す
+        """
+        raw_bytes = create_image_bytes(64, 48, 'ICO')
+        assert image_analyzer.detect_image_format(raw_bytes[:64]) is None
+        assert image_analyzer.detect_image_format(raw_bytes) == 'ICO'
+
+    @pytest.mark.parametrize(
+        'raw_bytes', [
+            (b''),
+            (b'<html></html>'),
+            (b'RIFF\x00\x00\x00\x00WAVEfmt ')
+        ]
+    )
+    def test_exception(self, raw_bytes):
+        with pytest.raises(image_analyzer.UnsupportedImageError):
+            image_analyzer.detect_image_format(raw_bytes)
+
+
+class TestGetWebpResolution(object):
+    @pytest.mark.parametrize(
+        'raw_bytes, expected', [
+            (create_image_bytes(300, 200, 'WEBP'), (300, 200)),
+            (create_image_bytes(300, 200, 'WEBP', lossless=True), (300, 200)),
+            (create_image_bytes(300, 200, 'WEBP', exif=Image.Exif()), (300, 200))
+        ]
+    )
+    def test_normal(self, raw_bytes, expected):
+        actual = image_analyzer.get_webp_resolution(raw_bytes[:64])
+        assert actual == expected
+
+
+class TestProbeImage(object):
+    @pytest.mark.parametrize(
+        'create_s3_bucket, bucket_name, raw_bytes, expected, expected_ranges', [
+            (
+                'data_bucket',
+                'data_bucket',
+                create_image_bytes(640, 480, 'PNG'),
+                (640, 480, 'PNG'),
+                [None]
+            ),
+            (
+                'data_bucket',
+                'data_bucket',
+                create_image_bytes(640, 480, 'JPEG', quality=100) + b'\x00' * 70000,
+                (640, 480, 'JPEG'),
+                ['bytes=0-65535']
+            ),
+            (
+                'data_bucket',
+                'data_bucket',
+                insert_jpeg_segments(create_image_bytes(640, 480, 'JPEG'), 2),
+                (640, 480, 'JPEG'),
+                ['bytes=0-65535', None]
+            ),
+            (
+                'data_bucket',
+                'data_bucket',
+                insert_jpeg_segments(create_image_bytes(640, 480, 'JPEG'), 20),
+                (640, 480, 'JPEG'),
+                ['bytes=0-65535', 'bytes=0-1048575', None]
+            ),
+            # マジックナンバーの表にない形式も、Pillowが判別できれば解像度を読み取る
+            (
+                'data_bucket',
+                'data_bucket',
+                create_image_bytes(640, 480, 'PPM'),
+                (640, 480, 'PPM'),
+                ['bytes=0-65535']
+            ),
+            (
+                'data_bucket',
+                'data_bucket',
+                create_image_bytes(64, 48, 'ICO'),
+                (48, 36, 'ICO'),
+                [None]
+            )
+        ], indirect=['create_s3_bucket']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket')
+    def test_normal(self, monkeypatch, s3_client, bucket_name, raw_bytes, expected, expected_ranges):
+        key = 'images/34d4b1ab-edfb-4b21-83e9-642e2f623345/image'
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=raw_bytes)
+        ranges = []
+        original_get_object = s3_client.get_object
+
+        def get_object(**kwargs):
+            ranges.append(kwargs.get('Range'))
+            return original_get_object(**kwargs)
+        monkeypatch.setattr(s3_client, 'get_object', get_object)
+
+        actual = image_analyzer.probe_image(bucket_name, key, len(raw_bytes), s3_client)
+        assert actual == expected
+        assert ranges == expected_ranges
+
+    @pytest.mark.parametrize(
+        'create_s3_bucket, bucket_name, raw_bytes', [
+            ('data_bucket', 'data_bucket', b'%PDF-1.4' + b'\x00' * 100000),
+            ('data_bucket', 'data_bucket', b'')
+        ], indirect=['create_s3_bucket']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket')
+    def test_exception(self, s3_client, bucket_name, raw_bytes):
+        key = 'images/34d4b1ab-edfb-4b21-83e9-642e2f623345/image'
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=raw_bytes)
+        with pytest.raises(image_analyzer.UnsupportedImageError):
+            image_analyzer.probe_image(bucket_name, key, len(raw_bytes), s3_client)
+
+
+class TestMain(object):
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'MAX_CONCURRENT_RECORDS': '2'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_partial_failure(self, s3_client, dynamodb, bucket_name):
+        """
+        処理に失敗するRecordがあっても、他のRecordは処理される
+        """
+        objects = [
+            ('images/34d4b1ab-edfb-4b21-83e9-642e2f623345/dog.png', create_image_bytes(300, 200, 'PNG')),
+            ('images/8d2a4a6f-0bd3-4a56-b4d1-5d9ec1a1c1f4/cat.txt', b'not an image'),
+            ('images/e6bbfdce-5e2d-4088-a516-b088088aa95c/bird.jpg', create_image_bytes(640, 480, 'JPEG'))
+        ]
+        for key, raw_bytes in objects:
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=raw_bytes)
+        event = create_sns_event(
+            create_s3_message(bucket_name, *[(key, len(raw_bytes)) for key, raw_bytes in objects[:2]]),
+            create_s3_message(bucket_name, (objects[2][0], len(objects[2][1])))
+        )
+
+        with pytest.raises(records.RecordProcessingError) as e:
+            image_analyzer.main(event, s3_client=s3_client, dynamodb_resouce=dynamodb)
+
+        assert [(x['messageId'], x['key'], x['succeeded']) for x in e.value.results] == [
+            (None, objects[0][0], True),
+            (None, objects[1][0], False),
+            (None, objects[2][0], True)
+        ]
+        table = dynamodb.Table('data_table')
+        first = table.get_item(Key={'id': '34d4b1ab-edfb-4b21-83e9-642e2f623345'})['Item']
+        assert (first['width'], first['height']) == (300, 200)
+        third = table.get_item(Key={'id': 'e6bbfdce-5e2d-4088-a516-b088088aa95c'})['Item']
+        assert (third['width'], third['height']) == (640, 480)
+
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'MAX_CONCURRENT_RECORDS': '2'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_thread_safe_client(self, monkeypatch, s3_client, dynamodb, bucket_name):
+        """
+        Recordごとのスレッドでは、スレッドセーフではないServiceResourceのTableを使わない
+        """
+        ids = ['34d4b1ab-edfb-4b21-83e9-642e2f623345', 'e6bbfdce-5e2d-4088-a516-b088088aa95c']
+        raw_bytes = create_image_bytes(300, 200, 'PNG')
+        for id in ids:
+            s3_client.put_object(Bucket=bucket_name, Key=f'images/{id}/dog.png', Body=raw_bytes)
+        message = create_s3_message(bucket_name, *[(f'images/{id}/dog.png', len(raw_bytes)) for id in ids])
+        for record in message['Records']:
+            record['s3']['object']['sequencer'] = '0A'
+
+        def table(*args):
+            raise AssertionError('ServiceResource.Table is called in a worker thread.')
+        monkeypatch.setattr(dynamodb, 'Table', table)
+        image_analyzer.main(create_sns_event(message), s3_client=s3_client, dynamodb_resouce=dynamodb)
+        monkeypatch.undo()
+
+        for id in ids:
+            item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+            assert (item['width'], item['height']) == (300, 200)
+
+
+class TestIdempotency(object):
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_normal(self, monkeypatch, s3_client, dynamodb, bucket_name):
+        """
+        同じEventや古いEventが届いた場合は、metadataを更新せずに成功とする
+        (画像の読み込みは処理済みかどうかの確認と並列に始まる)
+        """
+        key = 'images/34d4b1ab-edfb-4b21-83e9-642e2f623345/dog.png'
+        raw_bytes = create_image_bytes(300, 200, 'PNG')
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=raw_bytes)
+        original_update_metadata = image_analyzer.update_metadata
+        updated = []
+
+        def update_metadata(*args):
+            updated.append(args)
+            return original_update_metadata(*args)
+        monkeypatch.setattr(image_analyzer, 'update_metadata', update_metadata)
+
+        def create_event(sequencer):
+            message = create_s3_message(bucket_name, (key, len(raw_bytes)))
+            message['Records'][0]['s3']['object']['sequencer'] = sequencer
+            return create_sns_event(message)
+
+        image_analyzer.main(create_event('0A'), s3_client=s3_client, dynamodb_resouce=dynamodb)
+        image_analyzer.main(create_event('0A'), s3_client=s3_client, dynamodb_resouce=dynamodb)
+        image_analyzer.main(create_event('09'), s3_client=s3_client, dynamodb_resouce=dynamodb)
+        assert len(updated) == 1
+        image_analyzer.main(create_event('0B'), s3_client=s3_client, dynamodb_resouce=dynamodb)
+        assert len(updated) == 2
+
+        item = dynamodb.Table('data_table').get_item(Key={'id': '34d4b1ab-edfb-4b21-83e9-642e2f623345'})['Item']
+        assert item['analyzerProcessedObject'] == {'key': key, 'sequencer': '0' * 30 + '0B'}
+
+    @pytest.mark.parametrize(
+        'dynamodb, set_environ', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                }
+            )
+        ], indirect=['dynamodb', 'set_environ']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_superseded(self, dynamodb):
+        """
+        処理中により新しいObjectが処理済みになった場合は、古い結果で上書きしない
+        """
+        id = '34d4b1ab-edfb-4b21-83e9-642e2f623345'
+        newer = {'key': f'images/{id}/dog.png', 'sequencer': '0B'}
+        older = {'key': f'images/{id}/dog.png', 'sequencer': '0A'}
+        newer_option = image_analyzer.create_update_option(id, 100, 30, 20, newer)
+        update = image_analyzer.update_metadata
+        assert idempotency.update_unless_superseded(update, newer_option, dynamodb, newer) is not None
+
+        older_option = image_analyzer.create_update_option(id, 200, 60, 40, older)
+        assert idempotency.update_unless_superseded(update, older_option, dynamodb, older) is None
+        item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+        assert (item['width'], item['height']) == (30, 20)
+
+        with pytest.raises(dynamodb.meta.client.exceptions.ConditionalCheckFailedException):
+            option = image_analyzer.create_update_option('4b1ec5d8-bff0-47ce-a42d-f70643abca27', 200, 60, 40)
+            idempotency.update_unless_superseded(update, option, dynamodb, None)
+
+
+class TestPipelineLatency(object):
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                'data_bucket',
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    @freeze_time('2019/04/01 12:00:01+00:00')
+    def test_normal(self, caplog, s3_client, dynamodb, bucket_name):
+        """
+        Objectのtrace idがmetadataと一致し、サムネイルの作成が先に終わっている場合は、全体の遅延を記録する
+        """
+        id = '34d4b1ab-edfb-4b21-83e9-642e2f623345'
+        key = f'images/{id}/dog.png'
+        raw_bytes = create_image_bytes(300, 200, 'PNG')
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=raw_bytes, Metadata={'trace-id': 'test_trace_id'})
+        dynamodb.Table('data_table').update_item(
+            Key={'id': id},
+            UpdateExpression='SET traceId = :traceId, uploadUrlIssuedAt = :issuedAt, thumbnailCreatedAt = :createdAt',
+            ExpressionAttributeValues={
+                ':traceId': 'test_trace_id',
+                ':issuedAt': 1554119990000,
+                ':createdAt': 1554120002000
+            }
+        )
+        message = create_s3_message(bucket_name, (key, len(raw_bytes)))
+        message['Records'][0]['eventTime'] = '2019-04-01T12:00:00.000Z'
+
+        with caplog.at_level(logging.INFO, logger='image_analyzer'):
+            image_analyzer.main(create_sns_event(message), s3_client=s3_client, dynamodb_resouce=dynamodb)
+
+        records = [x for x in caplog.records if x.getMessage().startswith('processed record.')]
+        assert len(records) == 1
+        assert records[0].traceId == 'test_trace_id'
+        assert records[0].pipelineLatencies == {'analyze': 1000, 'upload': 10000, 'end_to_end': 12000}
+        item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+        assert (item['uploadedAt'], item['analyzedAt']) == (1554120000000, 1554120001000)
@@ -1,8 +1,41 @@
+import json
+from functools import partial
+from io import BytesIO
+
 import pytest
+from PIL import Image
 
+import image_analyzer
 import index
 
 
+def create_image_bytes(width, height):
+    io = BytesIO()
+    Image.new('RGB', (width, height), (255, 0, 0)).save(io, format='PNG')
+    return io.getvalue()
+
+
+def create_s3_message(bucket_name, key, size):
+    return json.dumps({'Records': [{'s3': {'bucket': {'name': bucket_name}, 'object': {'key': key, 'size': size}}}]})
+
+
+def receive_sqs_event(sqs_client, queue_url):
+    """
+    Queueから受信したMessageを、LambdaがSQSから呼ばれたときのEventの形式にする
+    """
+    resp = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
+    return {
+        'Records': [
+            {
+                'messageId': x['MessageId'],
+                'receiptHandle': x['ReceiptHandle'],
+                'body': x['Body'],
+                'eventSource': 'aws:sqs'
+            } for x in resp['Messages']
+        ]
+    }
+
+
 class TestHandler(object):
     @pytest.mark.parametrize(
         'error', [
@@ -21,3 +54,93 @@ class TestHandler(object):
     def test_normal(self, monkeypatch):
         monkeypatch.setattr(index, 'main', lambda *_, **__: None)
         index.handler({}, None)
+
+
+class TestSqs(object):
+    @pytest.mark.parametrize(
+        'event, expected', [
+            ({}, False),
+            ({'Records': []}, False),
+            ({'Records': [{'Sns': {'Message': '{}'}}]}, False),
+            ({'Records': [{'messageId': 'a', 'body': '{}', 'eventSource': 'aws:sqs'}]}, True)
+        ]
+    )
+    def test_is_sqs_event(self, event, expected):
+        assert index.is_sqs_event(event) == expected
+
+    @pytest.mark.parametrize(
+        'results, expected', [
+            ([{'messageId': 'a', 'succeeded': True}], {'batchItemFailures': []}),
+            (
+                [
+                    {'messageId': 'a', 'succeeded': False},
+                    {'messageId': 'b', 'succeeded': True},
+                    {'messageId': 'a', 'succeeded': False},
+                    {'messageId': 'c', 'succeeded': False}
+                ],
+                {'batchItemFailures': [{'itemIdentifier': 'a'}, {'itemIdentifier': 'c'}]}
+            )
+        ]
+    )
+    def test_create_batch_item_failures(self, results, expected):
+        assert index.create_batch_item_failures(results) == expected
+
+    @pytest.mark.parametrize(
+        'dynamodb, create_s3_bucket, create_sqs_queue, set_environ, bucket_name', [
+            (
+                [
+                    ['data_table', 'multiple data']
+                ],
+                'data_bucket',
+                'image_event_queue',
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                },
+                'data_bucket'
+            )
+        ], indirect=['dynamodb', 'create_s3_bucket', 'create_sqs_queue', 'set_environ']
+    )
+    @pytest.mark.usefixtures('create_s3_bucket', 'set_environ')
+    def test_batch(self, monkeypatch, s3_client, sqs_client, dynamodb, create_sqs_queue, bucket_name):
+        """
+        SQSからまとめて受け取ったMessageのうち、失敗したものだけをbatchItemFailuresで返す
+        """
+        queue_url = create_sqs_queue
+        keys = {
+            '34d4b1ab-edfb-4b21-83e9-642e2f623345': 'images/34d4b1ab-edfb-4b21-83e9-642e2f623345/dog.png',
+            '8d2a4a6f-0bd3-4a56-b4d1-5d9ec1a1c1f4': 'images/8d2a4a6f-0bd3-4a56-b4d1-5d9ec1a1c1f4/cat.png',
+            'e6bbfdce-5e2d-4088-a516-b088088aa95c': 'images/e6bbfdce-5e2d-4088-a516-b088088aa95c/bird.png'
+        }
+        raw_bytes = create_image_bytes(300, 200)
+        for id in ['34d4b1ab-edfb-4b21-83e9-642e2f623345', 'e6bbfdce-5e2d-4088-a516-b088088aa95c']:
+            s3_client.put_object(Bucket=bucket_name, Key=keys[id], Body=raw_bytes)
+        bodies = {
+            # Raw message deliveryの場合
+            'raw': create_s3_message(bucket_name, keys['34d4b1ab-edfb-4b21-83e9-642e2f623345'], len(raw_bytes)),
+            # SNSの形式のまま配信された場合。画像がアップロードされていないので失敗する
+            'missing': json.dumps({
+                'Type': 'Notification',
+                'Message': create_s3_message(bucket_name, keys['8d2a4a6f-0bd3-4a56-b4d1-5d9ec1a1c1f4'], len(raw_bytes))
+            }),
+            'broken': 'not json',
+            'notification': json.dumps({
+                'Type': 'Notification',
+                'Message': create_s3_message(bucket_name, keys['e6bbfdce-5e2d-4088-a516-b088088aa95c'], len(raw_bytes))
+            })
+        }
+        message_ids = {
+            k: sqs_client.send_message(QueueUrl=queue_url, MessageBody=v)['MessageId'] for k, v in bodies.items()
+        }
+        event = receive_sqs_event(sqs_client, queue_url)
+        assert len(event['Records']) == len(bodies)
+
+        main = partial(image_analyzer.main, s3_client=s3_client, dynamodb_resouce=dynamodb)
+        monkeypatch.setattr(index, 'main', main)
+        actual = index.handler(event, None)
+
+        failed_message_ids = sorted(x['itemIdentifier'] for x in actual['batchItemFailures'])
+        assert failed_message_ids == sorted([message_ids['missing'], message_ids['broken']])
+        table = dynamodb.Table('data_table')
+        for id in ['34d4b1ab-edfb-4b21-83e9-642e2f623345', 'e6bbfdce-5e2d-4088-a516-b088088aa95c']:
+            item = table.get_item(Key={'id': id})['Item']
+            assert (item['width'], item['height']) == (300, 200)
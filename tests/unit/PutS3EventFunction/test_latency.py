@@ -0,0 +1,76 @@
+import pytest
+
+from pipeline import latency
+
+
+class TestGetEventTime(object):
+    @pytest.mark.parametrize(
+        'record, expected', [
+            ({'eventTime': '2019-04-01T12:00:00.512Z'}, 1554120000512),
+            ({'eventTime': '2019-04-01T21:00:00.512+09:00'}, 1554120000512),
+            ({}, None)
+        ]
+    )
+    def test_normal(self, record, expected):
+        assert latency.get_event_time(record) == expected
+
+
+class TestGetPipelineLatencies(object):
+    @pytest.mark.parametrize(
+        'item, trace_id, stages, expected', [
+            # 解析だけが終わっている
+            (
+                {'traceId': 't', 'uploadUrlIssuedAt': 1000, 'uploadedAt': 5000, 'analyzedAt': 5300},
+                't',
+                ['analyze'],
+                {'analyze': 300}
+            ),
+            # 両方が終わっているので、全体の遅延も求める
+            (
+                {
+                    'traceId': 't', 'uploadUrlIssuedAt': 1000, 'uploadedAt': 5000,
+                    'analyzedAt': 5300, 'thumbnailCreatedAt': 5800
+                },
+                't',
+                ['thumbnail'],
+                {'thumbnail': 800, 'upload': 4000, 'end_to_end': 4800}
+            ),
+            (
+                {
+                    'traceId': 't', 'uploadUrlIssuedAt': 1000, 'uploadedAt': 5000,
+                    'analyzedAt': 5300, 'thumbnailCreatedAt': 5800
+                },
+                't',
+                ['analyze', 'thumbnail'],
+                {'analyze': 300, 'thumbnail': 800, 'upload': 4000, 'end_to_end': 4800}
+            ),
+            # サムネイルの作成の時刻は、以前にアップロードされた画像のもの
+            (
+                {
+                    'traceId': 't', 'uploadUrlIssuedAt': 1000, 'uploadedAt': 5000,
+                    'analyzedAt': 5300, 'thumbnailCreatedAt': 4000
+                },
+                't',
+                ['analyze'],
+                {'analyze': 300}
+            ),
+            # 別のURLでアップロードされたので、URLの発行時刻は使わない
+            (
+                {
+                    'traceId': 't', 'uploadUrlIssuedAt': 1000, 'uploadedAt': 5000,
+                    'analyzedAt': 5300, 'thumbnailCreatedAt': 5800
+                },
+                'other',
+                ['analyze'],
+                {'analyze': 300}
+            ),
+            (
+                {'analyzedAt': 5300, 'thumbnailCreatedAt': 5800},
+                None,
+                ['analyze'],
+                {}
+            )
+        ]
+    )
+    def test_normal(self, item, trace_id, stages, expected):
+        assert latency.get_pipeline_latencies(item, trace_id, stages) == expected
@@ -0,0 +1,77 @@
+import filecmp
+import json
+import os
+
+import pytest
+
+from pipeline import records
+
+
+def create_sns_event(*messages):
+    return {'Records': [{'Sns': {'Message': json.dumps(x)}} for x in messages]}
+
+
+def create_s3_message(bucket_name, *objects):
+    return {
+        'Records': [
+            {
+                's3': {
+                    'bucket': {'name': bucket_name},
+                    'object': {'key': key, 'size': size}
+                }
+            } for key, size in objects
+        ]
+    }
+
+
+class TestGetS3Records(object):
+    @pytest.mark.parametrize(
+        'event, expected', [
+            (
+                create_sns_event(create_s3_message('data_bucket', ('images/a/dog.png', 10))),
+                ['images/a/dog.png']
+            ),
+            (
+                create_sns_event(
+                    create_s3_message('data_bucket', ('images/a/dog.png', 10), ('images/b/cat.png', 20)),
+                    {'Event': 's3:TestEvent'},
+                    create_s3_message('data_bucket', ('images/c/bird.png', 30))
+                ),
+                ['images/a/dog.png', 'images/b/cat.png', 'images/c/bird.png']
+            )
+        ]
+    )
+    def test_normal(self, event, expected):
+        messages = records.get_messages(event)
+        actual = [x for _, message in messages for x in records.get_s3_records(message)]
+        assert [records.get_key(x) for x in actual] == expected
+
+    def test_sqs(self):
+        s3_message = create_s3_message('data_bucket', ('images/a/dog.png', 10))
+        event = {
+            'Records': [
+                {'messageId': 'raw', 'body': json.dumps(s3_message), 'eventSource': 'aws:sqs'},
+                {
+                    'messageId': 'notification',
+                    'body': json.dumps({'Type': 'Notification', 'Message': json.dumps(s3_message)}),
+                    'eventSource': 'aws:sqs'
+                }
+            ]
+        }
+        messages = records.get_messages(event)
+        assert [x[0] for x in messages] == ['raw', 'notification']
+        for _, message in messages:
+            assert records.get_s3_records(message) == s3_message['Records']
+
+
+class TestVendoredCopies(object):
+    def test_normal(self):
+        """
+        pipelineはPutS3EventFunctionとCreateThumbnailFunctionに同じものを置いているので、内容が揃っていることを確かめる
+        """
+        src_dir = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src')
+        dirs = [os.path.join(src_dir, x, 'pipeline') for x in ['PutS3EventFunction', 'CreateThumbnailFunction']]
+        names = sorted(x for x in os.listdir(dirs[0]) if x.endswith('.py'))
+        assert names == sorted(x for x in os.listdir(dirs[1]) if x.endswith('.py'))
+        _, mismatch, errors = filecmp.cmpfiles(dirs[0], dirs[1], names, shallow=False)
+        assert (mismatch, errors) == ([], [])
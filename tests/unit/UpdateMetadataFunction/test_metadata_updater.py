@@ -0,0 +1,157 @@
+import json
+
+import boto3
+import pytest
+from botocore.config import Config
+from freezegun import freeze_time
+
+import metadata_updater
+
+
+class TestUpdateMetadata(object):
+    @pytest.mark.parametrize(
+        'set_environ, dynamodb, id, filename, expected', [
+            (
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                },
+                [
+                    ['data_table', 'single data']
+                ],
+                '34d4b1ab-edfb-4b21-83e9-642e2f623345',
+                'cat.png',
+                {
+                    'id': '34d4b1ab-edfb-4b21-83e9-642e2f623345',
+                    'filename': 'cat.png',
+                    'isUploaded': False,
+                    'createdAt': 1566868362512,
+                    'updatedAt': 1554120000000,
+                    'traceId': 'test_trace_id',
+                    'uploadUrlIssuedAt': 1554120000000
+                }
+            ),
+            # filenameを指定しない場合は、trace idとURLの発行時刻だけを更新する
+            (
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                },
+                [
+                    ['data_table', 'single data']
+                ],
+                '34d4b1ab-edfb-4b21-83e9-642e2f623345',
+                None,
+                {
+                    'id': '34d4b1ab-edfb-4b21-83e9-642e2f623345',
+                    'filename': 'dog.png',
+                    'isUploaded': True,
+                    'createdAt': 1566868362512,
+                    'traceId': 'test_trace_id',
+                    'uploadUrlIssuedAt': 1554120000000
+                }
+            ),
+            (
+                {
+                    'DATA_TABLE_NAME': 'data_table'
+                },
+                [
+                    ['data_table', 'single data']
+                ],
+                '4b1ec5d8-bff0-47ce-a42d-f70643abca27',
+                'cat.png',
+                None
+            )
+        ], indirect=['set_environ', 'dynamodb']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    @freeze_time('2019/04/01 12:00:00+00:00')
+    def test_normal(self, monkeypatch, dynamodb, id, filename, expected):
+        monkeypatch.setattr(metadata_updater, 'uuid4', lambda: 'test_trace_id')
+        option = metadata_updater.create_update_option(id, filename)
+        actual = metadata_updater.update_metadata(option, dynamodb)
+        assert actual == expected
+        # 存在しないmetadataは作成されない
+        assert dynamodb.Table('data_table').get_item(Key={'id': id}).get('Item') == expected
+
+
+class TestMain(object):
+    @pytest.mark.parametrize(
+        'set_environ, dynamodb, body, expected_status_code, expected_filename', [
+            (
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'DATA_BUCKET_NAME': 'data_bucket'
+                },
+                [
+                    ['data_table', 'single data']
+                ],
+                json.dumps({'filename': 'cat.png'}),
+                200,
+                'cat.png'
+            ),
+            (
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'DATA_BUCKET_NAME': 'data_bucket'
+                },
+                [
+                    ['data_table', 'single data']
+                ],
+                None,
+                200,
+                'dog.png'
+            ),
+            (
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'DATA_BUCKET_NAME': 'data_bucket'
+                },
+                [
+                    ['data_table', 'single data']
+                ],
+                json.dumps({'filename': 'cat/.png'}),
+                400,
+                None
+            )
+        ], indirect=['set_environ', 'dynamodb']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    @freeze_time('2019/04/01 12:00:00+00:00')
+    def test_normal(self, dynamodb, body, expected_status_code, expected_filename):
+        id = '34d4b1ab-edfb-4b21-83e9-642e2f623345'
+        s3_client = boto3.client('s3', config=Config(signature_version='s3v4'))
+        event = {'pathParameters': {'id': id}, 'body': body}
+        status_code, raw_actual = metadata_updater.main(event, dynamodb_resource=dynamodb, s3_client=s3_client)
+        actual = json.loads(raw_actual)
+        assert status_code == expected_status_code
+        if expected_filename is not None:
+            assert actual['metadata']['filename'] == expected_filename
+            assert actual['preSignedUrl']['id'] == id
+            assert f'/images/{id}/{expected_filename}?' in actual['preSignedUrl']['url']
+            # URLを発行するたびに、trace idとURLの発行時刻を新しくする(アップロードまでの遅延を発行時刻から計測するため)
+            item = dynamodb.Table('data_table').get_item(Key={'id': id})['Item']
+            assert actual['metadata']['traceId'] == item['traceId']
+            assert item['uploadUrlIssuedAt'] == 1554120000000
+            # アップロード時にtrace idのHeaderが必要になる
+            assert actual['preSignedUrl']['headers'] == {'x-amz-meta-trace-id': item['traceId']}
+
+    @pytest.mark.parametrize(
+        'set_environ, dynamodb, body', [
+            (
+                {
+                    'DATA_TABLE_NAME': 'data_table',
+                    'DATA_BUCKET_NAME': 'data_bucket'
+                },
+                [
+                    ['data_table', 'single data']
+                ],
+                body
+            ) for body in [json.dumps({'filename': 'cat.png'}), None]
+        ], indirect=['set_environ', 'dynamodb']
+    )
+    @pytest.mark.usefixtures('set_environ')
+    def test_not_found(self, dynamodb, body):
+        event = {'pathParameters': {'id': '4b1ec5d8-bff0-47ce-a42d-f70643abca27'}, 'body': body}
+        status_code, raw_actual = metadata_updater.main(event, dynamodb_resource=dynamodb, s3_client=None)
+        assert status_code == 404
+        assert json.loads(raw_actual) == {'message': 'not found'}
+        assert dynamodb.Table('data_table').scan()['Count'] == 1
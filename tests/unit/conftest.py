@@ -36,6 +36,11 @@ def s3_resource():
     return boto3.resource('s3', endpoint_url='http://localhost:4572')
 
 
+@pytest.fixture(scope='session')
+def sqs_client():
+    return boto3.client('sqs', endpoint_url='http://localhost:4576')
+
+
 @pytest.fixture(scope='function')
 def set_environ(monkeypatch, request):
     for k, v in request.param.items():
@@ -50,3 +55,10 @@ def create_s3_bucket(s3_resource, request):
     for object_summary in bucket.objects.all():
         object_summary.delete()
     bucket.delete()
+
+
+@pytest.fixture(scope='function')
+def create_sqs_queue(sqs_client, request):
+    queue_url = sqs_client.create_queue(QueueName=request.param)['QueueUrl']
+    yield queue_url
+    sqs_client.delete_queue(QueueUrl=queue_url)